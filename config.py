@@ -28,7 +28,18 @@ SERVER = {
 
 # 数据库配置
 DATABASE = {
-    'PATH': os.path.join(DB_DIR, 'messages.db')
+    'PATH': os.path.join(DB_DIR, 'messages.db'),
+    'POOL_SIZE': 8,                    # 连接池大小
+    'BUSY_TIMEOUT': 5000,              # 数据库被锁时的等待时间（毫秒）
+    'POOL_TIMEOUT': 10.0,              # 连接池耗尽时的等待时间（秒）
+    'CACHE_SIZE_KB': 16384,            # 每个连接的页缓存大小（KB）
+    'MMAP_SIZE': 256*1024*1024,        # 内存映射大小（字节）
+    'STATEMENT_CACHE_SIZE': 256,       # 每个连接缓存的预编译语句数量
+    'INGEST_QUEUE_SIZE': 10000,        # 消息写入队列容量
+    'INGEST_BATCH_SIZE': 500,          # 每批最多写入的消息数
+    'INGEST_FLUSH_INTERVAL': 0.5,      # 最长攒批时间（秒）
+    'INGEST_PUT_TIMEOUT': 2.0,         # 队列满时普通线程的等待时间（秒），超时后照常入队（保持顺序）；事件循环上不等待
+    'COUNT_CACHE_TTL': 30              # 消息面板总数的缓存时间（秒）
 }
 
 # HTTP 客户端配置
@@ -40,6 +51,72 @@ HTTP = {
     'CONNECTION_POOL_SIZE': 100
 }
 
+# 媒体下载配置
+MEDIA = {
+    'DOWNLOAD_WORKERS': 4,        # 同时进行的下载数量
+    'QUEUE_SIZE': 1000,           # 等待下载的附件数量上限，超出后放弃下载并记录日志
+    'CHUNK_SIZE': 64*1024,        # 流式写入磁盘的块大小（字节）
+    'DOWNLOAD_TIMEOUT': 120.0,    # 下载文件内容的读取超时（秒）
+    'INDEX_CACHE_SIZE': 10000,    # 内存中缓存的已下载文件索引条数
+    'X_ACCEL_PREFIX': '/protected_files/',  # nginx 内部路径，由 nginx 直接发送文件；不使用 nginx 时设为 None
+    'CACHE_MAX_AGE': 365*24*3600, # 浏览器缓存时间（秒），文件名对应的内容不会改变
+    'THUMB_SIZE': 320             # 照片缩略图取最长边不小于该值（像素）的最小版本
+}
+
+# 媒体保留策略：按消息类型设置附件保留天数，None 表示永久保留
+RETENTION = {
+    'POLICIES': {
+        'sticker': 7,
+        'video': 30,
+        'photo': 90,
+        'document': None
+    },
+    'CHAT_POLICIES': {},          # 按群组覆盖，例如 {-1001234567890: {'video': 7, 'photo': None}}
+    'SWEEP_INTERVAL': 600,        # 两次清理之间的间隔（秒）
+    'SWEEP_BATCH_SIZE': 200,      # 每批最多清理的附件数
+    'SWEEP_PAUSE': 1.0            # 批次之间的停顿（秒），避免集中占用磁盘
+}
+
+# 定时任务配置
+SCHEDULER = {
+    'CATCHUP_RATE': 5,           # 重启后补执行过期任务的速度（个/秒）
+    'DELETE_BATCH_DELAY': 1.0,   # 自动删除消息时等待合并的时间（秒）
+    'DELETE_BATCH_SIZE': 100     # 每次批量删除的最大消息数（Telegram 上限为 100）
+}
+
+# 自动禁言配置
+AUTO_MUTE = {
+    'CONCURRENCY': 50,            # 同一时刻切换多个群组时的并发数（实际速度仍受 RATE_LIMIT 限制）
+    'STALL_THRESHOLD': 60         # 调度协程被推迟超过该秒数时，重新核对所有群组的禁言状态
+}
+
+# Telegram 数据缓存配置（秒）
+CACHE = {
+    'PERMISSIONS_TTL': 300,       # 群组默认权限的缓存时间，我们自己修改权限时同步更新
+    'CHAT_TITLE_TTL': 3600,       # 群组标题，收到群消息时同步更新
+    'ADMINS_TTL': 600,            # 管理员列表（同时用于判断机器人是否为管理员）
+    'MEMBER_COUNT_TTL': 300       # 群组成员数，成员进出时按增量更新
+}
+
+# 面板实时推送配置（Server-Sent Events）
+EVENTS = {
+    'CLIENT_BUFFER': 256,        # 每个面板连接最多积压的事件数，超出后让该面板重新同步
+    'MAX_CLIENTS': 32,           # 同时连接的面板数量上限
+    'KEEPALIVE_INTERVAL': 15,    # 心跳间隔（秒），防止代理断开空闲连接
+    'MAX_MESSAGES_PER_EVENT': 500  # 单个批次新消息超过该数量时只通知面板重新加载
+}
+
+# Bot API 限速配置（参考 Telegram 的频率限制）
+RATE_LIMIT = {
+    'GLOBAL_RATE': 30,            # 发送、编辑、删除、禁言等写操作每秒最多次数
+    'GLOBAL_BURST': 30,           # 写操作允许的突发调用数
+    'READ_RATE': 30,              # get* 查询（成员、管理员、群组信息等）每秒最多次数，与写操作分开计算
+    'READ_BURST': 30,             # 查询允许的突发调用数
+    'GROUP_RATE_PER_MINUTE': 20,  # 每个群组每分钟最多发送的消息数
+    'PRIORITY_RESERVE': 5,        # 为删除、禁言等管理操作保留的全局令牌数
+    'MAX_RETRIES': 3              # 收到 429 后最多重试次数
+}
+
 # 日志配置
 LOGGING = {
     'FILE_PATH': os.path.join(LOG_DIR, 'telegram_bot.log'),
@@ -115,8 +115,25 @@ function AutoMuteStatusPanel() {
   useEffect(() => {
     console.log('AutoMuteStatusPanel mounted');
     fetchSettings();
-    const interval = setInterval(fetchSettings, 10000);
-    return () => clearInterval(interval);
+    // 实时推送连接正常时不轮询，收到自动禁言相关推送再刷新
+    const interval = setInterval(() => {
+      if (!window.liveEventsConnected) {
+        fetchSettings();
+      }
+    }, 10000);
+
+    function handleLiveEvent(event) {
+      const { type } = event.detail;
+      if (type === 'auto_mute' || type === 'resync') {
+        fetchSettings();
+      }
+    }
+
+    window.addEventListener('liveEvent', handleLiveEvent);
+    return () => {
+      clearInterval(interval);
+      window.removeEventListener('liveEvent', handleLiveEvent);
+    };
   }, []);
 
   // 格式化时间显示
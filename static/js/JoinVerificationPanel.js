@@ -215,15 +215,35 @@ function JoinVerificationPanel() {
   // 定期刷新待验证用户列表
   useEffect(() => {
     if (selectedChatId) {
-      // 每30秒刷新一次
+      // 每30秒刷新一次，实时推送连接正常时跳过
       const interval = setInterval(() => {
-        fetchPendingMembers(selectedChatId);
+        if (!window.liveEventsConnected) {
+          fetchPendingMembers(selectedChatId);
+        }
       }, 30000);
       
       return () => clearInterval(interval);
     }
   }, [selectedChatId]);
 
+  // 收到入群验证状态变化的推送时刷新
+  useEffect(() => {
+    if (!selectedChatId) return;
+
+    function handleLiveEvent(event) {
+      const { type, data } = event.detail;
+      if (type === 'resync' ||
+          (type === 'verification' && (data.chat_id === null || String(data.chat_id) === String(selectedChatId)))) {
+        fetchPendingMembers(selectedChatId);
+      }
+    }
+
+    window.addEventListener('liveEvent', handleLiveEvent);
+    return () => {
+      window.removeEventListener('liveEvent', handleLiveEvent);
+    };
+  }, [selectedChatId]);
+
   return React.createElement('div', { 
     className: 'mt-6 border-t pt-4'
   }, [
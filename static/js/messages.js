@@ -1,6 +1,16 @@
 // messages.js
 let currentPage = 1;
 let totalPages = 1;
+// 游标分页：当前页的游标（{before} 或 {after}），null 表示最新一页
+let currentCursor = null;
+let nextCursor = null;
+let prevCursor = null;
+// 增量刷新：已经拿到的最新消息 id 和当前的消息总数
+let lastMessageId = null;
+let currentTotal = 0;
+// 实时推送连接，断开期间退回到定时轮询
+let eventSource = null;
+window.liveEventsConnected = false;
 let autoRefreshInterval;
 // 在顶部添加群组筛选相关变量
 let currentFilters = {
@@ -9,6 +19,8 @@ let currentFilters = {
     groupId: 'all',
     pageSize: 50  // 默认值
 };
+// 当前的搜索关键词，为空时显示普通消息列表
+let currentSearch = '';
 
 // 格式化时间戳
 function formatTimestamp(timestamp) {
@@ -29,36 +41,54 @@ function formatTimestamp(timestamp) {
     }
 }
 
-// 创建媒体内容
+// 创建媒体内容：有缩略图时只加载缩略图，点击后再打开原文件
 function createMediaContent(msg) {
-    if (!msg.file_path) {
+    if (msg.file_path === 'expired') {
+        return '<div class="media-content">附件已过期清理</div>';
+    }
+    if (!msg.file_path && !msg.thumb_path) {
         return '';
     }
 
-    const fullPath = msg.file_path.startsWith('/') ? msg.file_path : '/' + msg.file_path;
+    const fullPath = msg.file_path
+        ? (msg.file_path.startsWith('/') ? msg.file_path : '/' + msg.file_path)
+        : null;
+    const thumbPath = msg.thumb_path || null;
+    const previewPath = thumbPath || fullPath;
     
     switch(msg.message_type) {
         case 'photo':
+        case 'sticker': {
+            const alt = msg.message_type === 'photo' ? 'Photo' : 'Sticker';
+            const img = `<img src="${previewPath}" alt="${alt}" loading="lazy" onerror="handleImageError(this)">`;
             return `<div class="media-content">
-                <img src="${fullPath}" alt="Photo" loading="lazy" onerror="handleImageError(this)">
+                ${fullPath && thumbPath ? `<a href="${fullPath}" target="_blank">${img}</a>` : img}
             </div>`;
+        }
         case 'video':
+            if (!fullPath) {
+                return `<div class="media-content">
+                    <img src="${thumbPath}" alt="Video" loading="lazy" onerror="handleImageError(this)">
+                </div>`;
+            }
             return `<div class="media-content">
-                <video controls onerror="handleVideoError(this)">
+                <video controls preload="none" ${thumbPath ? `poster="${thumbPath}"` : ''} onerror="handleVideoError(this)">
                     <source src="${fullPath}" type="video/mp4">
                     您的浏览器不支持视频标签。
                 </video>
             </div>`;
         case 'document':
+            if (!fullPath) {
+                return `<div class="media-content">
+                    <img src="${thumbPath}" alt="Document" loading="lazy" onerror="handleImageError(this)">
+                </div>`;
+            }
             return `<div class="media-content">
                 <a href="${fullPath}" target="_blank" class="file-link">
+                    ${thumbPath ? `<img src="${thumbPath}" alt="Document" loading="lazy" onerror="handleImageError(this)">` : ''}
                     📎 查看文件
                 </a>
             </div>`;
-        case 'sticker':
-            return `<div class="media-content">
-                <img src="${fullPath}" alt="Sticker" loading="lazy" onerror="handleImageError(this)">
-            </div>`;
         default:
             return '';
     }
@@ -68,6 +98,15 @@ function createMediaContent(msg) {
 function createMessageElement(msg) {
     const messageElement = document.createElement('div');
     messageElement.className = 'message';
+    messageElement.dataset.id = msg.id;
+    messageElement.dataset.timestamp = msg.timestamp;
+    messageElement.dataset.chatId = msg.chat_id;
+    if (msg.message_id) {
+        messageElement.dataset.messageId = msg.message_id;
+    }
+    messageElement.dataset.messageType = msg.message_type;
+    messageElement.dataset.filePath = msg.file_path || '';
+    messageElement.dataset.thumbPath = msg.thumb_path || '';
     
     // 确保 from_user_id 存在且不为空
     const hasUserId = msg.from_user_id && msg.from_user_id !== 'null' && msg.from_user_id !== 'undefined';
@@ -163,27 +202,46 @@ function handleVideoError(video) {
 }
 
 // 分页功能
+// 总数来自服务端缓存，页码只用于显示
 function renderPagination(total, current, perPage) {
-    const totalPages = Math.ceil(total / perPage);
+    totalPages = Math.max(1, Math.ceil(total / perPage));
     const pagination = document.getElementById('pagination');
     
-    if (totalPages <= 1) {
+    if (!nextCursor && !prevCursor) {
         pagination.style.display = 'none';
         return;
     }
     
     pagination.style.display = 'flex';
     pagination.innerHTML = `
-        <button onclick="changePage(1)" ${current === 1 ? 'disabled' : ''}>首页</button>
-        <button onclick="changePage(${current - 1})" ${current === 1 ? 'disabled' : ''}>上一页</button>
-        <span class="page-info">第 ${current} 页，共 ${totalPages} 页</span>
-        <button onclick="changePage(${current + 1})" ${current === totalPages ? 'disabled' : ''}>下一页</button>
-        <button onclick="changePage(${totalPages})" ${current === totalPages ? 'disabled' : ''}>末页</button>
+        <button onclick="changePage('first')" ${!prevCursor ? 'disabled' : ''}>首页</button>
+        <button onclick="changePage('prev')" ${!prevCursor ? 'disabled' : ''}>上一页</button>
+        <span class="page-info">第 ${current} 页，共约 ${totalPages} 页</span>
+        <button onclick="changePage('next')" ${!nextCursor ? 'disabled' : ''}>下一页</button>
+        <button onclick="changePage('last')" ${!nextCursor ? 'disabled' : ''}>末页</button>
     `;
 }
 
-function changePage(page) {
-    currentPage = page;
+function changePage(direction) {
+    switch (direction) {
+        case 'first':
+            currentCursor = null;
+            currentPage = 1;
+            break;
+        case 'prev':
+            currentCursor = { after: prevCursor };
+            currentPage = Math.max(1, currentPage - 1);
+            break;
+        case 'next':
+            currentCursor = { before: nextCursor };
+            currentPage += 1;
+            break;
+        case 'last':
+            // 从最早的消息之后开始取，得到的就是最后一页
+            currentCursor = { after: btoa(JSON.stringify(['', 0])) };
+            currentPage = totalPages;
+            break;
+    }
     fetchMessages();
     window.scrollTo(0, 0);
 }
@@ -242,16 +300,23 @@ async function sendMessage() {
 // 获取消息列表
 // 修改获取消息函数
 async function fetchMessages() {
+    // 回到普通消息列表时清除搜索状态
+    currentSearch = '';
+    const searchInput = document.getElementById('searchInput');
+    if (searchInput) {
+        searchInput.value = '';
+    }
+
     const messagesContainer = document.getElementById('messages');
     messagesContainer.innerHTML = '<div class="loading">加载消息中...</div>';
 
     try {
         const queryParams = new URLSearchParams({
-            page: currentPage,
             per_page: currentFilters.pageSize,  // 使用选择的页面大小
             chat_type: currentFilters.chatType,
             message_type: currentFilters.messageType,
-            group_id: currentFilters.groupId
+            group_id: currentFilters.groupId,
+            ...(currentCursor || {})
         });
 
         const response = await fetch(`/messages?${queryParams}`);
@@ -260,6 +325,18 @@ async function fetchMessages() {
         }
         
         const data = await response.json();
+
+        // 向前翻到头时不足一页，直接回到最新一页
+        if (currentCursor && currentCursor.after && !data.prev_cursor) {
+            currentCursor = null;
+            currentPage = 1;
+            return fetchMessages();
+        }
+
+        nextCursor = data.next_cursor;
+        prevCursor = data.prev_cursor;
+        lastMessageId = data.last_id;
+        currentTotal = data.total;
         messagesContainer.innerHTML = '';
 
         if (data.messages && data.messages.length > 0) {
@@ -267,12 +344,12 @@ async function fetchMessages() {
                 const messageElement = createMessageElement(msg);
                 messagesContainer.appendChild(messageElement);
             });
-            renderPagination(data.total, data.page, data.per_page);
+            renderPagination(data.total, currentPage, data.per_page);
             
             // 添加消息统计信息
             const statsElement = document.createElement('div');
             statsElement.className = 'message-stats';
-            statsElement.innerHTML = `显示第 ${(data.page - 1) * data.per_page + 1} 到 ${Math.min(data.page * data.per_page, data.total)} 条，共 ${data.total} 条消息`;
+            statsElement.textContent = `本页 ${data.messages.length} 条，共约 ${data.total} 条消息`;
             messagesContainer.insertBefore(statsElement, messagesContainer.firstChild);
         } else {
             messagesContainer.innerHTML = '<div class="no-messages">暂无消息</div>';
@@ -288,6 +365,193 @@ async function fetchMessages() {
     }
 }
 
+// 增量获取新消息，只在查看最新一页时使用
+async function fetchNewMessages() {
+    if (currentSearch || currentCursor || lastMessageId === null) {
+        return;
+    }
+
+    try {
+        const queryParams = new URLSearchParams({
+            since_id: lastMessageId,
+            per_page: currentFilters.pageSize,
+            chat_type: currentFilters.chatType,
+            message_type: currentFilters.messageType,
+            group_id: currentFilters.groupId
+        });
+
+        const response = await fetch(`/messages?${queryParams}`);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+
+        const data = await response.json();
+        // 等待期间切换了筛选条件或页码，结果作废
+        if (currentCursor || String(lastMessageId) !== queryParams.get('since_id')) {
+            return;
+        }
+        if (data.reset) {
+            fetchMessages();
+            return;
+        }
+        lastMessageId = data.last_id;
+        if (data.unchanged || data.messages.length === 0) {
+            return;
+        }
+
+        prependMessages(data.messages);
+        refreshGroupsIfChanged(data.messages);
+    } catch (error) {
+        console.error('Error fetching new messages:', error);
+    }
+}
+
+// 出现新的群组或群组改名时才刷新群组列表
+function refreshGroupsIfChanged(messages) {
+    const groupFilter = document.getElementById('groupFilter');
+    const known = new Map(Array.from(groupFilter.options).map(option => [option.value, option.textContent]));
+    const groupsChanged = messages.some(msg =>
+        ['group', 'supergroup'].includes(msg.chat_type) && known.get(String(msg.chat_id)) !== msg.chat_title
+    );
+    if (groupsChanged) {
+        fetchGroups();
+    }
+}
+
+// 判断推送的消息是否符合当前的筛选条件
+function matchesFilters(msg) {
+    return (currentFilters.chatType === 'all' || msg.chat_type === currentFilters.chatType) &&
+        (currentFilters.messageType === 'all' || msg.message_type === currentFilters.messageType) &&
+        (currentFilters.groupId === 'all' || String(msg.chat_id) === String(currentFilters.groupId));
+}
+
+// 处理服务端推送的新消息
+function handleLiveMessages(data) {
+    const autoRefresh = document.getElementById('autoRefresh');
+    // 不在最新一页或暂停了自动刷新时先不处理，之后用 since_id 补齐
+    if (currentSearch || currentCursor || lastMessageId === null || (autoRefresh && !autoRefresh.checked)) {
+        return;
+    }
+    if (data.reset) {
+        fetchMessages();
+        return;
+    }
+
+    const messages = data.messages.filter(msg => msg.id > lastMessageId && matchesFilters(msg));
+    lastMessageId = Math.max(lastMessageId, data.last_id);
+    if (messages.length > 0) {
+        prependMessages(messages);
+    }
+    refreshGroupsIfChanged(data.messages);
+}
+
+// 连接实时事件流，其它面板通过 window 上的 liveEvent 事件接收推送
+function setupLiveEvents() {
+    if (!window.EventSource) {
+        return;
+    }
+
+    eventSource = new EventSource('/events');
+
+    eventSource.addEventListener('open', () => {
+        window.liveEventsConnected = true;
+        // 补齐断线期间错过的消息
+        fetchNewMessages();
+    });
+
+    eventSource.addEventListener('error', () => {
+        window.liveEventsConnected = false;
+    });
+
+    eventSource.addEventListener('messages', (event) => {
+        handleLiveMessages(JSON.parse(event.data));
+    });
+
+    eventSource.addEventListener('resync', () => {
+        if (!currentSearch) {
+            fetchMessages();
+        }
+    });
+
+    eventSource.addEventListener('media', (event) => {
+        handleMediaReady(JSON.parse(event.data));
+    });
+
+    ['verification', 'auto_mute', 'moderation', 'resync'].forEach(type => {
+        eventSource.addEventListener(type, (event) => {
+            window.dispatchEvent(new CustomEvent('liveEvent', {
+                detail: { type, data: JSON.parse(event.data) }
+            }));
+        });
+    });
+}
+
+// 附件或缩略图在后台下载完成后更新对应消息的显示
+function handleMediaReady(data) {
+    const element = document.querySelector(
+        `.message[data-chat-id="${data.chat_id}"][data-message-id="${data.message_id}"]`
+    );
+    if (!element) {
+        return;
+    }
+    if (data.file_path) {
+        element.dataset.filePath = data.file_path;
+    }
+    if (data.thumb_path) {
+        element.dataset.thumbPath = data.thumb_path;
+        // 原文件已经显示时不再替换，避免打断正在播放的视频
+        if (!data.file_path && element.dataset.filePath) {
+            return;
+        }
+    }
+
+    const existing = element.querySelector('.media-content');
+    if (existing) {
+        existing.remove();
+    }
+    element.querySelector('.message-content').insertAdjacentHTML('beforeend', createMediaContent({
+        message_type: element.dataset.messageType,
+        file_path: element.dataset.filePath,
+        thumb_path: element.dataset.thumbPath
+    }));
+}
+
+// 把新消息插入到列表顶部，并保持每页条数不变
+function prependMessages(messages) {
+    const messagesContainer = document.getElementById('messages');
+    let statsElement = messagesContainer.querySelector('.message-stats');
+    if (!statsElement) {
+        messagesContainer.innerHTML = '';
+        statsElement = document.createElement('div');
+        statsElement.className = 'message-stats';
+        messagesContainer.appendChild(statsElement);
+    }
+
+    // 返回的消息按 id 从新到旧排列，倒序插入到统计信息后面
+    let added = 0;
+    messages.slice().reverse().forEach(msg => {
+        if (messagesContainer.querySelector(`.message[data-id="${msg.id}"]`)) {
+            return;
+        }
+        messagesContainer.insertBefore(createMessageElement(msg), statsElement.nextSibling);
+        added++;
+    });
+
+    const elements = messagesContainer.querySelectorAll('.message');
+    for (let i = currentFilters.pageSize; i < elements.length; i++) {
+        elements[i].remove();
+    }
+
+    const shown = messagesContainer.querySelectorAll('.message');
+    const last = shown[shown.length - 1];
+    if (last && shown.length < elements.length) {
+        nextCursor = btoa(JSON.stringify([last.dataset.timestamp, Number(last.dataset.id)]));
+    }
+    currentTotal += added;
+    statsElement.textContent = `本页 ${shown.length} 条，共约 ${currentTotal} 条消息`;
+    renderPagination(currentTotal, currentPage, currentFilters.pageSize);
+}
+
 // 添加获取群组列表的函数
 async function fetchGroups() {
     try {
@@ -325,10 +589,13 @@ function setupAutoRefresh() {
     
     function updateAutoRefresh() {
         if (autoRefreshCheckbox.checked) {
+            // 只拉取新消息，群组列表在出现新群组时才刷新；实时推送连接正常时不轮询
             autoRefreshInterval = setInterval(() => {
-                fetchMessages();
-                fetchGroups(); // 定期更新群组列表
+                if (!window.liveEventsConnected) {
+                    fetchNewMessages();
+                }
             }, 5000);
+            fetchNewMessages();
         } else {
             clearInterval(autoRefreshInterval);
         }
@@ -353,7 +620,62 @@ function updateFilters() {
     };
     
     currentPage = 1;  // 重置到第一页
-    fetchMessages();
+    currentCursor = null;
+    if (currentSearch) {
+        searchMessages();
+    } else {
+        fetchMessages();
+    }
+}
+
+// 全文搜索，结果按相关度排列，消息内容显示为高亮片段
+async function searchMessages() {
+    currentSearch = document.getElementById('searchInput').value.trim();
+    if (!currentSearch) {
+        fetchMessages();
+        return;
+    }
+
+    const messagesContainer = document.getElementById('messages');
+    messagesContainer.innerHTML = '<div class="loading">搜索中...</div>';
+    document.getElementById('pagination').innerHTML = '';
+
+    try {
+        const queryParams = new URLSearchParams({
+            q: currentSearch,
+            per_page: currentFilters.pageSize,
+            chat_type: currentFilters.chatType,
+            message_type: currentFilters.messageType,
+            group_id: currentFilters.groupId
+        });
+        const response = await fetch(`/messages/search?${queryParams}`);
+        const data = await response.json();
+        if (!response.ok || data.status !== 'success') {
+            throw new Error(data.message || `HTTP error! status: ${response.status}`);
+        }
+
+        messagesContainer.innerHTML = '';
+        if (data.messages.length === 0) {
+            messagesContainer.innerHTML = '<div class="no-messages">没有找到匹配的消息</div>';
+            return;
+        }
+
+        const statsElement = document.createElement('div');
+        statsElement.className = 'message-stats';
+        statsElement.textContent = `搜索“${currentSearch}”找到 ${data.messages.length}${data.has_more ? '+' : ''} 条消息（${data.took_ms} 毫秒）`;
+        messagesContainer.appendChild(statsElement);
+        data.messages.forEach(msg => {
+            messagesContainer.appendChild(createMessageElement({ ...msg, message_content: msg.snippet }));
+        });
+    } catch (error) {
+        console.error('Error searching messages:', error);
+        messagesContainer.innerHTML = `
+            <div class="error-container">
+                <div class="error-message">搜索时出错：${error.message}</div>
+                <button onclick="searchMessages()" class="retry-button">重试</button>
+            </div>
+        `;
+    }
 }
 
 // 页面初始化
@@ -362,4 +684,5 @@ document.addEventListener('DOMContentLoaded', () => {
     fetchGroups(); // 获取群组列表
     fetchMessages();
     setupAutoRefresh();
+    setupLiveEvents();
 });
\ No newline at end of file
@@ -1,14 +1,16 @@
 from config import *
-from flask import Flask, request, jsonify, session, redirect, url_for, send_file, render_template
+from flask import Flask, request, jsonify, session, redirect, url_for, send_file, render_template, Response, stream_with_context
 from datetime import timedelta
 import httpx
 import telegram
 from telegram import Update
 from telegram.request import HTTPXRequest
 import json
+import base64
 import logging
 from logging.handlers import RotatingFileHandler
 import os
+import sys
 from datetime import datetime
 import pytz
 import sqlite3
@@ -16,15 +18,21 @@ from pathlib import Path
 import asyncio
 from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 from telegram.error import NetworkError, Forbidden, BadRequest
 from telegram.constants import ChatMemberStatus
 from telegram import ChatPermissions
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import queue
 import time
+import heapq
+import contextvars
 from telegram import ChatMember
 import re
+import collections
+import hashlib
+import html
+import mimetypes
 
 # 1. 首先创建 logger
 logger = logging.getLogger('TelegramBot')
@@ -80,314 +88,1768 @@ def init_directories():
 init_directories()
 
 
+# 常驻异步运行时
+class AsyncRuntime:
+    """
+    常驻的 asyncio 运行时
+
+    Flask 路由和后台任务的协程都提交到同一个事件循环上执行，
+    连接池、缓存以及协程创建的后台任务都能跨请求复用。
+    以脚本方式启动时直接使用主线程的事件循环，否则按需启动一个后台线程。
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0}
+
+    def attach(self, loop):
+        """使用已有的事件循环作为运行时（由主线程负责运行它）"""
+        with self._lock:
+            self._loop = loop
+            self._thread = None
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._start_thread()
+            return self._loop
+
+    def _start_thread(self):
+        """启动后台事件循环线程（调用方需持有锁）"""
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='async-runtime', daemon=True)
+        self._thread.start()
+        ready.wait()
+        self._loop = loop
+        logger.info("[运行时] 后台事件循环线程已启动")
+
+    def submit(self, coro):
+        """线程安全地提交协程，返回 concurrent.futures.Future"""
+        # run_coroutine_threadsafe 会复制调用线程的 contextvars，
+        # 因此协程内仍然可以访问 Flask 的 request / app 上下文
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        with self._lock:
+            self._stats['submitted'] += 1
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        with self._lock:
+            if future.cancelled() or future.exception() is not None:
+                self._stats['failed'] += 1
+            else:
+                self._stats['completed'] += 1
+
+    def run(self, coro, timeout=None):
+        """在运行时中执行协程并同步等待结果（不能在运行时线程内调用）"""
+        loop = self.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            coro.close()
+            raise RuntimeError("Cannot block on the runtime loop from inside itself")
+        return self.submit(coro).result(timeout)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['in_flight'] = stats['submitted'] - stats['completed'] - stats['failed']
+        return stats
+
+# 创建全局运行时
+runtime = AsyncRuntime()
+
+
+class TokenBucket:
+    """令牌桶，rate 为每秒补充的令牌数，capacity 为桶容量（允许的突发量）"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        """在 seconds 秒内不发放令牌（收到 429 时使用），调用方需持有锁"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def try_take(self, reserve=0):
+        """
+        尝试取一个令牌，桶中至少要留下 reserve 个
+
+        取到返回 0，否则返回大约还需等待的秒数。调用方需持有锁。
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= reserve + 1:
+            self.tokens -= 1
+            return 0
+        return (reserve + 1 - self.tokens) / self.rate
+
+    @property
+    def is_full(self):
+        if time.monotonic() < self.paused_until:
+            return False
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class RateLimiter:
+    """
+    Bot API 限速器
+
+    全局令牌桶按 RATE_LIMIT['GLOBAL_RATE'] 次/秒限制发送、编辑、删除、禁言等写操作；
+    get* 查询（成员列表、管理员、群组信息等）使用单独的 READ_RATE 桶，
+    批量查询成员时不会占用发送和管理操作的令牌。
+    向群组发送消息的方法另外按群组限制为 RATE_LIMIT['GROUP_RATE_PER_MINUTE'] 次/分钟。
+    发送类调用（通知、欢迎语等）不能动用全局桶里最后 PRIORITY_RESERVE 个令牌，
+    这部分留给删除、禁言、踢人等管理操作，保证刷屏时管理操作优先执行。
+    收到 429 时按 retry_after 暂停该调用所用的桶（群组桶、查询桶或全局桶），所有调用方一起等待。
+    """
+
+    # 受群组频率限制、优先级较低的发送类方法
+    SEND_METHODS = frozenset({
+        'sendMessage', 'sendPhoto', 'sendVideo', 'sendDocument', 'sendSticker', 'sendAnimation',
+        'sendVoice', 'sendAudio', 'sendVideoNote', 'sendMediaGroup', 'sendPoll', 'sendLocation',
+        'sendContact', 'sendDice', 'forwardMessage', 'copyMessage'
+    })
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._global = TokenBucket(RATE_LIMIT['GLOBAL_RATE'], RATE_LIMIT['GLOBAL_BURST'])
+        self._reads = TokenBucket(RATE_LIMIT['READ_RATE'], RATE_LIMIT['READ_BURST'])
+        self._chats = {}
+        self._stats = {'calls': 0, 'throttled': 0, 'wait_seconds': 0.0, 'retry_after': 0, 'retry_failed': 0,
+                       'chat_pauses': 0, 'global_pauses': 0, 'read_pauses': 0}
+
+    async def _take(self, bucket, reserve):
+        waited = 0.0
+        while True:
+            with self._lock:
+                delay = bucket.try_take(reserve)
+            if delay <= 0:
+                return waited
+            waited += delay
+            await asyncio.sleep(delay)
+
+    def _chat_bucket(self, chat_id):
+        with self._lock:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                if len(self._chats) >= 10000:
+                    # 丢弃已经回满的桶，它们与新建的桶没有区别
+                    self._chats = {key: value for key, value in self._chats.items() if not value.is_full}
+                per_minute = RATE_LIMIT['GROUP_RATE_PER_MINUTE']
+                bucket = self._chats[chat_id] = TokenBucket(per_minute / 60, per_minute)
+            return bucket
+
+    def _uses_chat_bucket(self, method, chat_id):
+        return method in self.SEND_METHODS and isinstance(chat_id, int) and chat_id < 0
+
+    @staticmethod
+    def _is_read(method):
+        return method.startswith('get')
+
+    async def acquire(self, method, chat_id=None):
+        """在发起调用前等待令牌"""
+        is_send = method in self.SEND_METHODS
+        waited = 0.0
+        if self._is_read(method):
+            waited += await self._take(self._reads, 0)
+        else:
+            if self._uses_chat_bucket(method, chat_id):
+                waited += await self._take(self._chat_bucket(chat_id), 0)
+            waited += await self._take(self._global, RATE_LIMIT['PRIORITY_RESERVE'] if is_send else 0)
+        with self._lock:
+            self._stats['calls'] += 1
+            if waited:
+                self._stats['throttled'] += 1
+                self._stats['wait_seconds'] += waited
+
+    def record_retry_after(self, method, chat_id, retry_after, failed=False):
+        """记录一次 429，并在 retry_after 秒内暂停对应的桶"""
+        if self._is_read(method):
+            bucket, counter = self._reads, 'read_pauses'
+        elif self._uses_chat_bucket(method, chat_id):
+            bucket, counter = self._chat_bucket(chat_id), 'chat_pauses'
+        else:
+            bucket, counter = self._global, 'global_pauses'
+        with self._lock:
+            bucket.pause(retry_after)
+            self._stats['retry_after'] += 1
+            self._stats[counter] += 1
+            if failed:
+                self._stats['retry_failed'] += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['wait_seconds'] = round(stats['wait_seconds'], 2)
+            stats['tracked_chats'] = len(self._chats)
+        return stats
+
+# 创建全局限速器，所有 bot 共享
+rate_limiter = RateLimiter()
+
+class _TimedHTTPXRequest(HTTPXRequest):
+    """
+    Bot API 请求
+
+    每次调用先经过 rate_limiter 限速，并记录耗时；
+    收到 429 时暂停对应的令牌桶 retry_after 秒，重试时和其他调用一起在限速器里等待，
+    重试 RATE_LIMIT['MAX_RETRIES'] 次仍失败才交给调用方。
+    """
+
+    def __init__(self, manager, **kwargs):
+        super().__init__(**kwargs)
+        self._manager = manager
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        chat_id = None
+        if request_data is not None:
+            try:
+                chat_id = int(request_data.parameters.get('chat_id'))
+            except (TypeError, ValueError):
+                chat_id = None
+
+        for attempt in range(RATE_LIMIT['MAX_RETRIES'] + 1):
+            await rate_limiter.acquire(api_method, chat_id)
+            started = time.perf_counter()
+            try:
+                code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            finally:
+                self._manager._record_latency(time.perf_counter() - started)
+            if code != 429:
+                return code, payload
+
+            try:
+                retry_after = json.loads(payload)['parameters']['retry_after']
+            except Exception:
+                retry_after = 1
+            last_attempt = attempt == RATE_LIMIT['MAX_RETRIES']
+            rate_limiter.record_retry_after(api_method, chat_id, retry_after, failed=last_attempt)
+            if last_attempt:
+                return code, payload
+            logger.warning(f"[限速] {api_method} 触发频率限制，{retry_after} 秒后重试（chat_id={chat_id}）")
+
+
 # Bot 管理器类
 class TelegramBotManager:
+    """
+    Bot 连接池管理器
+
+    每个事件循环只持有一个预热过的 bot（底层为一个 HTTPXRequest 连接池），
+    所有 get_bot() 调用共享该连接池，避免每次操作都重新进行 TCP+TLS 握手。
+    """
+
     def __init__(self):
         self.token = TELEGRAM['BOT_TOKEN']
-        self._request = None
-        self.bot = None
-        self._initialized = False
-        self._lock = asyncio.Lock()
+        self.bot = None  # 第一个初始化的 bot，用于解析 Update 等不需要网络的场景
+        self._clients = {}  # 事件循环 -> 已预热的 bot
+        self._locks = {}  # 事件循环 -> 创建 bot 时使用的锁
+        self._guard = threading.Lock()
+        self._stats = {
+            'pool_hits': 0,
+            'pool_misses': 0,
+            'api_calls': 0,
+            'total_latency': 0.0,
+            'max_latency': 0.0,
+            'last_latency': 0.0
+        }
+
+    def _create_request(self):
+        """按配置创建带连接池的请求对象"""
+        return _TimedHTTPXRequest(
+            self,
+            connection_pool_size=HTTP['CONNECTION_POOL_SIZE'],
+            connect_timeout=HTTP['CONNECT_TIMEOUT'],
+            read_timeout=HTTP['READ_TIMEOUT'],
+            write_timeout=HTTP['WRITE_TIMEOUT'],
+            pool_timeout=HTTP['POOL_TIMEOUT']
+        )
+
+    def _get_lock(self, loop):
+        with self._guard:
+            # 顺便清理已关闭事件循环留下的记录
+            for closed_loop in [l for l in self._clients if l.is_closed()]:
+                self._clients.pop(closed_loop, None)
+                self._locks.pop(closed_loop, None)
+            lock = self._locks.get(loop)
+            if lock is None:
+                lock = asyncio.Lock()
+                self._locks[loop] = lock
+            return lock
+
+    async def _get_client(self):
+        """获取当前事件循环共享的 bot，不存在时创建并预热"""
+        loop = asyncio.get_running_loop()
+        bot = self._clients.get(loop)
+        if bot is not None:
+            self._count('pool_hits')
+            return bot
+
+        async with self._get_lock(loop):
+            bot = self._clients.get(loop)
+            if bot is not None:
+                self._count('pool_hits')
+                return bot
+
+            try:
+                bot = telegram.Bot(token=self.token, request=self._create_request())
+                # initialize 会调用 get_me，顺便完成连接池预热
+                await bot.initialize()
+            except Exception as e:
+                logger.error(f"Failed to warm up bot connection pool: {e}")
+                raise
+
+            with self._guard:
+                self._clients[loop] = bot
+                if self.bot is None:
+                    self.bot = bot
+            self._count('pool_misses')
+            logger.info("Bot connection pool warmed up successfully")
+            return bot
 
     async def initialize(self):
-        """初始化 bot 管理器"""
-        async with self._lock:
-            if not self._initialized:
-                try:
-                    # 为每个新的事件循环创建新的请求对象
-                    self._request = HTTPXRequest(
-                        connection_pool_size=HTTP['CONNECTION_POOL_SIZE'],
-                        connect_timeout=HTTP['CONNECT_TIMEOUT'],
-                        read_timeout=HTTP['READ_TIMEOUT'],
-                        write_timeout=HTTP['WRITE_TIMEOUT'],
-                        pool_timeout=HTTP['POOL_TIMEOUT']
-                    )
-                    self.bot = telegram.Bot(token=self.token, request=self._request)
-                    await self.bot.get_me()
-                    self._initialized = True
-                    logger.info("Bot connection pool warmed up successfully")
-                except Exception as e:
-                    logger.error(f"Failed to warm up bot connection pool: {e}")
-                    raise
+        """初始化 bot 管理器（预热当前事件循环的连接池）"""
+        await self._get_client()
 
     @asynccontextmanager
     async def get_bot(self):
-        """获取 bot 实例的上下文管理器"""
+        """获取 bot 实例的上下文管理器，同一事件循环内共享连接池"""
+        bot = await self._get_client()
         try:
-            # 确保在当前事件循环中初始化
-            if not self._initialized:
-                await self.initialize()
-            # 为每次请求创建新的 bot 实例
-            request = HTTPXRequest(
-                connection_pool_size=1,
-                connect_timeout=30.0,
-                read_timeout=30.0,
-                write_timeout=30.0,
-                pool_timeout=3.0
-            )
-            bot = telegram.Bot(token=self.token, request=request)
             yield bot
         except Exception as e:
             logger.error(f"Error in bot operation: {e}")
             raise
 
+    async def shutdown(self):
+        """关闭当前事件循环的连接池"""
+        loop = asyncio.get_running_loop()
+        with self._guard:
+            bot = self._clients.pop(loop, None)
+            self._locks.pop(loop, None)
+        if bot is None:
+            return
+        try:
+            await bot.shutdown()
+        except Exception as e:
+            logger.error(f"Error shutting down bot connection pool: {e}")
+
+    def _count(self, key):
+        with self._guard:
+            self._stats[key] += 1
+
+    def _record_latency(self, seconds):
+        with self._guard:
+            self._stats['api_calls'] += 1
+            self._stats['total_latency'] += seconds
+            self._stats['last_latency'] = seconds
+            if seconds > self._stats['max_latency']:
+                self._stats['max_latency'] = seconds
+
+    def get_stats(self):
+        """返回连接池命中率及 API 调用耗时统计"""
+        with self._guard:
+            stats = dict(self._stats)
+            active_clients = sum(1 for loop in self._clients if not loop.is_closed())
+        lookups = stats['pool_hits'] + stats['pool_misses']
+        calls = stats['api_calls']
+        return {
+            'active_clients': active_clients,
+            'pool_size': HTTP['CONNECTION_POOL_SIZE'],
+            'pool_hits': stats['pool_hits'],
+            'pool_misses': stats['pool_misses'],
+            'hit_rate': round(stats['pool_hits'] / lookups, 4) if lookups else None,
+            'api_calls': calls,
+            'avg_latency_ms': round(stats['total_latency'] / calls * 1000, 2) if calls else None,
+            'max_latency_ms': round(stats['max_latency'] * 1000, 2),
+            'last_latency_ms': round(stats['last_latency'] * 1000, 2)
+        }
+
 # 创建全局 bot 管理器
 bot_manager = TelegramBotManager()
 
 
+UPSERT_JOB_SQL = """
+    INSERT OR REPLACE INTO scheduled_jobs (task_id, job_type, payload, due_at)
+    VALUES (?, ?, ?, ?)
+"""
+DELETE_JOB_SQL = 'DELETE FROM scheduled_jobs WHERE task_id = ? AND due_at = ?'
+CANCEL_JOB_SQL = 'DELETE FROM scheduled_jobs WHERE task_id = ?'
+
+class _ScheduledTask:
+    """堆中的一个定时任务，func 为 None 表示已取消"""
+    __slots__ = ('due', 'seq', 'task_id', 'func')
+
+    def __init__(self, due, seq, task_id, func):
+        self.due = due
+        self.seq = seq
+        self.task_id = task_id
+        self.func = func
+
+    def __lt__(self, other):
+        return (self.due, self.seq) < (other.due, other.seq)
+
 class TaskManager:
+    """
+    基于最小堆的异步定时任务调度器
+
+    所有定时任务都放在一个按到期时间排序的堆里，由常驻事件循环上的一个协程统一等待最早的到期时间，
+    到期后为每个任务创建一个 asyncio 任务执行，不再为每个等待中的任务占用一个线程。
+    插入为 O(log n)；取消只做标记，被标记的条目在到达堆顶或堆中已取消的条目过多时清除。
+    同一个 task_id 重复调度时，旧的任务会被替换。
+
+    schedule_job 调度的任务同时写入 scheduled_jobs 表，执行或取消后删除，
+    重启时由 restore_jobs 恢复，因此禁言解除、验证超时等任务不会因为重启而丢失。
+    """
+
     def __init__(self):
-        self.executor = ThreadPoolExecutor(max_workers=10)
         self._lock = threading.Lock()
+        self._heap = []
         self._tasks = {}
+        self._running = {}
+        self._seq = 0
+        self._cancelled = 0
+        self._wakeup = None
+        self._started = False
+        self._stats = {
+            'scheduled': 0,
+            'executed': 0,
+            'failed': 0,
+            'cancelled': 0,
+            'total_lateness': 0.0,
+            'max_lateness': 0.0,
+            'last_lateness': 0.0
+        }
+
+    def start(self):
+        """在常驻运行时上启动调度协程（重复调用无副作用）"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        # 使用空的上下文启动，避免调度协程及其创建的任务继承某个请求的上下文
+        runtime.loop.call_soon_threadsafe(self._start_runner, context=contextvars.Context())
+
+    def _start_runner(self):
+        self._wakeup = asyncio.Event()
+        asyncio.get_running_loop().create_task(self._run())
+        logger.info("[定时任务] 调度器已启动")
+
+    def _wake(self):
+        if self._wakeup is not None:
+            runtime.loop.call_soon_threadsafe(self._wakeup.set)
 
     def schedule_task(self, task_id, func, delay):
-        """调度一个延迟执行的任务"""
-        def delayed_task():
+        """调度一个延迟执行的任务，func 接收一个 bot 实例，如果已存在同ID的任务则先取消"""
+        self.start()
+        with self._lock:
+            old = self._tasks.get(task_id)
+            if old is not None:
+                old.func = None
+                self._cancelled += 1
+                logger.info(f"[定时任务] 取消已存在的任务 {task_id}")
+
+            self._seq += 1
+            entry = _ScheduledTask(time.monotonic() + max(delay, 0), self._seq, task_id, func)
+            heapq.heappush(self._heap, entry)
+            self._tasks[task_id] = entry
+            self._stats['scheduled'] += 1
+            is_earliest = self._heap[0] is entry
+            self._compact()
+
+        if is_earliest:
+            self._wake()
+        logger.info(f"[定时任务] 已调度任务 {task_id}, 将在 {delay} 秒后执行")
+
+    def schedule_job(self, task_id, job_type, payload, delay):
+        """调度一个可持久化的任务，job_type 必须在 JOB_HANDLERS 中注册，payload 需可序列化为 JSON"""
+        if job_type not in JOB_HANDLERS:
+            raise ValueError(f"未知的任务类型: {job_type}")
+        due_at = time.time() + max(delay, 0)
+        ingest_writer.submit(UPSERT_JOB_SQL, (task_id, job_type, json.dumps(payload), due_at))
+        self._schedule_job(task_id, job_type, payload, delay, due_at)
+
+    def _schedule_job(self, task_id, job_type, payload, delay, due_at):
+        async def run_job(bot):
             try:
-                logger.info(f"[定时任务] 开始执行任务 {task_id}, 延迟 {delay} 秒")
-                time.sleep(delay)
-                
-                # 检查任务是否被取消
-                with self._lock:
-                    if task_id not in self._tasks:
-                        logger.info(f"[定时任务] 任务 {task_id} 已被取消，不执行")
-                        return
-                
-                # 创建新的事件循环
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
-                try:
-                    # 创建新的 bot 实例
-                    request = HTTPXRequest(
-                        connection_pool_size=1,
-                        connect_timeout=30.0,
-                        read_timeout=30.0,
-                        write_timeout=30.0,
-                        pool_timeout=3.0
-                    )
-                    bot = telegram.Bot(token=TOKEN, request=request)
-                    
-                    # 执行异步操作
-                    coroutine = func(bot)
-                    result = loop.run_until_complete(coroutine)
-                    logger.info(f"[定时任务] 任务 {task_id} 执行成功")
-                    return result
-                finally:
-                    loop.close()
-                    asyncio.set_event_loop(None)
-                    
+                await JOB_HANDLERS[job_type](bot, **payload)
             except asyncio.CancelledError:
-                logger.info(f"[定时任务] 任务 {task_id} 被取消")
-            except Exception as e:
-                logger.error(f"[定时任务] 任务 {task_id} 执行失败: {str(e)}", exc_info=True)
-            finally:
-                with self._lock:
-                    self._tasks.pop(task_id, None)
-                    logger.info(f"[定时任务] 任务 {task_id} 已从队列中移除")
+                # 被取消（包括关闭服务）时保留记录，由 cancel_task 或下次启动处理
+                raise
+            except Exception:
+                ingest_writer.submit(DELETE_JOB_SQL, (task_id, due_at))
+                raise
+            ingest_writer.submit(DELETE_JOB_SQL, (task_id, due_at))
+
+        self.schedule_task(task_id, run_job, delay)
+
+    def restore_jobs(self):
+        """
+        启动时从 scheduled_jobs 恢复任务
+
+        未到期的任务按原定时间执行；已过期的任务按 SCHEDULER['CATCHUP_RATE'] 限速依次补执行，
+        避免重启后瞬间发出大量 Telegram 请求。
+        """
+        with db.connection() as conn:
+            rows = conn.execute(
+                'SELECT task_id, job_type, payload, due_at FROM scheduled_jobs ORDER BY due_at'
+            ).fetchall()
+
+        now = time.time()
+        interval = 1.0 / SCHEDULER['CATCHUP_RATE']
+        overdue = 0
+        for task_id, job_type, payload, due_at in rows:
+            if job_type not in JOB_HANDLERS:
+                logger.warning(f"[定时任务] 跳过未知类型的任务 {task_id}: {job_type}")
+                continue
+            if due_at <= now:
+                delay = overdue * interval
+                overdue += 1
+            else:
+                delay = due_at - now
+            self._schedule_job(task_id, job_type, json.loads(payload), delay, due_at)
+
+        logger.info(f"[定时任务] 已恢复 {len(rows)} 个任务，其中 {overdue} 个已过期，将在 {overdue * interval:.0f} 秒内补执行")
 
+    def cancel_task(self, task_id):
+        """取消指定的任务，正在执行的任务也会被取消"""
+        ingest_writer.submit(CANCEL_JOB_SQL, (task_id,))
         with self._lock:
-            # 如果已存在相同ID的任务，先取消它
-            if task_id in self._tasks:
-                try:
-                    self._tasks[task_id].cancel()
-                    logger.info(f"[定时任务] 取消已存在的任务 {task_id}")
-                except Exception as e:
-                    logger.error(f"[定时任务] 取消任务 {task_id} 时出错: {str(e)}")
-                self._tasks.pop(task_id, None)
-            
-            # 提交新任务
-            future = self.executor.submit(delayed_task)
-            self._tasks[task_id] = future
-            logger.info(f"[定时任务] 已调度任务 {task_id}, 将在 {delay} 秒后执行")
+            entry = self._tasks.pop(task_id, None)
+            if entry is not None:
+                entry.func = None
+                self._cancelled += 1
+                self._stats['cancelled'] += 1
+                logger.info(f"[定时任务] 任务 {task_id} 已取消")
+            running = self._running.get(task_id)
+        if running is not None:
+            runtime.loop.call_soon_threadsafe(running.cancel)
+
+    def cleanup(self):
+        """清理所有任务"""
+        with self._lock:
+            for entry in self._heap:
+                entry.func = None
+            self._stats['cancelled'] += len(self._tasks)
+            self._heap.clear()
+            self._tasks.clear()
+            self._cancelled = 0
+            running = list(self._running.values())
+        for task in running:
+            runtime.loop.call_soon_threadsafe(task.cancel)
+        logger.info("[定时任务] 所有任务已清理")
+
+    def _compact(self):
+        """已取消的条目超过一半时重建堆（调用方需持有锁）"""
+        if self._cancelled > 1024 and self._cancelled * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if entry.func is not None]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            due = []
+            with self._lock:
+                while self._heap:
+                    entry = self._heap[0]
+                    if entry.func is None:
+                        heapq.heappop(self._heap)
+                        self._cancelled -= 1
+                        continue
+                    if entry.due > now:
+                        break
+                    heapq.heappop(self._heap)
+                    self._tasks.pop(entry.task_id, None)
+                    due.append(entry)
+                timeout = self._heap[0].due - now if self._heap else None
+
+            for entry in due:
+                self._dispatch(entry, now)
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self, entry, now):
+        lateness = now - entry.due
+        task = asyncio.get_running_loop().create_task(self._execute(entry))
+        with self._lock:
+            self._running[entry.task_id] = task
+            self._stats['total_lateness'] += lateness
+            self._stats['last_lateness'] = lateness
+            if lateness > self._stats['max_lateness']:
+                self._stats['max_lateness'] = lateness
+        if lateness > 1:
+            logger.warning(f"[定时任务] 任务 {entry.task_id} 延迟 {lateness:.2f} 秒执行")
+
+    async def _execute(self, entry):
+        task_id = entry.task_id
+        try:
+            async with bot_manager.get_bot() as bot:
+                await entry.func(bot)
+            logger.info(f"[定时任务] 任务 {task_id} 执行成功")
+            with self._lock:
+                self._stats['executed'] += 1
+        except asyncio.CancelledError:
+            logger.info(f"[定时任务] 任务 {task_id} 被取消")
+        except Exception as e:
+            logger.error(f"[定时任务] 任务 {task_id} 执行失败: {str(e)}", exc_info=True)
+            with self._lock:
+                self._stats['failed'] += 1
+        finally:
+            with self._lock:
+                if self._running.get(task_id) is asyncio.current_task():
+                    del self._running[task_id]
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._tasks)
+            stats['heap_size'] = len(self._heap)
+            stats['running'] = len(self._running)
+        dispatched = stats['executed'] + stats['failed']
+        total_lateness = stats.pop('total_lateness')
+        stats['avg_lateness_ms'] = round(total_lateness / dispatched * 1000, 2) if dispatched else None
+        stats['max_lateness_ms'] = round(stats.pop('max_lateness') * 1000, 2)
+        stats['last_lateness_ms'] = round(stats.pop('last_lateness') * 1000, 2)
+        return stats
 
 # 创建全局任务管理器实例
 task_manager = TaskManager()
 
 def async_route(f):
-    """异步路由装饰器"""
+    """异步路由装饰器：将协程提交到常驻运行时执行"""
     @wraps(f)
     def wrapped(*args, **kwargs):
-        loop = None
+        return runtime.run(f(*args, **kwargs))
+    return wrapped
+
+def _on_event_loop():
+    """当前线程是否正在运行事件循环"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+# 数据库访问层
+class Database:
+    """
+    SQLite 连接池
+
+    连接在首次需要时创建，最多 DATABASE['POOL_SIZE'] 个，用完归还复用。
+    每个连接都开启 WAL 日志并设置 busy_timeout、synchronous、cache_size、
+    mmap_size 等参数；长期存活的连接也让 sqlite3 的语句缓存得以复用预编译语句。
+    """
+
+    def __init__(self, path, pool_size):
+        self.path = path
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._stats = {'acquired': 0, 'waits': 0, 'timeouts': 0}
+
+    def _connect(self):
+        """创建并配置一个新连接"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DATABASE['BUSY_TIMEOUT'] / 1000,
+            check_same_thread=False,
+            cached_statements=DATABASE['STATEMENT_CACHE_SIZE']
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f"PRAGMA busy_timeout={int(DATABASE['BUSY_TIMEOUT'])}")
+        conn.execute(f"PRAGMA cache_size=-{int(DATABASE['CACHE_SIZE_KB'])}")
+        conn.execute(f"PRAGMA mmap_size={int(DATABASE['MMAP_SIZE'])}")
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def _acquire(self):
         try:
-            # 尝试获取当前事件循环
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            # 如果没有运行中的循环，创建一个新的
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = None
+
+        if conn is None:
+            with self._lock:
+                can_create = self._created < self.pool_size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                with self._lock:
+                    self._stats['waits'] += 1
+                if _on_event_loop():
+                    logger.warning("[数据库] 在事件循环线程上等待连接，协程中应使用 db.run()")
+                try:
+                    conn = self._pool.get(timeout=DATABASE['POOL_TIMEOUT'])
+                except queue.Empty:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    raise sqlite3.OperationalError("database connection pool exhausted")
+
+        with self._lock:
+            self._stats['acquired'] += 1
+        return conn
+
+    def _release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put_nowait(conn)
+        except Exception as e:
+            # 连接已损坏，丢弃并允许重新创建
+            logger.error(f"[数据库] 丢弃损坏的连接: {str(e)}")
+            with self._lock:
+                self._created -= 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @contextmanager
+    def connection(self):
+        """
+        从连接池借出一个连接
+
+        正常退出时提交未提交的事务，出现异常时回滚。
+        连接池耗尽时会阻塞等待，协程中请改用 run()，不要在事件循环上直接调用。
+        """
+        conn = self._acquire()
         try:
-            return loop.run_until_complete(f(*args, **kwargs))
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
         finally:
-            # 如果我们创建了新的循环，确保清理它
-            if loop and not loop.is_running():
-                loop.close()
-    return wrapped
+            self._release(conn)
+
+    def _call(self, func, args):
+        with self.connection() as conn:
+            return func(conn, *args)
+
+    async def run(self, func, *args):
+        """
+        在工作线程中借出连接并执行 func(conn, *args)，返回其结果
+
+        所有请求和后台任务共享同一个事件循环，借连接时的等待和 SQLite 查询
+        都放到线程里执行，避免一次慢查询卡住整个循环。
+        """
+        return await asyncio.to_thread(self._call, func, args)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['created'] = self._created
+        stats['pool_size'] = self.pool_size
+        stats['idle'] = self._pool.qsize()
+        return stats
+
+# 创建全局数据库连接池
+db = Database(DB_PATH, DATABASE['POOL_SIZE'])
+
+class TTLCache:
+    """
+    带过期时间的简单内存缓存（线程安全）
 
-def init_db():
-    """初始化数据库"""
-    conn = None
+    用来缓存那些允许稍微过时、但每次都重新计算代价很高的值。
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._stats['hits'] += 1
+                return entry[0]
+            if entry is not None:
+                del self._data[key]
+            self._stats['misses'] += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def update(self, key, func):
+        """对未过期的缓存值应用 func 并保留原过期时间，缓存不存在时不做任何事"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                return
+            self._data[key] = (func(entry[0]), entry[1])
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._data)
+        return stats
+
+# 消息总数缓存，按过滤条件分别缓存
+message_count_cache = TTLCache(DATABASE['COUNT_CACHE_TTL'])
+
+# 群组默认权限缓存：chat_id -> ChatPermissions
+chat_permissions_cache = TTLCache(CACHE['PERMISSIONS_TTL'])
+
+# 禁言和解除禁言涉及的权限项
+PERMISSION_FLAGS = (
+    'can_send_messages', 'can_send_polls', 'can_send_other_messages',
+    'can_add_web_page_previews', 'can_change_info', 'can_invite_users', 'can_pin_messages'
+)
+
+def permissions_match(current, target):
+    """比较禁言相关的权限项是否一致"""
+    return all(getattr(current, flag) == getattr(target, flag) for flag in PERMISSION_FLAGS)
+
+def remember_chat(chat):
+    """用 get_chat 的结果同时刷新标题和权限缓存"""
+    if chat.title:
+        chat_title_cache.set(chat.id, chat.title)
+    if chat.permissions is not None:
+        chat_permissions_cache.set(chat.id, chat.permissions)
+
+async def get_chat_permissions(bot, chat_id):
+    """读取群组当前的默认权限，缓存过期后才调用 get_chat"""
+    permissions = chat_permissions_cache.get(chat_id)
+    if permissions is None:
+        chat = await bot.get_chat(chat_id)
+        remember_chat(chat)
+        permissions = chat.permissions
+    return permissions
+
+async def set_chat_permissions_cached(bot, chat_id, permissions):
+    """
+    设置群组默认权限，缓存显示已经是目标权限时跳过调用
+
+    返回权限是否确实发生了变化：跳过调用或 Telegram 回复 Chat_not_modified 时返回 False，
+    调用方据此决定是否发送通知。
+    """
+    cached = chat_permissions_cache.get(chat_id)
+    if cached is not None and permissions_match(cached, permissions):
+        logger.info(f"[权限缓存] 群组 {chat_id} 权限未变化，跳过设置")
+        return False
+    changed = True
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+        await bot.set_chat_permissions(chat_id=chat_id, permissions=permissions)
+    except telegram.error.BadRequest as e:
+        if 'Chat_not_modified' not in str(e):
+            chat_permissions_cache.invalidate(chat_id)
+            if is_permission_error(e):
+                chat_admins_cache.invalidate(chat_id)
+            raise
+        changed = False
+    except Forbidden:
+        chat_permissions_cache.invalidate(chat_id)
+        chat_admins_cache.invalidate(chat_id)
+        raise
+    chat_permissions_cache.set(chat_id, permissions)
+    return changed
+
+# 群组元数据缓存：标题、管理员列表和成员数
+chat_title_cache = TTLCache(CACHE['CHAT_TITLE_TTL'])
+chat_admins_cache = TTLCache(CACHE['ADMINS_TTL'])
+chat_member_count_cache = TTLCache(CACHE['MEMBER_COUNT_TTL'])
+
+async def get_chat_title(bot, chat_id):
+    """获取群组标题，缓存过期后才调用 get_chat"""
+    title = chat_title_cache.get(chat_id)
+    if title is None:
+        chat = await bot.get_chat(chat_id)
+        remember_chat(chat)
+        title = chat.title
+    return title
+
+async def get_chat_admins(bot, chat_id):
+    """获取群组管理员列表（元组），缓存过期后才调用 get_chat_administrators"""
+    admins = chat_admins_cache.get(chat_id)
+    if admins is None:
+        admins = tuple(await bot.get_chat_administrators(chat_id))
+        chat_admins_cache.set(chat_id, admins)
+    return admins
+
+async def get_member_count(bot, chat_id):
+    """获取群组成员数，缓存过期后才调用 get_chat_member_count"""
+    count = chat_member_count_cache.get(chat_id)
+    if count is None:
+        count = await bot.get_chat_member_count(chat_id)
+        chat_member_count_cache.set(chat_id, count)
+    return count
+
+async def get_bot_status(bot, chat_id):
+    """
+    机器人在群组中的身份
+
+    先查缓存的管理员列表；不在其中时调用 get_chat_member 确认实际身份（普通成员、受限、已被移出），
+    不把“不是管理员”一律当作普通成员。机器人身份变化（my_chat_member 更新）或操作因权限不足失败时
+    会清除管理员缓存，避免降级后仍按管理员处理。
+    bot.id 在连接池预热（initialize 内部的 get_me）时就已确定，不再每次调用 get_me。
+    """
+    for admin in await get_chat_admins(bot, chat_id):
+        if admin.user.id == bot.id:
+            return admin.status
+    member = await bot.get_chat_member(chat_id, bot.id)
+    return member.status
+
+def is_permission_error(error):
+    """Forbidden，或提示机器人权限不足的 BadRequest"""
+    if isinstance(error, Forbidden):
+        return True
+    text = str(error).lower()
+    return isinstance(error, BadRequest) and any(word in text for word in ('rights', 'admin', 'permission'))
+
+async def restrict_member(bot, chat_id, user_id, permissions, **kwargs):
+    """限制群成员权限；因权限不足失败时清除管理员缓存，下次重新确认机器人的身份"""
+    try:
+        return await bot.restrict_chat_member(chat_id=chat_id, user_id=user_id, permissions=permissions, **kwargs)
+    except (Forbidden, BadRequest) as e:
+        if is_permission_error(e):
+            chat_admins_cache.invalidate(chat_id)
+        raise
+
+def observe_chat_message(message):
+    """根据群消息及成员进出等服务消息更新元数据缓存"""
+    chat_id = message.chat.id
+    if message.chat.title:
+        chat_title_cache.set(chat_id, message.chat.title)
+    if message.new_chat_members:
+        joined = len(message.new_chat_members)
+        chat_member_count_cache.update(chat_id, lambda count: count + joined)
+    if message.left_chat_member:
+        chat_member_count_cache.update(chat_id, lambda count: max(count - 1, 0))
+        admins = chat_admins_cache.get(chat_id)
+        if admins is not None and any(a.user.id == message.left_chat_member.id for a in admins):
+            chat_admins_cache.invalidate(chat_id)
+
+def get_metadata_cache_stats():
+    """汇总群组元数据缓存的命中情况"""
+    return {
+        'permissions': chat_permissions_cache.get_stats(),
+        'titles': chat_title_cache.get_stats(),
+        'admins': chat_admins_cache.get_stats(),
+        'member_counts': chat_member_count_cache.get_stats()
+    }
+
+def init_db(check_plans=True):
+    """初始化数据库，check_plans 为真时顺带检查面板查询计划"""
+    try:
+        with db.connection() as conn:
+            c = conn.cursor()
         
-        # 首先检查消息表
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'")
-        messages_exists = c.fetchone() is not None
+            # 首先检查消息表
+            c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'")
+            messages_exists = c.fetchone() is not None
         
-        # 检查自动禁言设置表
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='auto_mute_settings'")
-        auto_mute_exists = c.fetchone() is not None
+            # 检查自动禁言设置表
+            c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='auto_mute_settings'")
+            auto_mute_exists = c.fetchone() is not None
         
-        # 检查入群验证设置表
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='join_settings'")
-        join_settings_exists = c.fetchone() is not None
+            # 检查入群验证设置表
+            c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='join_settings'")
+            join_settings_exists = c.fetchone() is not None
         
-        # 检查待验证用户表
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pending_members'")
-        pending_members_exists = c.fetchone() is not None
+            # 检查待验证用户表
+            c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pending_members'")
+            pending_members_exists = c.fetchone() is not None
 
-        # 检查垃圾信息过滤设置表
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='spam_filter_settings'")
-        spam_filter_exists = c.fetchone() is not None
+            # 检查垃圾信息过滤设置表
+            c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='spam_filter_settings'")
+            spam_filter_exists = c.fetchone() is not None
         
-        # 添加这段新代码：检查白名单表
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='spam_filter_whitelist'")
-        whitelist_exists = c.fetchone() is not None
+            # 添加这段新代码：检查白名单表
+            c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='spam_filter_whitelist'")
+            whitelist_exists = c.fetchone() is not None
 
-        if not spam_filter_exists:
-            c.execute('''
-                CREATE TABLE spam_filter_settings (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER NOT NULL UNIQUE,
-                    enabled BOOLEAN DEFAULT 0,
-                    rules TEXT NOT NULL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            logger.info("Created spam_filter_settings table")
+            if not spam_filter_exists:
+                c.execute('''
+                    CREATE TABLE spam_filter_settings (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id INTEGER NOT NULL UNIQUE,
+                        enabled BOOLEAN DEFAULT 0,
+                        rules TEXT NOT NULL,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                logger.info("Created spam_filter_settings table")
 
-        # 创建必要的表
-        if not messages_exists:
-            c.execute('''
-                CREATE TABLE messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp DATETIME NOT NULL,
-                    chat_id INTEGER NOT NULL,
-                    chat_title TEXT NOT NULL,
-                    user_name TEXT NOT NULL,
-                    from_user_id INTEGER,
-                    message_type TEXT NOT NULL,
-                    message_content TEXT NOT NULL,
-                    file_path TEXT,
-                    chat_type TEXT NOT NULL,
-                    is_topic_message BOOLEAN DEFAULT 0,
-                    topic_id INTEGER,
-                    forward_from TEXT,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            logger.info("Created new messages table")
+            # 创建必要的表
+            if not messages_exists:
+                c.execute('''
+                    CREATE TABLE messages (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        timestamp DATETIME NOT NULL,
+                        chat_id INTEGER NOT NULL,
+                        chat_title TEXT NOT NULL,
+                        user_name TEXT NOT NULL,
+                        from_user_id INTEGER,
+                        message_type TEXT NOT NULL,
+                        message_content TEXT NOT NULL,
+                        file_path TEXT,
+                        chat_type TEXT NOT NULL,
+                        is_topic_message BOOLEAN DEFAULT 0,
+                        topic_id INTEGER,
+                        forward_from TEXT,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                logger.info("Created new messages table")
 
-        if not auto_mute_exists:
-            c.execute('''
-                CREATE TABLE auto_mute_settings (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER NOT NULL UNIQUE,
-                    enabled BOOLEAN DEFAULT 0,
-                    start_time TEXT NOT NULL,
-                    end_time TEXT NOT NULL,
-                    days_of_week TEXT NOT NULL,
-                    mute_level TEXT NOT NULL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            logger.info("Created new auto_mute_settings table")
+            if not auto_mute_exists:
+                c.execute('''
+                    CREATE TABLE auto_mute_settings (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id INTEGER NOT NULL UNIQUE,
+                        enabled BOOLEAN DEFAULT 0,
+                        start_time TEXT NOT NULL,
+                        end_time TEXT NOT NULL,
+                        days_of_week TEXT NOT NULL,
+                        mute_level TEXT NOT NULL,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                logger.info("Created new auto_mute_settings table")
 
-        if not join_settings_exists:
-            c.execute('''
-                CREATE TABLE join_settings (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER NOT NULL UNIQUE,
-                    enabled BOOLEAN DEFAULT 0,
-                    verify_type TEXT DEFAULT 'question',
-                    question TEXT,
-                    answer TEXT,
-                    welcome_message TEXT,
-                    timeout INTEGER DEFAULT 300,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            logger.info("Created join_settings table")
+            if not join_settings_exists:
+                c.execute('''
+                    CREATE TABLE join_settings (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id INTEGER NOT NULL UNIQUE,
+                        enabled BOOLEAN DEFAULT 0,
+                        verify_type TEXT DEFAULT 'question',
+                        question TEXT,
+                        answer TEXT,
+                        welcome_message TEXT,
+                        timeout INTEGER DEFAULT 300,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                logger.info("Created join_settings table")
         
-        if not pending_members_exists:
-            c.execute('''
-                CREATE TABLE pending_members (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    username TEXT,
-                    full_name TEXT,
-                    join_time DATETIME NOT NULL,
-                    verify_deadline DATETIME NOT NULL,
-                    status TEXT DEFAULT 'pending',
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(chat_id, user_id)
-                )
-            ''')
-            logger.info("Created pending_members table")
+            if not pending_members_exists:
+                c.execute('''
+                    CREATE TABLE pending_members (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id INTEGER NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        username TEXT,
+                        full_name TEXT,
+                        join_time DATETIME NOT NULL,
+                        verify_deadline DATETIME NOT NULL,
+                        status TEXT DEFAULT 'pending',
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        UNIQUE(chat_id, user_id)
+                    )
+                ''')
+                logger.info("Created pending_members table")
         
-        if not whitelist_exists:
-            c.execute('''
-                CREATE TABLE spam_filter_whitelist (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    username TEXT,
-                    full_name TEXT,
-                    added_by INTEGER NOT NULL,
-                    added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    note TEXT,
-                    UNIQUE(chat_id, user_id)
-                )
-            ''')
-            logger.info("Created spam_filter_whitelist table")
+            if not whitelist_exists:
+                c.execute('''
+                    CREATE TABLE spam_filter_whitelist (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id INTEGER NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        username TEXT,
+                        full_name TEXT,
+                        added_by INTEGER NOT NULL,
+                        added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        note TEXT,
+                        UNIQUE(chat_id, user_id)
+                    )
+                ''')
+                logger.info("Created spam_filter_whitelist table")
 
-        conn.commit()
+            conn.commit()
+
+            # 执行尚未应用的结构迁移
+            apply_schema_migrations(conn)
         logger.info("Database initialized successfully")
+
+        if check_plans:
+            check_query_plans()
         
     except Exception as e:
         logger.error(f"Error initializing database: {str(e)}")
         logger.error("Error details:", exc_info=True)
-        if conn:
+
+# 数据库结构迁移：按版本号顺序执行，已应用的版本记录在 PRAGMA user_version 中
+SCHEMA_MIGRATIONS = [
+    (1, '为消息面板的查询创建索引', [
+        # /messages：按时间倒序分页，可选按聊天类型、消息类型、群组过滤
+        'CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_id_timestamp ON messages (chat_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_type_timestamp ON messages (chat_type, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_message_type_timestamp ON messages (message_type, timestamp)',
+        # /api/groups：覆盖索引，DISTINCT 不需要回表
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_type_chat ON messages (chat_type, chat_id, chat_title)',
+        # /api/group_members：按群组统计成员最后活跃时间
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_user ON messages (chat_id, from_user_id, user_name, timestamp)',
+        'ANALYZE messages'
+    ]),
+    (2, '创建持久化定时任务表', [
+        '''
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            task_id TEXT PRIMARY KEY,
+            job_type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            due_at REAL NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due_at ON scheduled_jobs (due_at)'
+    ]),
+    (3, '记录 Telegram 消息 ID，后台下载完成后据此回填附件路径', [
+        'ALTER TABLE messages ADD COLUMN message_id INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_message ON messages (chat_id, message_id)'
+    ]),
+    (4, '创建按 file_unique_id 去重的媒体文件表', [
+        '''
+        CREATE TABLE IF NOT EXISTS media_files (
+            file_unique_id TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            sha256 TEXT,
+            size INTEGER NOT NULL DEFAULT 0,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_used_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'ALTER TABLE messages ADD COLUMN file_unique_id TEXT'
+    ]),
+    (5, '为附件清理创建部分索引（只包含仍指向本地文件的消息）', [
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_media_retention
+        ON messages (message_type, timestamp) WHERE file_path LIKE '/serve_file/%'
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_media_retention_chat
+        ON messages (chat_id, message_type, timestamp) WHERE file_path LIKE '/serve_file/%'
+        """
+    ]),
+    (6, '为附件消息记录缩略图', [
+        'ALTER TABLE messages ADD COLUMN thumb_path TEXT',
+        'ALTER TABLE messages ADD COLUMN thumb_unique_id TEXT'
+    ]),
+    (7, '创建消息全文索引（FTS5 trigram，支持中文子串搜索）', [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            message_content, content='messages', content_rowid='id', tokenize='trigram'
+        )
+        """,
+        # 触发器只在 message_content 变化时更新索引，回填 file_path 等字段不会触发
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message_content) VALUES (new.id, new.message_content);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_content)
+            VALUES ('delete', old.id, old.message_content);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message_content ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_content)
+            VALUES ('delete', old.id, old.message_content);
+            INSERT INTO messages_fts (rowid, message_content) VALUES (new.id, new.message_content);
+        END
+        """,
+        # 为已有消息建立索引
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"
+    ]),
+    (8, '记录每个群组最近一次自动禁言切换的结果', [
+        '''
+        CREATE TABLE IF NOT EXISTS auto_mute_state (
+            chat_id INTEGER PRIMARY KEY,
+            state TEXT,
+            mute_level TEXT,
+            due_at REAL,
+            applied_at REAL,
+            duration_ms REAL,
+            error TEXT
+        )
+        '''
+    ])
+]
+
+def apply_schema_migrations(conn):
+    """执行所有版本号大于当前 user_version 的迁移，每个版本一个事务"""
+    current = conn.execute('PRAGMA user_version').fetchone()[0]
+    for version, description, statements in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info(f"[数据库迁移] 开始执行版本 {version}: {description}")
+        started = time.perf_counter()
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"[数据库迁移] 版本 {version} 执行失败", exc_info=True)
+            raise
+        current = version
+        logger.info(f"[数据库迁移] 版本 {version} 完成，耗时 {time.perf_counter() - started:.1f} 秒")
+
+MESSAGE_COLUMNS = """
+    id, timestamp, chat_id, chat_title, user_name, message_type,
+    message_content, file_path, COALESCE(from_user_id, '') as from_user_id, chat_type,
+    message_id, thumb_path
+"""
+
+# 面板查询语句：路由和启动时的查询计划检查共用同一份，{where} 处拼接 message_filters() 的结果
+MESSAGES_PAGE_SQL = (
+    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE 1=1{{where}} "
+    "ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?"
+)
+MESSAGES_BEFORE_SQL = (
+    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE 1=1{{where}} "
+    "AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?"
+)
+MESSAGES_AFTER_SQL = (
+    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE 1=1{{where}} "
+    "AND (timestamp, id) > (?, ?) ORDER BY timestamp ASC, id ASC LIMIT ?"
+)
+MESSAGES_OLDER_EXISTS_SQL = "SELECT 1 FROM messages WHERE 1=1{where} AND (timestamp, id) <= (?, ?) LIMIT 1"
+# 增量拉取只读 (since_id, last_id] 这一段新消息；NOT INDEXED 让它始终按主键范围读取，
+# 否则带过滤条件时优化器会改走过滤列的索引，再为 ORDER BY id 建临时 B 树
+MESSAGES_SINCE_SQL = (
+    f"SELECT {MESSAGE_COLUMNS} FROM messages NOT INDEXED WHERE id > ? AND id <= ?{{where}} "
+    "ORDER BY id DESC LIMIT ?"
+)
+GROUPS_SQL = """
+    SELECT DISTINCT chat_id, chat_title
+    FROM messages
+    WHERE chat_type IN ('group', 'supergroup')
+    ORDER BY chat_title
+"""
+GROUP_MEMBERS_SQL = """
+    SELECT from_user_id, user_name, MAX(timestamp) as last_active
+    FROM messages
+    WHERE chat_id = ?
+    AND from_user_id IS NOT NULL
+    AND from_user_id != 0
+    GROUP BY from_user_id, user_name
+    ORDER BY last_active DESC
+    LIMIT 100
+"""
+
+def message_filters(chat_type='all', message_type='all', group_id='all'):
+    """生成 /messages 的过滤条件，返回 (以 AND 开头的 SQL 片段, 参数列表)"""
+    where_sql = ""
+    params = []
+    if chat_type != 'all':
+        where_sql += " AND chat_type = ?"
+        params.append(chat_type)
+    if message_type != 'all':
+        where_sql += " AND message_type = ?"
+        params.append(message_type)
+    if group_id != 'all':
+        where_sql += " AND chat_id = ?"
+        params.append(group_id)
+    return where_sql, params
+
+def retention_query(message_type, chat_id, cutoff, excluded, limit):
+    """生成附件清理取一批过期消息的查询，返回 (SQL, 参数列表)"""
+    sql = "SELECT id, file_unique_id, thumb_unique_id, file_path, thumb_path FROM messages WHERE "
+    params = []
+    if chat_id is not None:
+        sql += "chat_id = ? AND "
+        params.append(chat_id)
+    sql += "message_type = ? AND timestamp < ? AND file_path LIKE '/serve_file/%'"
+    params.extend([message_type, cutoff])
+    if excluded:
+        sql += f" AND chat_id NOT IN ({','.join('?' * len(excluded))})"
+        params.extend(excluded)
+    sql += " ORDER BY timestamp LIMIT ?"
+    params.append(limit)
+    return sql, params
+
+def dashboard_query_plans():
+    """
+    生成需要检查查询计划的语句列表：(名称, SQL, 参数, 是否热点查询)
+
+    /messages 的每种分页方式都与各种过滤组合搭配一次；
+    热点查询除了不能全表扫描，也不能为排序建临时 B 树。
+    """
+    filter_sets = [
+        ('all', message_filters()),
+        ('chat_type', message_filters(chat_type='supergroup')),
+        ('message_type', message_filters(message_type='photo')),
+        ('group', message_filters(group_id=0)),
+        ('combined', message_filters('supergroup', 'text', 0))
+    ]
+    plans = []
+    for label, (where_sql, params) in filter_sets:
+        plans.extend([
+            (f'messages_page[{label}]', MESSAGES_PAGE_SQL.format(where=where_sql),
+             [*params, 51, 0], True),
+            (f'messages_before[{label}]', MESSAGES_BEFORE_SQL.format(where=where_sql),
+             [*params, '', 0, 51], True),
+            (f'messages_after[{label}]', MESSAGES_AFTER_SQL.format(where=where_sql),
+             [*params, '', 0, 51], True),
+            (f'messages_older_exists[{label}]', MESSAGES_OLDER_EXISTS_SQL.format(where=where_sql),
+             [*params, '', 0], True),
+            (f'messages_since[{label}]', MESSAGES_SINCE_SQL.format(where=where_sql),
+             [0, 0, *params, 51], True)
+        ])
+    plans.extend([
+        ('groups', GROUPS_SQL, (), False),
+        ('group_members', GROUP_MEMBERS_SQL, (0,), False),
+        ('media_retention', *retention_query('sticker', None, '', [0], 200), True),
+        ('media_retention_chat', *retention_query('sticker', 0, '', [], 200), True)
+    ])
+    return plans
+
+def explain_query_plan(conn, sql, params=()):
+    """返回查询计划中每一步的描述"""
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+
+def query_plan_problems(plan, hot):
+    """找出查询计划中的全表扫描，热点查询还包括排序用的临时 B 树"""
+    problems = [step for step in plan if step.startswith('SCAN messages') and 'INDEX' not in step]
+    if hot:
+        problems.extend(step for step in plan if step.startswith('USE TEMP B-TREE'))
+    return problems
+
+def check_query_plans():
+    """检查面板查询是否都使用了索引，返回有问题的查询名称列表"""
+    failed = []
+    with db.connection() as conn:
+        for name, sql, params, hot in dashboard_query_plans():
+            plan = explain_query_plan(conn, sql, params)
+            problems = query_plan_problems(plan, hot)
+            if problems:
+                failed.append(name)
+                logger.error(f"[查询计划] {name} 未按预期使用索引: {problems}，完整计划: {plan}")
+    if not failed:
+        logger.info("[查询计划] 所有面板查询均已使用索引")
+    return failed
+
+class EventBroker:
+    """
+    面板实时事件分发（Server-Sent Events）
+
+    每个连接的面板有自己的有界队列，发布事件时只做 put_nowait，不会阻塞发布方。
+    某个面板处理不过来、队列满了时，清空它的队列并只留下一条 resync 事件，
+    由面板重新拉取一次数据，而不是无限堆积。
+    """
+
+    def __init__(self, buffer_size, max_clients):
+        self.buffer_size = buffer_size
+        self.max_clients = max_clients
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._stats = {'published': 0, 'resyncs': 0, 'rejected': 0}
+
+    @property
+    def has_subscribers(self):
+        return bool(self._clients)
+
+    def subscribe(self):
+        """注册一个面板连接，连接数已满时返回 None"""
+        with self._lock:
+            if len(self._clients) >= self.max_clients:
+                self._stats['rejected'] += 1
+                return None
+            client = queue.Queue(maxsize=self.buffer_size)
+            self._clients.add(client)
+        logger.info(f"[实时推送] 面板已连接，当前连接数 {len(self._clients)}")
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+        logger.info(f"[实时推送] 面板已断开，当前连接数 {len(self._clients)}")
+
+    def publish(self, event, data):
+        """向所有面板发布事件，可以在任意线程调用"""
+        if not self._clients:
+            return
+        payload = json.dumps(data, ensure_ascii=False, default=str)
+        with self._lock:
+            self._seq += 1
+            self._stats['published'] += 1
+            for client in self._clients:
+                try:
+                    client.put_nowait((self._seq, event, payload))
+                except queue.Full:
+                    self._resync(client)
+
+    def _resync(self, client):
+        while True:
             try:
-                conn.rollback()
-            except:
-                pass
-    finally:
-        if conn:
+                client.get_nowait()
+            except queue.Empty:
+                break
+        client.put_nowait((self._seq, 'resync', '{}'))
+        self._stats['resyncs'] += 1
+
+    def stream(self, client):
+        """按 SSE 格式输出某个面板的事件，空闲时发送心跳"""
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    seq, event, payload = client.get(timeout=EVENTS['KEEPALIVE_INTERVAL'])
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"id: {seq}\nevent: {event}\ndata: {payload}\n\n"
+        finally:
+            self.unsubscribe(client)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['clients'] = len(self._clients)
+            stats['backlog'] = sum(client.qsize() for client in self._clients)
+        return stats
+
+# 创建全局事件分发器
+event_broker = EventBroker(EVENTS['CLIENT_BUFFER'], EVENTS['MAX_CLIENTS'])
+
+def message_row_to_dict(row):
+    """把 MESSAGE_COLUMNS 查询出的一行转换成接口返回的格式"""
+    return {
+        'id': row[0],
+        'timestamp': row[1],
+        'chat_id': row[2],
+        'chat_title': row[3],
+        'user_name': row[4],
+        'message_type': row[5],
+        'message_content': row[6],
+        'file_path': row[7],
+        'from_user_id': row[8] if row[8] != '' else None,
+        'chat_type': row[9],
+        'message_id': row[10],
+        'thumb_path': row[11]
+    }
+
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (
+        timestamp, chat_id, chat_title, user_name, from_user_id,
+        message_type, message_content, file_path, chat_type,
+        is_topic_message, topic_id, forward_from, message_id, file_unique_id,
+        thumb_unique_id
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+UPDATE_MESSAGE_FILE_SQL = """
+    UPDATE messages SET file_path = ? WHERE chat_id = ? AND message_id = ?
+"""
+
+UPDATE_MESSAGE_THUMB_SQL = """
+    UPDATE messages SET thumb_path = ? WHERE chat_id = ? AND message_id = ?
+"""
+
+# 新下载的文件登记为一次引用；文件丢失后重新下载时覆盖路径并增加引用
+UPSERT_MEDIA_FILE_SQL = """
+    INSERT INTO media_files (file_unique_id, path, sha256, size, ref_count)
+    VALUES (?, ?, ?, ?, 1)
+    ON CONFLICT(file_unique_id) DO UPDATE SET
+        path = excluded.path,
+        sha256 = excluded.sha256,
+        size = excluded.size,
+        ref_count = ref_count + 1,
+        last_used_at = CURRENT_TIMESTAMP
+"""
+
+ACQUIRE_MEDIA_FILE_SQL = """
+    UPDATE media_files SET ref_count = ref_count + 1, last_used_at = CURRENT_TIMESTAMP
+    WHERE file_unique_id = ?
+"""
+
+class MessageIngestWriter:
+    """
+    批量消息写入器
+
+    webhook 只负责把待写入的语句放进队列，后台线程按数量或时间攒批，
+    在一个事务中用 executemany 写入，从而把每条消息一次 fsync 变成每批一次。
+    所有语句都经过同一个先进先出队列，写入顺序与提交顺序一致（任务的写入与删除不会颠倒）。
+    队列超过容量时，普通线程最多等待 INGEST_PUT_TIMEOUT 秒后照常入队；
+    事件循环上的调用方不等待，直接入队，容量只是软上限，宁可多占内存也不乱序或丢数据。
+    每批提交后记录 messages 表当前最大的 id，消息面板据此判断有没有新消息。
+    """
+
+    _STOP = object()
+
+    def __init__(self):
+        self._queue = collections.deque()
+        self._capacity = DATABASE['INGEST_QUEUE_SIZE']
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._last_message_id = None
+        self._published_id = None
+        self._stats = {
+            'enqueued': 0,
+            'written': 0,
+            'failed': 0,
+            'batches': 0,
+            'queue_full': 0,
+            'overflowed': 0,
+            'max_depth': 0,
+            'last_batch_size': 0,
+            'last_flush_ms': 0.0
+        }
+
+    def start(self):
+        """启动后台写入线程（重复调用无副作用）"""
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("消息写入器已停止")
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='message-ingest', daemon=True)
+            self._thread.start()
+            logger.info("[消息写入] 批量写入线程已启动")
+
+    def submit(self, sql, params):
+        """提交一条待写入的语句，写入器停止后拒绝提交"""
+        self.start()
+        overflowed = False
+        with self._cond:
+            if len(self._queue) >= self._capacity:
+                with self._lock:
+                    self._stats['queue_full'] += 1
+                # 背压：普通线程等一会儿，事件循环上不等待；无论如何都排进同一个队列，保证顺序
+                if not _on_event_loop():
+                    self._cond.wait_for(lambda: len(self._queue) < self._capacity,
+                                        timeout=DATABASE['INGEST_PUT_TIMEOUT'])
+                overflowed = len(self._queue) >= self._capacity
+            self._queue.append((sql, params))
+            depth = len(self._queue)
+            self._cond.notify_all()
+
+        with self._lock:
+            self._stats['enqueued'] += 1
+            if overflowed:
+                self._stats['overflowed'] += 1
+            if depth > self._stats['max_depth']:
+                self._stats['max_depth'] = depth
+        if overflowed and depth == self._capacity + 1:
+            # 只在刚越过容量时提示一次，避免积压期间每条都刷日志
+            logger.warning(f"[消息写入] 写入队列超过容量 {self._capacity}，继续按顺序排队")
+
+    def _take(self, timeout=None):
+        """取出队首的一条语句；超时返回 None"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._queue, timeout=timeout):
+                return None
+            item = self._queue.popleft()
+            # 唤醒因队列满而等待的提交方
+            self._cond.notify_all()
+            return item
+
+    def _run(self):
+        # 先记下当前最新的 id，之后每批写入的新消息据此推送给面板
+        self._prime_last_id()
+        batch_size = DATABASE['INGEST_BATCH_SIZE']
+        interval = DATABASE['INGEST_FLUSH_INTERVAL']
+        stopping = False
+        while not stopping:
+            item = self._take()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + interval
+            while len(batch) < batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                item = self._take(remaining)
+                if item is None:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write_batch(batch)
+
+        # 退出前把剩余的数据全部写完
+        with self._cond:
+            remaining = [item for item in self._queue if item is not self._STOP]
+            self._queue.clear()
+        for start in range(0, len(remaining), batch_size):
+            self._write_batch(remaining[start:start + batch_size])
+
+    def _write_batch(self, batch):
+        """在一个事务中写入一批语句，相同语句合并为 executemany"""
+        started = time.perf_counter()
+        try:
+            with db.connection() as conn:
+                group_sql, group_params = None, []
+                for sql, params in batch:
+                    if sql != group_sql and group_params:
+                        conn.executemany(group_sql, group_params)
+                        group_params = []
+                    group_sql = sql
+                    group_params.append(params)
+                if group_params:
+                    conn.executemany(group_sql, group_params)
+                conn.commit()
+                self._update_last_message_id(conn)
+                self._publish_new_messages(conn)
+            written, failed = len(batch), 0
+        except Exception as e:
+            logger.error(f"[消息写入] 批量写入失败，改为逐条写入: {str(e)}")
+            written, failed = self._write_one_by_one(batch)
+
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._stats['written'] += written
+            self._stats['failed'] += failed
+            self._stats['batches'] += 1
+            self._stats['last_batch_size'] = len(batch)
+            self._stats['last_flush_ms'] = round(elapsed, 2)
+        logger.info(f"[消息写入] 已写入 {written} 条，失败 {failed} 条，耗时 {elapsed:.1f} ms")
+
+    def _write_one_by_one(self, batch):
+        written = failed = 0
+        for sql, params in batch:
             try:
-                conn.close()
-            except:
-                pass
+                with db.connection() as conn:
+                    conn.execute(sql, params)
+                    conn.commit()
+                    self._update_last_message_id(conn)
+                    self._publish_new_messages(conn)
+                written += 1
+            except Exception as e:
+                failed += 1
+                logger.error(f"[消息写入] 写入失败: {str(e)}")
+        return written, failed
+
+    def _update_last_message_id(self, conn):
+        last_id = conn.execute('SELECT MAX(id) FROM messages').fetchone()[0] or 0
+        with self._lock:
+            if self._last_message_id is None or last_id > self._last_message_id:
+                self._last_message_id = last_id
+
+    def _publish_new_messages(self, conn):
+        """把上次推送之后新落盘的消息推送给已连接的面板"""
+        with self._lock:
+            published_id = self._published_id
+            last_id = self._last_message_id
+            self._published_id = last_id
+        if published_id is None or last_id is None or last_id <= published_id:
+            return
+        if not event_broker.has_subscribers:
+            return
+        if last_id - published_id > EVENTS['MAX_MESSAGES_PER_EVENT']:
+            event_broker.publish('messages', {'messages': [], 'last_id': last_id, 'reset': True})
+            return
+        rows = conn.execute(
+            f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE id > ? AND id <= ? ORDER BY id DESC",
+            (published_id, last_id)
+        ).fetchall()
+        event_broker.publish('messages', {
+            'messages': [message_row_to_dict(row) for row in rows],
+            'last_id': last_id
+        })
+
+    def _prime_last_id(self):
+        """尚未记录时从数据库读取最新的消息 id，并作为推送的起点"""
+        with self._lock:
+            if self._last_message_id is not None:
+                return
+        with db.connection() as conn:
+            self._update_last_message_id(conn)
+        with self._lock:
+            if self._published_id is None:
+                self._published_id = self._last_message_id
+
+    @property
+    def last_message_id(self):
+        """已经落盘的最新消息 id"""
+        self._prime_last_id()
+        with self._lock:
+            return self._last_message_id
+
+    def stop(self, timeout=30):
+        """停止写入线程，并等待队列中的数据全部落盘；之后的 submit 会被拒绝"""
+        with self._lock:
+            self._stopped = True
+            thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        with self._cond:
+            logger.info(f"[消息写入] 正在写入剩余的 {len(self._queue)} 条数据...")
+            self._queue.append(self._STOP)
+            self._cond.notify_all()
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.error("[消息写入] 等待写入线程退出超时")
+        else:
+            logger.info("[消息写入] 写入线程已退出")
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        with self._cond:
+            stats['queue_depth'] = len(self._queue)
+        stats['queue_capacity'] = self._capacity
+        stats['last_message_id'] = self._last_message_id
+        return stats
+
+# 创建全局消息写入器
+ingest_writer = MessageIngestWriter()
 
 def save_message(message_data):
+    """将消息放入批量写入队列"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        c.execute("""
-            INSERT INTO messages (
-                timestamp, chat_id, chat_title, user_name, from_user_id,
-                message_type, message_content, file_path, chat_type,
-                is_topic_message, topic_id, forward_from
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+        ingest_writer.submit(INSERT_MESSAGE_SQL, (
             message_data['timestamp'],
             message_data['chat_id'],
             message_data['chat_title'],
@@ -399,75 +1861,439 @@ def save_message(message_data):
             message_data['chat_type'],
             message_data.get('is_topic_message', False),
             message_data.get('topic_id'),
-            message_data.get('forward_from')
+            message_data.get('forward_from'),
+            message_data.get('message_id'),
+            message_data.get('file_unique_id'),
+            message_data.get('thumb_unique_id')
         ))
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Message saved successfully: {message_data['message_type']}")
+        logger.info(f"Message queued for saving: {message_data['message_type']}")
     except Exception as e:
         logger.error(f"Error saving message to database: {str(e)}")
 
-async def download_file(file):
-    """下载Telegram文件"""
-    try:
-        # 生成文件名
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        file_ext = '.jpg'  # 默认扩展名
-        
+class MediaDownloader:
+    """
+    后台媒体下载器
+
+    webhook 先保存消息（file_path 为空），再把附件放进有界队列，不等待下载。
+    固定数量的工作协程共用一个 httpx 客户端，按块流式写入临时文件，完成后改名，
+    再通过批量写入队列回填 file_path，并推送 media 事件让面板显示附件。
+
+    照片、视频、文件和贴纸另外下载 Telegram 提供的缩略图（thumb_path），面板默认只加载缩略图。
+
+    文件按 file_unique_id 存放（同一文件在 Telegram 中的 file_unique_id 不变），
+    media_files 表记录路径、sha256、大小和引用次数。重复出现的贴纸、转发图片直接复用
+    已有文件，不再下载；正在下载的同一文件只下载一次。只在常驻事件循环上使用。
+    """
+
+    def __init__(self, workers, queue_size, index_size):
+        self._worker_count = workers
+        self._queue_size = queue_size
+        self._index_size = index_size
+        self._queue = None
+        self._client = None
+        self._workers = []
+        self._index = collections.OrderedDict()  # file_unique_id -> 文件名（最近使用的在末尾）
+        self._inflight = {}  # file_unique_id -> 下载结果 future
+        self._stats = {
+            'queued': 0, 'completed': 0, 'failed': 0, 'dropped': 0,
+            'bytes': 0, 'reused': 0, 'bytes_saved': 0
+        }
+
+    def _ensure_started(self):
+        if self._queue is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self._queue_size)
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(MEDIA['DOWNLOAD_TIMEOUT'], connect=HTTP['CONNECT_TIMEOUT']),
+            limits=httpx.Limits(max_connections=self._worker_count, max_keepalive_connections=self._worker_count)
+        )
+        # 工作协程不继承调用方（webhook 请求）的上下文
+        self._workers = [
+            loop.create_task(self._worker(), context=contextvars.Context())
+            for _ in range(self._worker_count)
+        ]
+        logger.info(f"[媒体下载] 已启动 {self._worker_count} 个下载协程")
+
+    def enqueue(self, file, chat_id, message_id, message_type, thumbnail=False):
+        """把附件（或其缩略图）加入下载队列，队列已满时放弃下载，返回是否成功加入"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((file.file_id, file.file_unique_id, chat_id, message_id, message_type, thumbnail))
+        except asyncio.QueueFull:
+            self._stats['dropped'] += 1
+            logger.error(f"[媒体下载] 下载队列已满，放弃下载 chat {chat_id} 的消息 {message_id} 的附件")
+            return False
+        self._stats['queued'] += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                if await self._download(*job):
+                    self._stats['completed'] += 1
+                else:
+                    self._stats['failed'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._stats['failed'] += 1
+                logger.error(f"Error downloading file: {str(e)}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    async def _download(self, file_id, file_unique_id, chat_id, message_id, message_type, thumbnail):
+        filename = await self._resolve(file_id, file_unique_id)
+        if filename is None:
+            return False
+
+        web_path = f'/serve_file/{filename}'
+        field = 'thumb_path' if thumbnail else 'file_path'
+        sql = UPDATE_MESSAGE_THUMB_SQL if thumbnail else UPDATE_MESSAGE_FILE_SQL
+        ingest_writer.submit(sql, (web_path, chat_id, message_id))
+        event_broker.publish('media', {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'message_type': message_type,
+            field: web_path
+        })
+        return True
+
+    async def _resolve(self, file_id, file_unique_id):
+        """返回该文件在 FILES_DIR 中的文件名，已有文件直接复用并增加引用次数"""
+        entry = await self._acquire(file_unique_id)
+        if entry is None and file_unique_id in self._inflight:
+            # 同一文件正在下载，等待结果即可
+            filename = await asyncio.shield(self._inflight[file_unique_id])
+            entry = await self._acquire(file_unique_id) if filename else None
+        if entry is not None:
+            filename, size = entry
+            self._stats['reused'] += 1
+            self._stats['bytes_saved'] += size
+            logger.info(f"[媒体下载] 复用已有文件 {filename}")
+            return filename
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[file_unique_id] = future
+        filename = None
+        try:
+            result = await self._fetch(file_id, file_unique_id)
+            if result is not None:
+                filename, size = result
+                self._remember(file_unique_id, filename, size)
+            return filename
+        finally:
+            del self._inflight[file_unique_id]
+            future.set_result(filename)
+
+    async def _acquire(self, file_unique_id):
+        """查找已下载的文件并增加一次引用，返回 (文件名, 大小)；文件已被删除时视为不存在"""
+        entry = await db.run(self._acquire_file, file_unique_id, self._index.get(file_unique_id))
+        if entry is None:
+            self._index.pop(file_unique_id, None)
+            return None
+        self._remember(file_unique_id, *entry)
+        return entry
+
+    @staticmethod
+    def _acquire_file(conn, file_unique_id, entry):
+        """
+        在工作线程中用同一个事务增加引用、查询路径（索引未命中时）并确认文件仍在磁盘上
+
+        MediaRetention 在一个事务里减少引用并删除归零的记录：先拿到引用时清理不会删除文件，
+        清理先提交时这里找不到记录，改为重新下载。文件已经丢失时回滚，不占用引用。
+        """
+        if conn.execute(ACQUIRE_MEDIA_FILE_SQL, (file_unique_id,)).rowcount == 0:
+            return None
+        if entry is None:
+            row = conn.execute(
+                'SELECT path, size FROM media_files WHERE file_unique_id = ?',
+                (file_unique_id,)
+            ).fetchone()
+            entry = (row[0], row[1])
+        if not os.path.exists(os.path.join(FILES_DIR, entry[0])):
+            conn.rollback()
+            return None
+        return entry
+
+    def _remember(self, file_unique_id, filename, size):
+        self._index[file_unique_id] = (filename, size)
+        self._index.move_to_end(file_unique_id)
+        while len(self._index) > self._index_size:
+            self._index.popitem(last=False)
+
+    def forget(self, file_unique_id):
+        """文件被清理后从索引中移除"""
+        self._index.pop(file_unique_id, None)
+
+    async def _fetch(self, file_id, file_unique_id):
+        """下载文件并登记到 media_files，返回 (文件名, 大小)，失败时返回 None"""
         # 获取文件信息并确定正确的扩展名
         async with bot_manager.get_bot() as bot:
             try:
-                file_info = await bot.get_file(file.file_id)
+                file_info = await bot.get_file(file_id)
                 if not file_info or not file_info.file_path:
                     logger.error("Failed to get file info or file path is empty")
                     return None
-                
+
                 # 从完整URL中提取实际的文件路径
                 actual_path = file_info.file_path
                 if "https://" in actual_path:
-                    # 提取实际的文件路径部分
                     actual_path = actual_path.split("/file/bot" + TELEGRAM['BOT_TOKEN'] + "/")[-1]
-                
+
                 file_ext = os.path.splitext(actual_path)[1] or '.jpg'
                 logger.info(f"Got file info: {actual_path}")
             except Exception as e:
                 logger.error(f"Error getting file info: {str(e)}")
                 return None
 
-        # 构建文件路径
-        filename = f'{timestamp}_{file.file_unique_id}{file_ext}'
+        # 以 file_unique_id 命名，同一文件只保存一份
+        filename = f'{file_unique_id}{file_ext}'
         file_path = os.path.join(FILES_DIR, filename)
-        web_path = f'/serve_file/{filename}'
-        
-        # 确保目录存在
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        
-        # 构建下载URL，使用处理后的路径
+        temp_path = file_path + '.part'
+
         download_url = f"https://api.telegram.org/file/bot{TELEGRAM['BOT_TOKEN']}/{actual_path}"
-        logger.info(f"Attempting to download from: {download_url}")
-        
-        timeout = httpx.Timeout(30.0)
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.get(download_url)
-            
-            if response.status_code == 200:
-                # 写入文件
-                with open(file_path, 'wb') as f:
-                    f.write(response.content)
-                
-                # 设置文件权限
-                os.chmod(file_path, 0o644)
-                logger.info(f"File downloaded successfully: {file_path}")
-                
-                return web_path
-            else:
-                logger.error(f"Failed to download file. Status: {response.status_code}, Response: {response.text}")
-                return None
-                
-    except Exception as e:
-        logger.error(f"Error downloading file: {str(e)}", exc_info=True)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async with self._client.stream('GET', download_url) as response:
+                if response.status_code != 200:
+                    logger.error(f"Failed to download file {actual_path}. Status: {response.status_code}")
+                    return None
+                # 写盘放到线程池，避免大文件阻塞事件循环
+                f = await asyncio.to_thread(open, temp_path, 'wb')
+                try:
+                    async for chunk in response.aiter_bytes(MEDIA['CHUNK_SIZE']):
+                        await asyncio.to_thread(f.write, chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                finally:
+                    await asyncio.to_thread(f.close)
+            await asyncio.to_thread(
+                self._finalize, temp_path, file_path, file_unique_id, filename, digest.hexdigest(), size
+            )
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        self._stats['bytes'] += size
+        logger.info(f"File downloaded successfully: {file_path} ({size} bytes)")
+        return filename, size
+
+    @staticmethod
+    def _finalize(temp_path, file_path, file_unique_id, filename, sha256, size):
+        """
+        在工作线程中把临时文件改名为正式文件，并登记到 media_files
+
+        直接提交而不经过批量写入队列，等待同一文件的下载随后就能在表中找到它。
+        FILES_DIR 在启动时由 init_directories 创建。
+        """
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
+        with db.connection() as conn:
+            conn.execute(UPSERT_MEDIA_FILE_SQL, (file_unique_id, filename, sha256, size))
+
+    async def close(self):
+        """停止下载协程并关闭共享客户端"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._client is not None:
+            await self._client.aclose()
+        self._queue = None
+        self._client = None
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats['workers'] = len(self._workers)
+        stats['pending'] = self._queue.qsize() if self._queue is not None else 0
+        stats['in_flight'] = len(self._inflight)
+        stats['indexed'] = len(self._index)
+        return stats
+
+# 创建全局媒体下载器
+media_downloader = MediaDownloader(MEDIA['DOWNLOAD_WORKERS'], MEDIA['QUEUE_SIZE'], MEDIA['INDEX_CACHE_SIZE'])
+
+def select_thumbnail(message, media):
+    """
+    选择面板预览用的缩略图
+
+    照片取最长边不小于 MEDIA['THUMB_SIZE'] 的最小尺寸，视频、文件、贴纸使用 Telegram
+    生成的 thumbnail（视频即首帧）。缩略图就是原文件本身或不存在时返回 None。
+    """
+    if message.photo:
+        # message.photo 按尺寸从小到大排列
+        thumbnail = next(
+            (size for size in message.photo if max(size.width, size.height) >= MEDIA['THUMB_SIZE']),
+            message.photo[-1]
+        )
+    else:
+        thumbnail = getattr(media, 'thumbnail', None)
+    if thumbnail is None or thumbnail.file_unique_id == media.file_unique_id:
         return None
+    return thumbnail
+
+# 附件被清理后 file_path 改为该值，面板显示为“已过期”
+MEDIA_TOMBSTONE = 'expired'
+
+class MediaRetention:
+    """
+    媒体保留策略
+
+    按 RETENTION['POLICIES'] 的消息类型保留天数（可用 CHAT_POLICIES 按群组覆盖）清理附件。
+    每批通过部分索引取出最早的一批过期附件消息，把 file_path 改为 MEDIA_TOMBSTONE，
+    清空 thumb_path，并减少附件和缩略图在 media_files 中的引用次数（缩略图只有在 thumb_path
+    已经回填、确实取得过引用时才减少）；引用归零的文件在事务提交后删除。
+    提交之后才写入磁盘的同名文件属于重新下载，不会被删除。
+    不遍历 FILES_DIR，批次之间停顿，避免集中占用磁盘。
+    """
+
+    def __init__(self, policies, chat_policies):
+        self.policies = dict(policies)
+        self.chat_policies = {int(chat_id): dict(policy) for chat_id, policy in chat_policies.items()}
+        self._lock = threading.Lock()
+        self._stats = {
+            'sweeps': 0, 'expired': 0, 'files_deleted': 0,
+            'bytes_freed': 0, 'last_sweep': None
+        }
+
+    def _targets(self, now):
+        """生成本次需要检查的 (消息类型, 群组ID或None, 截止时间, 排除的群组ID列表)"""
+        message_types = set(self.policies)
+        for policy in self.chat_policies.values():
+            message_types.update(policy)
+        for message_type in sorted(message_types):
+            overrides = {
+                chat_id: policy[message_type]
+                for chat_id, policy in self.chat_policies.items()
+                if message_type in policy
+            }
+            days = self.policies.get(message_type)
+            if days is not None:
+                yield message_type, None, self._cutoff(now, days), list(overrides)
+            for chat_id, chat_days in overrides.items():
+                if chat_days is not None:
+                    yield message_type, chat_id, self._cutoff(now, chat_days), []
+
+    @staticmethod
+    def _cutoff(now, days):
+        # 与 messages.timestamp 相同的格式，可以直接按字符串比较
+        return (now - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S UTC')
+
+    def sweep_batch(self, limit):
+        """清理一批过期附件，返回本批清理的消息数"""
+        rows = []
+        with db.connection() as conn:
+            for message_type, chat_id, cutoff, excluded in self._targets(datetime.now(pytz.UTC)):
+                remaining = limit - len(rows)
+                if remaining <= 0:
+                    break
+                sql, params = retention_query(message_type, chat_id, cutoff, excluded, remaining)
+                rows.extend(conn.execute(sql, params).fetchall())
+
+            if not rows:
+                return 0
+
+            conn.executemany(
+                'UPDATE messages SET file_path = ?, thumb_path = NULL WHERE id = ?',
+                [(MEDIA_TOMBSTONE, row[0]) for row in rows]
+            )
+
+            # 按 file_unique_id 存放的文件减少引用，引用归零后删除；
+            # 缩略图下载失败或被放弃时 thumb_path 为空，这条消息从未引用过它
+            references = collections.Counter(row[1] for row in rows if row[1])
+            references.update(
+                row[2] for row in rows
+                if row[2] and row[4] and row[4].startswith('/serve_file/')
+            )
+            released = []
+            if references:
+                conn.executemany(
+                    'UPDATE media_files SET ref_count = ref_count - ? WHERE file_unique_id = ?',
+                    [(count, file_unique_id) for file_unique_id, count in references.items()]
+                )
+                placeholders = ','.join('?' * len(references))
+                released = conn.execute(
+                    f'SELECT file_unique_id, path, size FROM media_files '
+                    f'WHERE ref_count <= 0 AND file_unique_id IN ({placeholders})',
+                    list(references)
+                ).fetchall()
+                conn.execute(
+                    f'DELETE FROM media_files WHERE ref_count <= 0 AND file_unique_id IN ({placeholders})',
+                    list(references)
+                )
+            conn.commit()
+        committed_at = time.time()
+
+        # 旧版本按时间戳命名的文件只属于一条消息，直接删除
+        filenames = [row[3][len('/serve_file/'):] for row in rows if not row[1]]
+        filenames.extend(path for _, path, _ in released)
+        for file_unique_id, _, _ in released:
+            runtime.loop.call_soon_threadsafe(media_downloader.forget, file_unique_id)
+
+        deleted = 0
+        freed = 0
+        for filename in filenames:
+            file_path = os.path.join(FILES_DIR, os.path.basename(filename))
+            try:
+                stat = os.stat(file_path)
+                if stat.st_mtime >= committed_at:
+                    # 记录删除后同一文件又被下载了一次，这是新文件
+                    continue
+                size = stat.st_size
+                os.remove(file_path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.error(f"[媒体清理] 删除文件失败 {file_path}: {str(e)}")
+                continue
+            deleted += 1
+            freed += size
+
+        with self._lock:
+            self._stats['expired'] += len(rows)
+            self._stats['files_deleted'] += deleted
+            self._stats['bytes_freed'] += freed
+        return len(rows)
+
+    async def sweep(self):
+        """分批清理所有过期附件"""
+        batch_size = RETENTION['SWEEP_BATCH_SIZE']
+        total = 0
+        while True:
+            cleaned = await asyncio.to_thread(self.sweep_batch, batch_size)
+            total += cleaned
+            if cleaned < batch_size:
+                break
+            await asyncio.sleep(RETENTION['SWEEP_PAUSE'])
+        with self._lock:
+            self._stats['sweeps'] += 1
+            self._stats['last_sweep'] = datetime.now(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S UTC')
+        if total:
+            logger.info(f"[媒体清理] 本轮清理过期附件 {total} 个")
+        return total
+
+    async def run(self):
+        """定期执行清理"""
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"[媒体清理] 清理失败: {str(e)}", exc_info=True)
+            await asyncio.sleep(RETENTION['SWEEP_INTERVAL'])
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['policies'] = self.policies
+        stats['chat_policies'] = len(self.chat_policies)
+        return stats
+
+# 创建全局媒体清理器
+media_retention = MediaRetention(RETENTION['POLICIES'], RETENTION['CHAT_POLICIES'])
 
 def login_required(f):
     @wraps(f)
@@ -512,31 +2338,35 @@ def delete_auto_mute_setting():
                 'message': '无效的ID格式'
             }), 400
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # 先检查设置是否存在
-        c.execute('SELECT COUNT(*) FROM auto_mute_settings WHERE chat_id = ?', (chat_id,))
-        count = c.fetchone()[0]
+        with db.connection() as conn:
+            c = conn.cursor()
         
-        logger.info(f"找到 {count} 条匹配的设置")
-        print(f"找到 {count} 条匹配的设置")
+            # 先检查设置是否存在
+            c.execute('SELECT COUNT(*) FROM auto_mute_settings WHERE chat_id = ?', (chat_id,))
+            count = c.fetchone()[0]
         
-        if count == 0:
-            return jsonify({
-                'status': 'error',
-                'message': '未找到该设置'
-            }), 404
+            logger.info(f"找到 {count} 条匹配的设置")
+            print(f"找到 {count} 条匹配的设置")
         
-        # 删除设置
-        c.execute('DELETE FROM auto_mute_settings WHERE chat_id = ?', (chat_id,))
-        rows_affected = c.rowcount
+            if count == 0:
+                return jsonify({
+                    'status': 'error',
+                    'message': '未找到该设置'
+                }), 404
         
-        logger.info(f"删除影响的行数: {rows_affected}")
-        print(f"删除影响的行数: {rows_affected}")
+            # 删除设置
+            c.execute('DELETE FROM auto_mute_settings WHERE chat_id = ?', (chat_id,))
+            rows_affected = c.rowcount
         
-        conn.commit()
+            logger.info(f"删除影响的行数: {rows_affected}")
+            print(f"删除影响的行数: {rows_affected}")
         
+            conn.commit()
+
+        # 归还连接后再通知调度器，reload_chat 会自己取连接读取设置
+        auto_mute_planner.reload_chat(chat_id)
+        event_broker.publish('auto_mute', {'chat_id': chat_id, 'action': 'deleted'})
+
         return jsonify({
             'status': 'success',
             'message': '设置已删除'
@@ -549,9 +2379,6 @@ def delete_auto_mute_setting():
             'status': 'error',
             'message': f'删除失败: {str(e)}'
         }), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/auto_mute/settings', methods=['POST'])
 @login_required
@@ -559,9 +2386,6 @@ def delete_auto_mute_setting():
 async def auto_mute_settings():
     """获取或更新自动禁言设置"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-
         data = request.get_json()
         chat_id = data.get('chat_id')
         enabled = data.get('enabled', False)
@@ -577,20 +2401,26 @@ async def auto_mute_settings():
         now = datetime.now(CHINA_TZ)
         
         # 使用 UPSERT 语法更新或插入设置
-        c.execute('''
-            INSERT INTO auto_mute_settings 
-            (chat_id, enabled, start_time, end_time, days_of_week, mute_level, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(chat_id) DO UPDATE SET
-            enabled=excluded.enabled,
-            start_time=excluded.start_time,
-            end_time=excluded.end_time,
-            days_of_week=excluded.days_of_week,
-            mute_level=excluded.mute_level,
-            updated_at=excluded.updated_at
-        ''', (chat_id, enabled, start_time, end_time, days_of_week, mute_level, now.strftime('%Y-%m-%d %H:%M:%S')))
-        
-        conn.commit()
+        def save_settings(conn):
+            c = conn.cursor()
+            c.execute('''
+                INSERT INTO auto_mute_settings 
+                (chat_id, enabled, start_time, end_time, days_of_week, mute_level, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET
+                enabled=excluded.enabled,
+                start_time=excluded.start_time,
+                end_time=excluded.end_time,
+                days_of_week=excluded.days_of_week,
+                mute_level=excluded.mute_level,
+                updated_at=excluded.updated_at
+            ''', (chat_id, enabled, start_time, end_time, days_of_week, mute_level, now.strftime('%Y-%m-%d %H:%M:%S')))
+            
+            conn.commit()
+
+        await db.run(save_settings)
+        await asyncio.to_thread(auto_mute_planner.reload_chat, int(chat_id))
+        event_broker.publish('auto_mute', {'chat_id': chat_id, 'action': 'updated'})
 
         # 检查是否在设定时间范围内
         now = datetime.now(CHINA_TZ)
@@ -626,33 +2456,31 @@ async def auto_mute_settings():
                         can_pin_messages=False
                     )
                     
-                    await bot.set_chat_permissions(
-                        chat_id=chat_id,
-                        permissions=permissions
-                    )
+                    changed = await set_chat_permissions_cached(bot, int(chat_id), permissions)
+                    auto_mute_planner.record_applied(int(chat_id), 'muted', mute_level)
                     
-                    # 发送开启通知，使用固定的时段格式
-                    notification_text = (
-                        "🌙 自动禁言模式已开始\n\n"
-                        f"⏰ 禁言时段：{start_time} - {end_time}\n"
-                        f"📅 生效日期：{formatDays(days)}\n"
-                        f"🔒 禁言级别：{mute_level == 'strict' and '严格（禁止所有消息）' or '轻度（仅允许文字消息）'}\n\n"
-                        "⚠️ 请各位成员注意休息"
-                    )
-                    await bot.send_message(
-                        chat_id=chat_id,
-                        text=notification_text,
-                        parse_mode='HTML'
-                    )
-                    logger.info(f"[禁言] 群组 {chat_id} 被禁言并已发送通知")
+                    # 群组本来就处于同样的禁言状态（例如重复保存设置）时不再发送通知
+                    if changed:
+                        # 发送开启通知，使用固定的时段格式
+                        notification_text = (
+                            "🌙 自动禁言模式已开始\n\n"
+                            f"⏰ 禁言时段：{start_time} - {end_time}\n"
+                            f"📅 生效日期：{formatDays(days)}\n"
+                            f"🔒 禁言级别：{mute_level == 'strict' and '严格（禁止所有消息）' or '轻度（仅允许文字消息）'}\n\n"
+                            "⚠️ 请各位成员注意休息"
+                        )
+                        await bot.send_message(
+                            chat_id=chat_id,
+                            text=notification_text,
+                            parse_mode='HTML'
+                        )
+                        logger.info(f"[禁言] 群组 {chat_id} 被禁言并已发送通知")
 
         return jsonify({'status': 'success', 'message': '设置已更新'})
 
     except Exception as e:
         logger.error(f"Error in auto_mute_settings: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
-    finally:
-        conn.close()
 
 @app.route('/webhook', methods=['POST'])
 @async_route
@@ -665,6 +2493,10 @@ async def webhook():
         update = Update.de_json(data, bot_manager.bot)
         logger.info(f"Update object created: {update}")
         
+        # 机器人自己的身份变化（被提升、降级、限制或移出）后，缓存的管理员列表已经过时
+        if update.my_chat_member:
+            chat_admins_cache.invalidate(update.my_chat_member.chat.id)
+        
         if update.message:
             message = update.message
             chat_id = message.chat.id
@@ -672,6 +2504,9 @@ async def webhook():
             
             logger.info(f"Processing message from chat {chat_id} of type {chat_type}")
             
+            if chat_type in ['group', 'supergroup']:
+                observe_chat_message(message)
+            
             # 首先进行垃圾信息检测
             if chat_type in ['group', 'supergroup'] and (message.text or message.caption):
                 logger.info(f"[消息处理] 开始检查是否为垃圾信息")
@@ -702,7 +2537,8 @@ async def webhook():
                                     can_send_other_messages=False,
                                     can_add_web_page_previews=False
                                 )
-                                await bot.restrict_chat_member(
+                                await restrict_member(
+                                    bot,
                                     chat_id=chat_id,
                                     user_id=message.from_user.id,
                                     permissions=permissions,
@@ -714,16 +2550,20 @@ async def webhook():
                                     text=mute_text,
                                     parse_mode='HTML'
                                 )
+                            event_broker.publish('moderation', {
+                                'action': f'spam_{action}',
+                                'chat_id': chat_id,
+                                'user_id': message.from_user.id
+                            })
                             return jsonify({'status': 'success'})
                     except Exception as e:
                         logger.error(f"Error handling spam message: {str(e)}")
 
             # 处理新成员加入
             if message.new_chat_members:
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                
-                try:
+                def load_join_settings(conn):
+                    c = conn.cursor()
+
                     # 清理用户旧的验证记录
                     for new_member in message.new_chat_members:
                         if not new_member.is_bot:
@@ -742,117 +2582,123 @@ async def webhook():
                         WHERE chat_id = ? AND enabled = 1
                     ''', (chat_id,))
                     
-                    settings = c.fetchone()
-                    logger.info(f"Verification settings for chat {chat_id}: {settings}")
+                    return c.fetchone()
+
+                settings = await db.run(load_join_settings)
+                logger.info(f"Verification settings for chat {chat_id}: {settings}")
+                
+                if settings:
+                    enabled, verify_type, question, answer, welcome_msg, timeout = settings
                     
-                    if settings:
-                        enabled, verify_type, question, answer, welcome_msg, timeout = settings
-                        
-                        for new_member in message.new_chat_members:
-                            if not new_member.is_bot:
-                                # 记录待验证用户
-                                join_time = datetime.now(CHINA_TZ)
-                                verify_deadline = join_time + timedelta(seconds=timeout)
+                    for new_member in message.new_chat_members:
+                        if not new_member.is_bot:
+                            # 记录待验证用户
+                            join_time = datetime.now(CHINA_TZ)
+                            verify_deadline = join_time + timedelta(seconds=timeout)
+                            
+                            try:
+                                await db.run(lambda conn: conn.execute('''
+                                    INSERT INTO pending_members 
+                                    (chat_id, user_id, username, full_name, 
+                                     join_time, verify_deadline, status)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                                ''', (
+                                    chat_id, new_member.id, new_member.username,
+                                    new_member.full_name, join_time.strftime('%Y-%m-%d %H:%M:%S'),
+                                    verify_deadline.strftime('%Y-%m-%d %H:%M:%S'), 'pending'
+                                )))
+                                logger.info(f"Added new pending verification for user {new_member.id}")
+                                event_broker.publish('verification', {
+                                    'chat_id': chat_id,
+                                    'user_id': new_member.id,
+                                    'status': 'pending'
+                                })
                                 
-                                try:
-                                    c.execute('''
-                                        INSERT INTO pending_members 
-                                        (chat_id, user_id, username, full_name, 
-                                         join_time, verify_deadline, status)
-                                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                                    ''', (
-                                        chat_id, new_member.id, new_member.username,
-                                        new_member.full_name, join_time.strftime('%Y-%m-%d %H:%M:%S'),
-                                        verify_deadline.strftime('%Y-%m-%d %H:%M:%S'), 'pending'
-                                    ))
-                                    conn.commit()
-                                    logger.info(f"Added new pending verification for user {new_member.id}")
+                                # 限制新用户权限
+                                async with bot_manager.get_bot() as bot:
+                                    permissions = ChatPermissions(
+                                        can_send_messages=False,
+                                        can_send_polls=False,
+                                        can_send_other_messages=False,
+                                        can_add_web_page_previews=False
+                                    )
+                                    await restrict_member(
+                                        bot,
+                                        chat_id=chat_id,
+                                        user_id=new_member.id,
+                                        permissions=permissions
+                                    )
+                                    logger.info(f"Restricted permissions for user {new_member.id}")
                                     
-                                    # 限制新用户权限
-                                    async with bot_manager.get_bot() as bot:
-                                        permissions = ChatPermissions(
-                                            can_send_messages=False,
-                                            can_send_polls=False,
-                                            can_send_other_messages=False,
-                                            can_add_web_page_previews=False
-                                        )
-                                        await bot.restrict_chat_member(
-                                            chat_id=chat_id,
-                                            user_id=new_member.id,
-                                            permissions=permissions
-                                        )
-                                        logger.info(f"Restricted permissions for user {new_member.id}")
-                                        
-                                        if verify_type == 'question':
-                                            try:
-                                                # 先在群里发送简单通知（自动删除）
-                                                group_msg = (
-                                                    f"👋 欢迎 {new_member.mention_html()}\n"
-                                                    "验证消息已通过私聊发送，请查收。"
-                                                )
-                                                await send_auto_delete_message(
-                                                    bot=bot,
-                                                    chat_id=chat_id,
-                                                    text=group_msg,
-                                                    parse_mode='HTML'
-                                                )
-                                                
-                                                # 通过私聊发送验证问题
-                                                verify_msg = (
-                                                    f"👋 您好！要加入群组，请先回答以下问题：\n\n"
-                                                    f"❓ {question}\n\n"
-                                                    f"⏰ 请在 {timeout} 秒内回复答案\n\n"
-                                                    "⚠️ 注意：请直接回复答案，不需要附加其他内容"
-                                                )
-                                                await bot.send_message(
-                                                    chat_id=new_member.id,
-                                                    text=verify_msg
-                                                )
-                                                logger.info(f"Sent verification question to user {new_member.id}")
-                                                
-                                            except telegram.error.Forbidden:
-                                                # 如果用户没有启用私聊，发送提醒
-                                                warning_msg = (
-                                                    f"{new_member.mention_html()}，由于您的隐私设置，机器人无法向您发送私聊消息。\n"
-                                                    "请先点击 @your_bot_username 启用私聊，然后重新加入群组。"
-                                                )
-                                                await send_auto_delete_message(
-                                                    bot=bot,
-                                                    chat_id=chat_id,
-                                                    text=warning_msg,
-                                                    parse_mode='HTML'
-                                                )
-                                                # 移除用户
-                                                await bot.ban_chat_member(chat_id=chat_id, user_id=new_member.id)
-                                                await bot.unban_chat_member(chat_id=chat_id, user_id=new_member.id)
-                                        else:
-                                            # 管理员审核模式
+                                    if verify_type == 'question':
+                                        try:
+                                            # 先在群里发送简单通知（自动删除）
+                                            group_msg = (
+                                                f"👋 欢迎 {new_member.mention_html()}\n"
+                                                "验证消息已通过私聊发送，请查收。"
+                                            )
+                                            await send_auto_delete_message(
+                                                bot=bot,
+                                                chat_id=chat_id,
+                                                text=group_msg,
+                                                parse_mode='HTML'
+                                            )
+                                            
+                                            # 通过私聊发送验证问题
                                             verify_msg = (
-                                                f"👋 欢迎 {new_member.mention_html()}\n\n"
-                                                "⌛️ 请等待管理员验证\n\n"
-                                                f"⏰ 验证时限：{timeout} 秒"
+                                                f"👋 您好！要加入群组，请先回答以下问题：\n\n"
+                                                f"❓ {question}\n\n"
+                                                f"⏰ 请在 {timeout} 秒内回复答案\n\n"
+                                                "⚠️ 注意：请直接回复答案，不需要附加其他内容"
+                                            )
+                                            await bot.send_message(
+                                                chat_id=new_member.id,
+                                                text=verify_msg
+                                            )
+                                            logger.info(f"Sent verification question to user {new_member.id}")
+                                            
+                                        except telegram.error.Forbidden:
+                                            # 如果用户没有启用私聊，发送提醒
+                                            warning_msg = (
+                                                f"{new_member.mention_html()}，由于您的隐私设置，机器人无法向您发送私聊消息。\n"
+                                                "请先点击 @your_bot_username 启用私聊，然后重新加入群组。"
                                             )
                                             await send_auto_delete_message(
                                                 bot=bot,
                                                 chat_id=chat_id,
-                                                text=verify_msg,
+                                                text=warning_msg,
                                                 parse_mode='HTML'
                                             )
-                                            logger.info(f"Set up admin verification for user {new_member.id}")
-                                        
-                                        # 创建超时任务
-                                        task_id = f"verify_{chat_id}_{new_member.id}"
-                                        task_manager.schedule_task(
-                                            task_id,
-                                            lambda bot: handle_verification_timeout(bot, chat_id, new_member.id),
-                                            timeout
+                                            # 移除用户
+                                            await bot.ban_chat_member(chat_id=chat_id, user_id=new_member.id)
+                                            await bot.unban_chat_member(chat_id=chat_id, user_id=new_member.id)
+                                    else:
+                                        # 管理员审核模式
+                                        verify_msg = (
+                                            f"👋 欢迎 {new_member.mention_html()}\n\n"
+                                            "⌛️ 请等待管理员验证\n\n"
+                                            f"⏰ 验证时限：{timeout} 秒"
                                         )
-                                        logger.info(f"Scheduled timeout task for user {new_member.id}")
-                                
-                                except sqlite3.IntegrityError as e:
-                                    logger.error(f"Database error adding user {new_member.id}: {e}")
-                finally:
-                    conn.close()
+                                        await send_auto_delete_message(
+                                            bot=bot,
+                                            chat_id=chat_id,
+                                            text=verify_msg,
+                                            parse_mode='HTML'
+                                        )
+                                        logger.info(f"Set up admin verification for user {new_member.id}")
+                                    
+                                    # 创建超时任务
+                                    task_id = f"verify_{chat_id}_{new_member.id}"
+                                    task_manager.schedule_job(
+                                        task_id,
+                                        'verification_timeout',
+                                        {'chat_id': chat_id, 'user_id': new_member.id},
+                                        timeout
+                                    )
+                                    logger.info(f"Scheduled timeout task for user {new_member.id}")
+                            
+                            except sqlite3.IntegrityError as e:
+                                logger.error(f"Database error adding user {new_member.id}: {e}")
 
             # 处理常规消息
             # 安全地获取用户信息
@@ -897,8 +2743,12 @@ async def webhook():
                 'chat_type': chat_type,
                 'is_topic_message': getattr(message, 'is_topic_message', False),
                 'topic_id': getattr(message, 'message_thread_id', None),
-                'forward_from': None
+                'forward_from': None,
+                'message_id': message.message_id,
+                'file_unique_id': None
             }
+            media = None
+            thumbnail = None
 
             # 处理转发消息
             if hasattr(message, 'forward_from') and message.forward_from:
@@ -920,27 +2770,37 @@ async def webhook():
             elif hasattr(message, 'photo') and message.photo:
                 message_data['message_type'] = 'photo'
                 message_data['message_content'] = getattr(message, 'caption', '') or ''
-                message_data['file_path'] = await download_file(message.photo[-1])
+                media = message.photo[-1]
                 logger.info("Photo message processed")
             elif hasattr(message, 'video') and message.video:
                 message_data['message_type'] = 'video'
                 message_data['message_content'] = getattr(message, 'caption', '') or ''
-                message_data['file_path'] = await download_file(message.video)
+                media = message.video
                 logger.info("Video message processed")
             elif hasattr(message, 'document') and message.document:
                 message_data['message_type'] = 'document'
                 message_data['message_content'] = getattr(message, 'caption', '') or ''
-                message_data['file_path'] = await download_file(message.document)
+                media = message.document
                 logger.info("Document message processed")
             elif hasattr(message, 'sticker') and message.sticker:
                 message_data['message_type'] = 'sticker'
                 message_data['message_content'] = getattr(message.sticker, 'emoji', '') or ''
-                message_data['file_path'] = await download_file(message.sticker)
+                media = message.sticker
                 logger.info("Sticker message processed")
             
+            if media:
+                message_data['file_unique_id'] = media.file_unique_id
+                thumbnail = select_thumbnail(message, media)
+                if thumbnail:
+                    message_data['thumb_unique_id'] = thumbnail.file_unique_id
             logger.info(f"Final message_data: {message_data}")
             save_message(message_data)
             logger.info(f"Message saved to database")
+            # 附件在后台下载，完成后回填 file_path；缩略图先下载，面板可以尽快显示预览
+            if thumbnail:
+                media_downloader.enqueue(thumbnail, chat_id, message.message_id, message_data['message_type'], thumbnail=True)
+            if media:
+                media_downloader.enqueue(media, chat_id, message.message_id, message_data['message_type'])
 
         elif update.channel_post:
             # 处理频道消息
@@ -962,8 +2822,12 @@ async def webhook():
                 'chat_type': chat_type,
                 'is_topic_message': False,
                 'topic_id': None,
-                'forward_from': None
+                'forward_from': None,
+                'message_id': message.message_id,
+                'file_unique_id': None
             }
+            media = None
+            thumbnail = None
             
             # 处理不同类型的频道消息
             if hasattr(message, 'text') and message.text:
@@ -973,22 +2837,31 @@ async def webhook():
             elif hasattr(message, 'photo') and message.photo:
                 message_data['message_type'] = 'photo'
                 message_data['message_content'] = getattr(message, 'caption', '') or ''
-                message_data['file_path'] = await download_file(message.photo[-1])
+                media = message.photo[-1]
                 logger.info("Channel photo message processed")
             elif hasattr(message, 'video') and message.video:
                 message_data['message_type'] = 'video'
                 message_data['message_content'] = getattr(message, 'caption', '') or ''
-                message_data['file_path'] = await download_file(message.video)
+                media = message.video
                 logger.info("Channel video message processed")
             elif hasattr(message, 'document') and message.document:
                 message_data['message_type'] = 'document'
                 message_data['message_content'] = getattr(message, 'caption', '') or ''
-                message_data['file_path'] = await download_file(message.document)
+                media = message.document
                 logger.info("Channel document message processed")
             
+            if media:
+                message_data['file_unique_id'] = media.file_unique_id
+                thumbnail = select_thumbnail(message, media)
+                if thumbnail:
+                    message_data['thumb_unique_id'] = thumbnail.file_unique_id
             logger.info(f"Final channel message data: {message_data}")
             save_message(message_data)
             logger.info(f"Channel message saved to database")
+            if thumbnail:
+                media_downloader.enqueue(thumbnail, chat_id, message.message_id, message_data['message_type'], thumbnail=True)
+            if media:
+                media_downloader.enqueue(media, chat_id, message.message_id, message_data['message_type'])
         
         return jsonify({'status': 'success'})
 
@@ -999,88 +2872,10 @@ async def webhook():
             'message': str(e)
         }), 500
 
-# 添加任务取消方法到TaskManager类
-    def cancel_task(self, task_id):
-        """取消指定的任务"""
-        with self._lock:
-            if task_id in self._tasks:
-                try:
-                    self._tasks[task_id].cancel()
-                    logger.info(f"[定时任务] 任务 {task_id} 已取消")
-                except Exception as e:
-                    logger.error(f"[定时任务] 取消任务 {task_id} 时出错: {str(e)}")
-                self._tasks.pop(task_id, None)
-
-    def cleanup(self):
-        """清理所有任务"""
-        with self._lock:
-            for task_id, future in self._tasks.items():
-                try:
-                    future.cancel()
-                    logger.info(f"[定时任务] 任务 {task_id} 已在清理时取消")
-                except Exception as e:
-                    logger.error(f"[定时任务] 清理任务 {task_id} 时出错: {str(e)}")
-            self._tasks.clear()
-            logger.info("[定时任务] 所有任务已清理")
-
-# 修改TaskManager的schedule_task方法以支持取消已存在的任务
-def schedule_task(self, task_id, func, delay):
-    """调度一个延迟执行的任务，如果已存在同ID的任务则先取消"""
-    with self._lock:
-        # 如果已存在相同ID的任务，先取消它
-        if task_id in self._tasks:
-            self._tasks[task_id].cancel()
-            self._tasks.pop(task_id)
-            logger.info(f"[定时任务] 取消已存在的任务 {task_id}")
-        
-        # 提交新任务
-        future = self.executor.submit(self._run_task, task_id, func, delay)
-        self._tasks[task_id] = future
-        logger.info(f"[定时任务] 已调度任务 {task_id}, 将在 {delay} 秒后执行")
-        
-def _run_task(self, task_id, func, delay):
-    """运行任务的内部方法"""
-    try:
-        logger.info(f"[定时任务] 开始执行任务 {task_id}, 延迟 {delay} 秒")
-        time.sleep(delay)
-        
-        # 创建新的事件循环
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        try:
-            # 创建新的 bot 实例
-            request = HTTPXRequest(
-                connection_pool_size=1,
-                connect_timeout=30.0,
-                read_timeout=30.0,
-                write_timeout=30.0,
-                pool_timeout=3.0
-            )
-            bot = telegram.Bot(token=TOKEN, request=request)
-            
-            # 执行异步操作
-            coroutine = func(bot)
-            result = loop.run_until_complete(coroutine)
-            logger.info(f"[定时任务] 任务 {task_id} 执行成功")
-            return result
-        finally:
-            loop.close()
-            asyncio.set_event_loop(None)
-            
-    except asyncio.CancelledError:
-        logger.info(f"[定时任务] 任务 {task_id} 被取消")
-    except Exception as e:
-        logger.error(f"[定时任务] 任务 {task_id} 执行失败: {str(e)}", exc_info=True)
-    finally:
-        with self._lock:
-            self._tasks.pop(task_id, None)
-            logger.info(f"[定时任务] 任务 {task_id} 已从队列中移除")
 # 新增：验证超时处理函数
 async def handle_verification_timeout(bot, chat_id: int, user_id: int):
     """处理验证超时"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
+    def mark_timeout(conn):
         c = conn.cursor()
         
         # 检查用户状态
@@ -1091,7 +2886,8 @@ async def handle_verification_timeout(bot, chat_id: int, user_id: int):
         ''', (chat_id, user_id))
         
         result = c.fetchone()
-        if result and result[0] == 'pending':
+        timed_out = bool(result and result[0] == 'pending')
+        if timed_out:
             # 更新状态为超时
             c.execute('''
                 UPDATE pending_members
@@ -1099,7 +2895,13 @@ async def handle_verification_timeout(bot, chat_id: int, user_id: int):
                 WHERE chat_id = ? AND user_id = ?
             ''', (chat_id, user_id))
             conn.commit()
-            
+        return timed_out
+
+    try:
+        timed_out = await db.run(mark_timeout)
+
+        if timed_out:
+            event_broker.publish('verification', {'chat_id': chat_id, 'user_id': user_id, 'status': 'timeout'})
             # 踢出用户
             try:
                 await bot.ban_chat_member(
@@ -1124,9 +2926,96 @@ async def handle_verification_timeout(bot, chat_id: int, user_id: int):
                 
     except Exception as e:
         logger.error(f"Error handling verification timeout: {str(e)}")
-    finally:
-        if 'conn' in locals():
-            conn.close()
+
+
+class DeletionBatcher:
+    """
+    合并到期的消息删除
+
+    同一群组在 SCHEDULER['DELETE_BATCH_DELAY'] 秒内到期的删除请求合并成一次 deleteMessages 调用
+    （每次最多 DELETE_BATCH_SIZE 条），批量删除失败时改为逐条删除。
+    只在常驻事件循环上使用；关闭服务前调用 close() 把还在等待合并的批次删完。
+    """
+
+    def __init__(self):
+        self._pending = {}  # chat_id -> [(message_id, future)]
+        self._timers = {}  # chat_id -> 定时刷新的 TimerHandle
+        self._tasks = set()  # 正在执行的删除批次，保留引用以免被回收
+        self._stats = {'requested': 0, 'batches': 0, 'fallbacks': 0}
+
+    async def delete(self, chat_id, message_id):
+        """加入待删除队列，等待所在批次删除完成，返回是否删除成功"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(chat_id, [])
+        batch.append((message_id, future))
+        self._stats['requested'] += 1
+
+        if len(batch) >= SCHEDULER['DELETE_BATCH_SIZE']:
+            self._flush(chat_id)
+        elif chat_id not in self._timers:
+            self._timers[chat_id] = loop.call_later(SCHEDULER['DELETE_BATCH_DELAY'], self._flush, chat_id)
+        return await future
+
+    def _flush(self, chat_id):
+        timer = self._timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(chat_id, None)
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._delete_batch(chat_id, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """立即删除所有等待合并的批次，并等待正在执行的批次完成"""
+        for chat_id in list(self._pending):
+            self._flush(chat_id)
+        if self._tasks:
+            logger.info(f"[消息删除] 正在完成 {len(self._tasks)} 个删除批次...")
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            # 让等待删除结果的定时任务继续执行完，写入各自的任务记录
+            await asyncio.sleep(0)
+
+    async def _delete_batch(self, chat_id, batch):
+        message_ids = [message_id for message_id, _ in batch]
+        results = {}
+        try:
+            async with bot_manager.get_bot() as bot:
+                try:
+                    await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+                    results = dict.fromkeys(message_ids, True)
+                    logger.info(f"Auto-deleted {len(message_ids)} messages in chat {chat_id}")
+                except Exception as e:
+                    logger.warning(f"Batch delete failed in chat {chat_id}, falling back to single deletes: {str(e)}")
+                    self._stats['fallbacks'] += 1
+                    for message_id in message_ids:
+                        try:
+                            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+                            results[message_id] = True
+                        except Exception as e:
+                            logger.error(f"Failed to delete message {message_id}: {str(e)}")
+                            results[message_id] = False
+        except Exception as e:
+            logger.error(f"Error deleting messages in chat {chat_id}: {str(e)}")
+        finally:
+            self._stats['batches'] += 1
+            for message_id, future in batch:
+                if not future.done():
+                    future.set_result(results.get(message_id, False))
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats['pending'] = sum(len(batch) for batch in self._pending.values())
+        stats['running'] = len(self._tasks)
+        return stats
+
+# 创建全局删除合并器
+deletion_batcher = DeletionBatcher()
+
+async def delete_message_job(bot, chat_id, message_id):
+    """定时删除消息，与同一群组同时到期的其他消息合并删除"""
+    return await deletion_batcher.delete(chat_id, message_id)
 
 async def send_auto_delete_message(bot, chat_id, text, parse_mode=None, reply_to_message_id=None, delete_after=15):
     """
@@ -1150,15 +3039,13 @@ async def send_auto_delete_message(bot, chat_id, text, parse_mode=None, reply_to
         )
         
         # 创建一个延时删除任务
-        async def delete_message(bot):
-            try:
-                await bot.delete_message(chat_id=chat_id, message_id=sent_message.message_id)
-                logger.info(f"Auto-deleted message {sent_message.message_id} in chat {chat_id}")
-            except Exception as e:
-                logger.error(f"Failed to delete message {sent_message.message_id}: {str(e)}")
-        
         task_id = f"delete_msg_{chat_id}_{sent_message.message_id}"
-        task_manager.schedule_task(task_id, delete_message, delete_after)
+        task_manager.schedule_job(
+            task_id,
+            'delete_message',
+            {'chat_id': chat_id, 'message_id': sent_message.message_id},
+            delete_after
+        )
         logger.info(f"Scheduled message {sent_message.message_id} for deletion in {delete_after} seconds")
         
         return sent_message
@@ -1167,93 +3054,305 @@ async def send_auto_delete_message(bot, chat_id, text, parse_mode=None, reply_to
         logger.error(f"Error in send_auto_delete_message: {str(e)}")
         return None
 # 修改检查垃圾信息的函数
+# 提取消息中链接的正则，预编译一次供所有规则复用
+URL_PATTERN = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick 多关键词匹配
+
+    一次扫描文本即可找出所有出现过的关键词，耗时只与文本长度有关，与关键词数量无关。
+    关键词和文本都按小写处理。
+    """
+
+    def __init__(self, keywords):
+        # keywords: {关键词: 规则序号}
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for keyword, index in keywords.items():
+            self._add(keyword.lower(), index)
+        self._build()
+
+    def _add(self, keyword, index):
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        self._output[state] = self._output[state] + (index,)
+
+    def _build(self):
+        pending = collections.deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, next_state in self._goto[state].items():
+                pending.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                self._output[next_state] = self._output[next_state] + self._output[fail]
+
+    def first_match(self, text):
+        """返回文本中出现的关键词对应的最小规则序号，没有则返回 None"""
+        goto, fail, output = self._goto, self._fail, self._output
+        best = None
+        state = 0
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found = min(output[state])
+                if best is None or found < best:
+                    best = found
+        return best
+
+class SpamMatcher:
+    """
+    某个群组编译好的垃圾信息规则
+
+    关键词规则合并到一个 Aho-Corasick 自动机，不含分组的正则规则合并成一个交替表达式作为预筛选，
+    链接规则共用预编译的 URL 正则。多条规则同时命中时，以规则列表中靠前的为准。
+    含有捕获分组的正则不参与合并：合并会给分组重新编号，其他规则里的 \\1 等反向引用
+    会指向别的分组（例如 (a)\\1 和 (b)\\1 合并后 'xbbx' 不再命中），这类规则总是单独匹配。
+    内容为空的关键词规则与原来的 '' in text 一致，命中所有消息；它不放进自动机，单独记下序号。
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        keywords = {}
+        self._always_match = None  # 第一条空关键词规则的序号
+        self._url_rules = []
+        self._regex_rules = []
+        for index, rule in enumerate(rules):
+            content = rule.get('content') or ''
+            if rule['type'] == 'keyword' and not content:
+                if self._always_match is None:
+                    self._always_match = index
+            elif rule['type'] == 'keyword':
+                # 同一个关键词出现多次时，只有第一条规则会生效
+                keywords.setdefault(content.lower(), index)
+            elif rule['type'] == 'url':
+                self._url_rules.append((index, '' if content == '*' else content.lower()))
+            elif rule['type'] == 'regex':
+                try:
+                    pattern = re.compile(content, re.IGNORECASE)
+                except re.error:
+                    logger.error(f"[垃圾检测] 无效的正则表达式: {content}")
+                    continue
+                # 没有分组也就不可能有反向引用，合并后语义不变
+                self._regex_rules.append((index, pattern, pattern.groups == 0))
+        self._keywords = KeywordAutomaton(keywords) if keywords else None
+
+        # 可合并的正则都不命中时，用一次合并后的搜索把它们全部排除
+        self._regex_prefilter = None
+        combinable = [pattern.pattern for _, pattern, plain in self._regex_rules if plain]
+        if len(combinable) > 1:
+            try:
+                self._regex_prefilter = re.compile(
+                    '|'.join(f'(?:{pattern})' for pattern in combinable),
+                    re.IGNORECASE
+                )
+            except re.error:
+                # 含有全局标志等无法合并的写法时逐条匹配
+                self._regex_prefilter = None
+
+    def match(self, text):
+        """返回命中的规则，没有命中返回 None"""
+        best = self._always_match
+        if self._keywords is not None and best != 0:
+            found = self._keywords.first_match(text)
+            if found is not None and (best is None or found < best):
+                best = found
+
+        if self._url_rules and (best is None or self._url_rules[0][0] < best):
+            urls = [url.lower() for url in URL_PATTERN.findall(text)]
+            if urls:
+                for index, content in self._url_rules:
+                    if best is not None and index >= best:
+                        break
+                    if not content or any(content in url for url in urls):
+                        best = index
+                        break
+
+        if self._regex_rules and (best is None or self._regex_rules[0][0] < best):
+            prefiltered = None
+            for index, pattern, plain in self._regex_rules:
+                if best is not None and index >= best:
+                    break
+                if plain and self._regex_prefilter is not None:
+                    if prefiltered is None:
+                        prefiltered = self._regex_prefilter.search(text) is not None
+                    if not prefiltered:
+                        continue
+                if pattern.search(text):
+                    best = index
+                    break
+
+        return self.rules[best] if best is not None else None
+
+class SpamFilterCache:
+    """
+    按群组缓存编译好的 SpamMatcher
+
+    每个群组第一次收到消息时读取一次设置并编译，之后直接使用内存中的对象；
+    /spam_filter/settings 更新设置时让对应群组的缓存失效。未启用过滤的群组缓存为 None。
+    """
+
+    MISSING = object()
+
+    def __init__(self):
+        self._matchers = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'loads': 0}
+
+    def peek(self, chat_id):
+        """只查内存，不访问数据库；未缓存时返回 MISSING"""
+        with self._lock:
+            if chat_id in self._matchers:
+                self._stats['hits'] += 1
+                return self._matchers[chat_id]
+        return self.MISSING
+
+    def get(self, chat_id):
+        with self._lock:
+            if chat_id in self._matchers:
+                self._stats['hits'] += 1
+                return self._matchers[chat_id]
+
+        with db.connection() as conn:
+            row = conn.execute('''
+                SELECT rules
+                FROM spam_filter_settings 
+                WHERE chat_id = ? AND enabled = 1
+            ''', (chat_id,)).fetchone()
+        rules = json.loads(row[0]) if row and row[0] else []
+        matcher = SpamMatcher(rules) if rules else None
+        logger.info(f"[垃圾检测] 已编译群组 {chat_id} 的 {len(rules)} 条规则")
+
+        with self._lock:
+            self._stats['loads'] += 1
+            self._matchers[chat_id] = matcher
+        return matcher
+
+    def invalidate(self, chat_id=None):
+        with self._lock:
+            if chat_id is None:
+                self._matchers.clear()
+            else:
+                self._matchers.pop(chat_id, None)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['chats'] = len(self._matchers)
+        return stats
+
+# 创建全局垃圾规则缓存
+spam_filter_cache = SpamFilterCache()
+
+class WhitelistIndex:
+    """
+    垃圾检测白名单的内存索引
+
+    启动时一次性加载 spam_filter_whitelist，按群组保存为 frozenset，
+    每条消息的白名单判断只是一次集合查找，不访问数据库。
+    白名单的增删只通过 add_to_whitelist / remove_from_whitelist 路由，写入数据库后同步更新索引；
+    更新时整体替换该群组的集合，读取方无需加锁。
+    """
+
+    def __init__(self):
+        self._members = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def load(self):
+        """从数据库重新加载全部白名单"""
+        members = collections.defaultdict(set)
+        with db.connection() as conn:
+            for chat_id, user_id in conn.execute('SELECT chat_id, user_id FROM spam_filter_whitelist'):
+                members[int(chat_id)].add(int(user_id))
+        with self._lock:
+            self._members = {chat_id: frozenset(users) for chat_id, users in members.items()}
+            self._loaded = True
+        logger.info(f"[白名单] 已加载 {sum(len(users) for users in members.values())} 个用户，涉及 {len(members)} 个群组")
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def contains(self, chat_id, user_id):
+        if not self._loaded:
+            self.load()
+        users = self._members.get(int(chat_id))
+        return users is not None and int(user_id) in users
+
+    def add(self, chat_id, user_id):
+        chat_id, user_id = int(chat_id), int(user_id)
+        with self._lock:
+            self._members[chat_id] = self._members.get(chat_id, frozenset()) | {user_id}
+
+    def remove(self, chat_id, user_id):
+        chat_id, user_id = int(chat_id), int(user_id)
+        with self._lock:
+            users = self._members.get(chat_id, frozenset()) - {user_id}
+            if users:
+                self._members[chat_id] = users
+            else:
+                self._members.pop(chat_id, None)
+
+    def get_stats(self):
+        members = self._members
+        return {
+            'loaded': self._loaded,
+            'chats': len(members),
+            'users': sum(len(users) for users in members.values())
+        }
+
+# 创建全局白名单索引
+whitelist_index = WhitelistIndex()
+
 async def check_spam(message, chat_id):
     """检查消息是否为垃圾信息，支持白名单"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        logger.info(f"[垃圾检测] 开始检查消息: chat_id={chat_id}")
-        
         # 首先检查用户是否在白名单中
         user_id = message.from_user.id
-        c.execute('''
-            SELECT 1 FROM spam_filter_whitelist 
-            WHERE chat_id = ? AND user_id = ?
-        ''', (chat_id, user_id))
-        
-        if c.fetchone():
+        if not whitelist_index.loaded:
+            await asyncio.to_thread(whitelist_index.load)
+        if whitelist_index.contains(chat_id, user_id):
             logger.info(f"[垃圾检测] 用户 {user_id} 在白名单中，跳过检查")
             return False, None
-        
-        # 获取垃圾信息过滤设置
-        c.execute('''
-            SELECT enabled, rules
-            FROM spam_filter_settings 
-            WHERE chat_id = ? AND enabled = 1
-        ''', (chat_id,))
-        
-        row = c.fetchone()
-        if not row:
-            logger.info(f"[垃圾检测] 未找到启用的过滤规则: chat_id={chat_id}")
-            return False, None
-        
-        enabled, rules = row
-        if not enabled:
-            logger.info(f"[垃圾检测] 过滤功能未启用: chat_id={chat_id}")
-            return False, None
-        
-        rules = json.loads(rules)
-        logger.info(f"[垃圾检测] 加载规则: {rules}")
-        
-        if not rules:
-            logger.info(f"[垃圾检测] 无规则配置: chat_id={chat_id}")
+
+        # 获取编译好的过滤规则
+        matcher = spam_filter_cache.peek(chat_id)
+        if matcher is SpamFilterCache.MISSING:
+            matcher = await asyncio.to_thread(spam_filter_cache.get, chat_id)
+        if matcher is None:
             return False, None
         
         # 检查消息内容
         message_text = message.text or message.caption or ''
         if not message_text:
-            logger.info(f"[垃圾检测] 无消息内容")
             return False, None
         
-        logger.info(f"[垃圾检测] 检查消息内容: {message_text}")
-        
-        for rule in rules:
-            match_found = False
-            action = rule['action']
-            
-            logger.info(f"[垃圾检测] 检查规则: type={rule['type']}, content={rule['content']}")
-            
-            if rule['type'] == 'keyword':
-                match_found = rule['content'].lower() in message_text.lower()
-            elif rule['type'] == 'url':
-                if not rule['content'] or rule['content'] == '*':
-                    url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-                    match_found = bool(re.search(url_pattern, message_text))
-                else:
-                    urls = re.findall(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', message_text)
-                    match_found = any(rule['content'].lower() in url.lower() for url in urls)
-            elif rule['type'] == 'regex':
-                try:
-                    pattern = re.compile(rule['content'], re.IGNORECASE)
-                    match_found = bool(pattern.search(message_text))
-                except re.error:
-                    logger.error(f"[垃圾检测] 无效的正则表达式: {rule['content']}")
-                    continue
-            
-            if match_found:
-                logger.info(f"[垃圾检测] 发现匹配规则: type={rule['type']}, action={action}")
-                return True, action
+        rule = matcher.match(message_text)
+        if rule is not None:
+            logger.info(f"[垃圾检测] 发现匹配规则: type={rule['type']}, action={rule['action']}")
+            return True, rule['action']
         
-        logger.info(f"[垃圾检测] 未发现垃圾信息")
         return False, None
         
     except Exception as e:
         logger.error(f"[垃圾检测] 检查出错: {str(e)}", exc_info=True)
         return False, None
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 async def handle_verification_success(bot, user_id, group_id, message, welcome_msg, task_id):
     """处理验证成功的情况"""
@@ -1265,7 +3364,8 @@ async def handle_verification_success(bot, user_id, group_id, message, welcome_m
             can_send_other_messages=True,
             can_add_web_page_previews=True
         )
-        await bot.restrict_chat_member(
+        await restrict_member(
+            bot,
             chat_id=group_id,
             user_id=user_id,
             permissions=permissions
@@ -1315,30 +3415,70 @@ async def handle_verification_success(bot, user_id, group_id, message, welcome_m
 # 新增：清理过期验证记录的定时任务
 async def clean_expired_verifications():
     """清理过期的验证记录"""
+    def delete_expired(conn):
+        # 删除已完成的过期记录
+        cursor = conn.execute('''
+            DELETE FROM pending_members
+            WHERE status != 'pending'
+            AND datetime(verify_deadline) < datetime('now')
+        ''')
+        conn.commit()
+        return cursor.rowcount
+
     while True:
         try:
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            # 删除已完成的过期记录
-            c.execute('''
-                DELETE FROM pending_members
-                WHERE status != 'pending'
-                AND datetime(verify_deadline) < datetime('now')
-            ''')
-            
-            conn.commit()
+            cleaned = await db.run(delete_expired)
             logger.info("Cleaned expired verification records")
+            if cleaned:
+                event_broker.publish('verification', {'chat_id': None, 'status': 'cleaned'})
             
         except Exception as e:
             logger.error(f"Error cleaning expired verifications: {str(e)}")
-        finally:
-            if 'conn' in locals():
-                conn.close()
             
         # 每小时运行一次
         await asyncio.sleep(3600)
 
+# 获取运行状态统计
+@app.route('/api/stats', methods=['GET'])
+@login_required
+def get_stats():
+    """返回 bot 连接池等运行时统计信息"""
+    return jsonify({
+        'status': 'success',
+        'bot_pool': bot_manager.get_stats(),
+        'runtime': runtime.get_stats(),
+        'database': db.get_stats(),
+        'ingest': ingest_writer.get_stats(),
+        'message_count_cache': message_count_cache.get_stats(),
+        'events': event_broker.get_stats(),
+        'spam_filter': spam_filter_cache.get_stats(),
+        'whitelist': whitelist_index.get_stats(),
+        'scheduler': task_manager.get_stats(),
+        'rate_limit': rate_limiter.get_stats(),
+        'deletions': deletion_batcher.get_stats(),
+        'media': media_downloader.get_stats(),
+        'retention': media_retention.get_stats(),
+        'auto_mute': auto_mute_planner.get_stats(),
+        'chat_metadata': get_metadata_cache_stats()
+    })
+
+# 面板实时事件流
+@app.route('/events', methods=['GET'])
+@login_required
+def events():
+    """以 Server-Sent Events 推送新消息、入群验证和禁言变化"""
+    client = event_broker.subscribe()
+    if client is None:
+        return jsonify({'status': 'error', 'message': '实时连接数已达上限'}), 503
+    return Response(
+        stream_with_context(event_broker.stream(client)),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
 # 获取群组列表
 @app.route('/api/groups', methods=['GET'])
 @login_required
@@ -1346,19 +3486,15 @@ async def clean_expired_verifications():
 async def get_groups():
     try:
         logger.info("开始获取群组列表")
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+        def load_groups(conn):
+            c = conn.cursor()
         
-        # 从消息记录中获取唯一的群组信息
-        c.execute('''
-            SELECT DISTINCT chat_id, chat_title 
-            FROM messages 
-            WHERE chat_type IN ('group', 'supergroup') 
-            ORDER BY chat_title
-        ''')
+            # 从消息记录中获取唯一的群组信息
+            c.execute(GROUPS_SQL)
         
-        groups = [{'id': row[0], 'title': row[1]} for row in c.fetchall()]
-        conn.close()
+            return [{'id': row[0], 'title': row[1]} for row in c.fetchall()]
+
+        groups = await db.run(load_groups)
         
         logger.info(f"成功获取群组列表，共 {len(groups)} 个群组")
         for group in groups:
@@ -1386,17 +3522,17 @@ async def get_group_members(chat_id):
         
         async with bot_manager.get_bot() as bot:
             try:
-                # 首先检查机器人是否在群组中以及权限
-                chat = await bot.get_chat(chat_id_int)
-                bot_member = await bot.get_chat_member(chat_id_int, (await bot.get_me()).id)
-                logger.info(f"机器人在群组 {chat_id_int} 中的状态: {bot_member.status}")
+                # 首先检查机器人是否在群组中以及权限（标题、管理员和成员数均走缓存）
+                chat_title = await get_chat_title(bot, chat_id_int)
+                bot_status = await get_bot_status(bot, chat_id_int)
+                logger.info(f"机器人在群组 {chat_id_int} 中的状态: {bot_status}")
                 
                 members = []
-                member_count = await bot.get_chat_member_count(chat_id_int)
+                member_count = await get_member_count(bot, chat_id_int)
                 logger.info(f"群组 {chat_id_int} 总成员数: {member_count}")
                 
                 # 获取管理员列表
-                admins = await bot.get_chat_administrators(chat_id_int)
+                admins = await get_chat_admins(bot, chat_id_int)
                 admin_ids = set()
                 
                 # 将管理员添加到成员列表
@@ -1416,23 +3552,15 @@ async def get_group_members(chat_id):
                     logger.info(f"获取到管理员: {user.full_name} ({user.id})")
                 
                 # 获取最近的消息记录以识别活跃成员
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
+                def load_active_users(conn):
+                    c = conn.cursor()
                 
-                # 获取最近发送消息的用户ID和最后活跃时间
-                c.execute('''
-                    SELECT from_user_id, user_name, MAX(timestamp) as last_active
-                    FROM messages 
-                    WHERE chat_id = ? 
-                    AND from_user_id IS NOT NULL 
-                    AND from_user_id != 0
-                    GROUP BY from_user_id, user_name
-                    ORDER BY last_active DESC
-                    LIMIT 100
-                ''', (chat_id_int,))
+                    # 获取最近发送消息的用户ID和最后活跃时间
+                    c.execute(GROUP_MEMBERS_SQL, (chat_id_int,))
                 
-                active_users = c.fetchall()
-                conn.close()
+                    return c.fetchall()
+
+                active_users = await db.run(load_active_users)
                 
                 # 获取活跃成员的详细信息
                 for user_id, user_name, last_active in active_users:
@@ -1464,7 +3592,7 @@ async def get_group_members(chat_id):
                     'members': members,
                     'total_members': member_count,
                     'visible_members': len(members),
-                    'chat_title': chat.title
+                    'chat_title': chat_title
                 })
                 
             except telegram.error.Forbidden as e:
@@ -1491,18 +3619,18 @@ async def get_group_members(chat_id):
 def list_auto_mute_settings():
     """获取所有自动禁言设置"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+        with db.connection() as conn:
+            c = conn.cursor()
 
-        c.execute('''
-            SELECT 
-                chat_id, enabled, start_time, end_time, 
-                days_of_week, mute_level, updated_at 
-            FROM auto_mute_settings 
-            WHERE enabled = 1
-            ORDER BY updated_at DESC
-        ''')
-        rows = c.fetchall()
+            c.execute('''
+                SELECT 
+                    chat_id, enabled, start_time, end_time, 
+                    days_of_week, mute_level, updated_at 
+                FROM auto_mute_settings 
+                WHERE enabled = 1
+                ORDER BY updated_at DESC
+            ''')
+            rows = c.fetchall()
         
         if rows is None:
             return jsonify({
@@ -1548,21 +3676,44 @@ def list_auto_mute_settings():
             'status': 'error',
             'message': f"获取设置失败: {str(e)}"
         }), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/serve_file/<filename>')
 @login_required
 def serve_file(filename):
-    """提供文件下载服务"""
+    """
+    提供文件下载服务
+
+    文件名由 file_unique_id（旧文件为时间戳加 file_unique_id）决定，内容不会改变，
+    因此允许浏览器长期缓存。配置了 X_ACCEL_PREFIX 时只做登录校验，文件由 nginx 从磁盘发送，
+    ETag、Last-Modified 和条件请求都由 nginx 处理（nginx 会用自己的 ETag 替换应用设置的值）；
+    否则用文件名作为强 ETag，由 send_file 处理 Range 和条件请求。
+    """
+    if filename.startswith('.') or filename.endswith('.part'):
+        return "File not found", 404
+
+    cache_control = f"private, max-age={MEDIA['CACHE_MAX_AGE']}, immutable"
+    if MEDIA['X_ACCEL_PREFIX']:
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = MEDIA['X_ACCEL_PREFIX'] + filename
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    etag = os.path.splitext(filename)[0]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        return response
+
     try:
         file_path = os.path.join(FILES_DIR, filename)
-        if os.path.exists(file_path):
-            return send_file(file_path)
-        else:
+        if not os.path.isfile(file_path):
             logger.error(f"File not found: {file_path}")
             return "File not found", 404
+        response = send_file(file_path, conditional=True, etag=etag, max_age=MEDIA['CACHE_MAX_AGE'])
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        return response
     except Exception as e:
         logger.error(f"Error serving file {filename}: {str(e)}")
         return "Error serving file", 500
@@ -1590,84 +3741,293 @@ def logout():
 def home():
     return render_template('index.html', admin_id=TELEGRAM['ADMIN_ID'])
 
+def encode_cursor(timestamp, message_id):
+    """把 (timestamp, id) 编码成分页游标"""
+    raw = json.dumps([timestamp, message_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """解析分页游标，格式不正确时抛出 ValueError"""
+    try:
+        timestamp, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(timestamp), int(message_id)
+    except Exception:
+        raise ValueError(f"无效的分页游标: {cursor}")
+
+def count_messages(conn, where_sql, params):
+    """获取符合条件的消息总数，结果按过滤条件缓存 COUNT_CACHE_TTL 秒"""
+    key = (where_sql, tuple(params))
+    total = message_count_cache.get(key)
+    if total is None:
+        total = conn.execute(f"SELECT COUNT(*) FROM messages WHERE 1=1{where_sql}", params).fetchone()[0]
+        message_count_cache.set(key, total)
+    return total
+
+def get_message_delta(since_id, where_sql, filter_params, limit):
+    """
+    获取 id 大于 since_id 的新消息
+
+    没有新消息时直接根据写入器记录的最新 id 返回，不访问数据库。
+    新消息超过 limit 条时返回 reset，由前端重新加载第一页。
+    """
+    last_id = ingest_writer.last_message_id
+    if since_id >= last_id:
+        return {'messages': [], 'last_id': since_id, 'unchanged': True}
+
+    with db.connection() as conn:
+        rows = conn.execute(
+            MESSAGES_SINCE_SQL.format(where=where_sql),
+            [since_id, last_id, *filter_params, limit + 1]
+        ).fetchall()
+
+    if len(rows) > limit:
+        return {'messages': [], 'last_id': last_id, 'reset': True}
+    return {
+        'messages': [message_row_to_dict(row) for row in rows],
+        'last_id': last_id,
+        'unchanged': False
+    }
+
 @app.route('/messages', methods=['GET'])
 @login_required
 def get_messages():
+    """
+    获取消息列表
+
+    支持两种分页方式：
+    - 游标分页：传入 before（更早的消息）或 after（更新的消息），按 (timestamp, id) 定位，
+      每次只读取一页的数据，与翻到第几页无关
+    - 页码分页：传入 page，保留给旧的调用方使用
+    返回的 total 来自缓存，可能略有滞后。
+    传入 since_id 时只返回比它更新的消息，供自动刷新增量拉取。
+    """
     try:
-        logger.info("Received request for messages")
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 50, type=int)
         chat_type = request.args.get('chat_type', 'all')
         message_type = request.args.get('message_type', 'all')
         group_id = request.args.get('group_id', 'all')  # 添加群组ID参数
-        offset = (page - 1) * per_page
-        
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # 构建基础查询
-        base_query = """
-            SELECT timestamp, chat_id, chat_title, user_name, message_type, 
-                   message_content, file_path, COALESCE(from_user_id, '') as from_user_id
-            FROM messages
-            WHERE 1=1
-        """
-        count_query = "SELECT COUNT(*) FROM messages WHERE 1=1"
-        query_params = []
-        
-        # 添加过滤条件
-        if chat_type != 'all':
-            base_query += " AND chat_type = ?"
-            count_query += " AND chat_type = ?"
-            query_params.append(chat_type)
-            
-        if message_type != 'all':
-            base_query += " AND message_type = ?"
-            count_query += " AND message_type = ?"
-            query_params.append(message_type)
+        before = request.args.get('before')
+        after = request.args.get('after')
+        since_id = request.args.get('since_id', type=int)
+
+        try:
+            before_key = decode_cursor(before) if before else None
+            after_key = decode_cursor(after) if after else None
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+
+        # 构建过滤条件
+        where_sql, filter_params = message_filters(chat_type, message_type, group_id)
+
+        if since_id is not None:
+            return jsonify(get_message_delta(since_id, where_sql, filter_params, per_page))
+
+        # 多取一条用来判断是否还有下一页
+        if before_key:
+            base_query = MESSAGES_BEFORE_SQL.format(where=where_sql)
+            query_params = [*filter_params, *before_key, per_page + 1]
+        elif after_key:
+            base_query = MESSAGES_AFTER_SQL.format(where=where_sql)
+            query_params = [*filter_params, *after_key, per_page + 1]
+        else:
+            base_query = MESSAGES_PAGE_SQL.format(where=where_sql)
+            query_params = [*filter_params, per_page + 1, (page - 1) * per_page]
+
+        # 先取最新 id 再查询，保证之后的增量请求不会漏掉消息（重复的由前端去重）
+        last_id = ingest_writer.last_message_id
+        with db.connection() as conn:
+            rows = conn.execute(base_query, query_params).fetchall()
+            total_count = count_messages(conn, where_sql, filter_params)
+            if after_key:
+                # 游标本身及更早的消息是否存在，决定是否还能往后翻
+                older_exists = conn.execute(
+                    MESSAGES_OLDER_EXISTS_SQL.format(where=where_sql),
+                    [*filter_params, *after_key]
+                ).fetchone() is not None
+
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if after_key:
+            rows.reverse()
+
+        messages = [message_row_to_dict(row) for row in rows]
+
+        # next_cursor 指向更早的一页，prev_cursor 指向更新的一页
+        next_cursor = prev_cursor = None
+        if messages:
+            first, last = messages[0], messages[-1]
+            if after_key:
+                newer_exists = has_more
+            else:
+                older_exists, newer_exists = has_more, bool(before_key) or page > 1
+            if older_exists:
+                next_cursor = encode_cursor(last['timestamp'], last['id'])
+            if newer_exists:
+                prev_cursor = encode_cursor(first['timestamp'], first['id'])
+
+        return jsonify({
+            'messages': messages,
+            'total': total_count,
+            'total_is_estimate': True,
+            'page': page,
+            'per_page': per_page,
+            'total_pages': (total_count + per_page - 1) // per_page,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor,
+            'last_id': last_id
+        })
+    except Exception as e:
+        logger.error(f"Error fetching messages: {str(e)}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# trigram 分词只能匹配不少于 3 个字符的子串
+FTS_MIN_TERM_LENGTH = 3
+
+# snippet() 用不可见字符标记命中位置，转义 HTML 后再替换成 <mark>
+SNIPPET_OPEN = '\x02'
+SNIPPET_CLOSE = '\x03'
+
+def split_search_terms(query):
+    """拆分搜索词：返回 (FTS5 MATCH 表达式, 需要用 LIKE 过滤的短词列表)"""
+    indexed, short = [], []
+    for term in query.split():
+        (indexed if len(term) >= FTS_MIN_TERM_LENGTH else short).append(term)
+    match = ' AND '.join('"' + term.replace('"', '""') + '"' for term in indexed)
+    return match, short
+
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def render_snippet(snippet):
+    """把 snippet() 的结果转义并把命中部分包在 <mark> 中"""
+    return html.escape(snippet).replace(SNIPPET_OPEN, '<mark>').replace(SNIPPET_CLOSE, '</mark>')
+
+def make_snippet(text, terms, width=32):
+    """LIKE 搜索没有 snippet()，按第一个命中的词截取前后文"""
+    lowered = text.lower()
+    positions = [(lowered.find(term.lower()), term) for term in terms]
+    positions = [(pos, term) for pos, term in positions if pos >= 0]
+    if not positions:
+        return html.escape(text[:width * 2])
+    pos, term = min(positions)
+    start = max(0, pos - width)
+    end = min(len(text), pos + len(term) + width)
+    return (
+        ('…' if start > 0 else '')
+        + html.escape(text[start:pos])
+        + '<mark>' + html.escape(text[pos:pos + len(term)]) + '</mark>'
+        + html.escape(text[pos + len(term):end])
+        + ('…' if end < len(text) else '')
+    )
+
+def parse_search_time(value, end=False):
+    """解析 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS（UTC），返回与 messages.timestamp 相同格式的字符串"""
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            parsed = datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            continue
+        if end and fmt == '%Y-%m-%d':
+            # 只给日期时包含当天
+            parsed += timedelta(days=1)
+        elif end:
+            parsed += timedelta(seconds=1)
+        return parsed.strftime('%Y-%m-%d %H:%M:%S UTC')
+    raise ValueError(f'无效的时间格式: {value}')
+
+@app.route('/messages/search', methods=['GET'])
+@login_required
+def search_messages():
+    """
+    全文搜索消息
+
+    q 按空格拆分为多个词，全部命中才返回。不少于 3 个字符的词使用 messages_fts
+    （trigram 索引，中文同样按子串匹配），按 bm25 相关度或时间排序并返回高亮片段；
+    全部都是短词时退回 LIKE 扫描，只按时间排序。
+    可选过滤：group_id、user_id、chat_type、message_type、start、end（UTC 时间）。
+    """
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'status': 'error', 'message': '缺少搜索关键词'}), 400
+
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 50, type=int), 1), 200)
+        sort = request.args.get('sort', 'relevance')
+
+        where_sql = ""
+        filter_params = []
+        for arg, column in (('chat_type', 'chat_type'), ('message_type', 'message_type'),
+                            ('group_id', 'chat_id'), ('user_id', 'from_user_id')):
+            value = request.args.get(arg, 'all')
+            if value != 'all' and value != '':
+                where_sql += f" AND {column} = ?"
+                filter_params.append(value)
+        try:
+            if request.args.get('start'):
+                where_sql += " AND timestamp >= ?"
+                filter_params.append(parse_search_time(request.args['start']))
+            if request.args.get('end'):
+                where_sql += " AND timestamp < ?"
+                filter_params.append(parse_search_time(request.args['end'], end=True))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+
+        match, short_terms = split_search_terms(query)
+        for term in short_terms:
+            where_sql += " AND messages.message_content LIKE ? ESCAPE '\\'"
+            filter_params.append(f'%{escape_like(term)}%')
+
+        started = time.perf_counter()
+        with db.connection() as conn:
+            if match:
+                # 先只取这一页的 id 和相关度，snippet() 只为这一页的消息计算
+                order_sql = "score" if sort == 'relevance' else "hit_id DESC"
+                rows = conn.execute(f"""
+                    WITH hits AS (
+                        SELECT messages_fts.rowid AS hit_id, bm25(messages_fts) AS score
+                        FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid
+                        WHERE messages_fts MATCH ?{where_sql}
+                        ORDER BY {order_sql} LIMIT ? OFFSET ?
+                    )
+                    SELECT {MESSAGE_COLUMNS}, (
+                        SELECT snippet(messages_fts, 0, ?, ?, '…', 24)
+                        FROM messages_fts WHERE messages_fts MATCH ? AND rowid = hits.hit_id
+                    ) FROM hits JOIN messages ON messages.id = hits.hit_id
+                    ORDER BY {order_sql}
+                """, [match, *filter_params, per_page + 1, (page - 1) * per_page,
+                      SNIPPET_OPEN, SNIPPET_CLOSE, match]).fetchall()
+                mode = 'fts'
+            else:
+                rows = conn.execute(
+                    f"SELECT {MESSAGE_COLUMNS}, NULL FROM messages WHERE 1=1{where_sql} "
+                    f"ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?",
+                    [*filter_params, per_page + 1, (page - 1) * per_page]
+                ).fetchall()
+                mode = 'like'
+        elapsed = time.perf_counter() - started
 
-        if group_id != 'all':
-            base_query += " AND chat_id = ?"
-            count_query += " AND chat_id = ?"
-            query_params.append(group_id)
-        
-        # 获取总数
-        c.execute(count_query, query_params)
-        total_count = c.fetchone()[0]
-        logger.info(f"Total message count: {total_count}")
-        
-        # 添加排序和分页
-        base_query += " ORDER BY timestamp DESC LIMIT ? OFFSET ?"
-        query_params.extend([per_page, offset])
-        
-        # 执行主查询
-        c.execute(base_query, query_params)
-        
         messages = []
-        for row in c.fetchall():
-            message = {
-                'timestamp': row[0],
-                'chat_id': row[1],
-                'chat_title': row[2],
-                'user_name': row[3],
-                'message_type': row[4],
-                'message_content': row[5],
-                'file_path': row[6],
-                'from_user_id': row[7] if row[7] != '' else None
-            }
+        for row in rows[:per_page]:
+            message = message_row_to_dict(row)
+            message['snippet'] = (
+                render_snippet(row[-1]) if row[-1] is not None
+                else make_snippet(message['message_content'] or '', query.split())
+            )
             messages.append(message)
-        
-        conn.close()
-        
+
         return jsonify({
+            'status': 'success',
             'messages': messages,
-            'total': total_count,
             'page': page,
             'per_page': per_page,
-            'total_pages': (total_count + per_page - 1) // per_page
+            'has_more': len(rows) > per_page,
+            'mode': mode,
+            'took_ms': round(elapsed * 1000, 1)
         })
     except Exception as e:
-        logger.error(f"Error fetching messages: {str(e)}", exc_info=True)
+        logger.error(f"Error searching messages: {str(e)}", exc_info=True)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @app.route('/send_message', methods=['POST'])
@@ -1886,12 +4246,14 @@ async def _unmute_user_core(bot, chat_id: int, user_id: int):
             can_pin_messages=True
         )
         
-        await bot.restrict_chat_member(
+        await restrict_member(
+            bot,
             chat_id=chat_id,
             user_id=user_id,
             permissions=permissions
         )
         logger.info(f"[解除禁言] 成功解除用户 {user_id} 的禁言")
+        event_broker.publish('moderation', {'action': 'unmute_user', 'chat_id': chat_id, 'user_id': user_id})
         
     except Exception as e:
         logger.error(f"[解除禁言] 解除用户 {user_id} 禁言时出错: {str(e)}", exc_info=True)
@@ -1902,48 +4264,20 @@ async def _unmute_group_core(bot, chat_id: int):
     try:
         logger.info(f"[解除禁言] 开始解除群组 {chat_id} 的禁言")
         
-        request = HTTPXRequest(
-            connection_pool_size=1,
-            connect_timeout=30.0,
-            read_timeout=30.0,
-            write_timeout=30.0,
-            pool_timeout=3.0
-        )
-        temp_bot = telegram.Bot(token=bot.token, request=request)
-        
         try:
-            # 获取当前群组的权限状态
-            chat = await temp_bot.get_chat(chat_id)
-            current_permissions = chat.permissions
-            
-            # 定义目标权限状态
-            target_permissions = ChatPermissions(
-                can_send_messages=True,
-                can_send_polls=True,
-                can_send_other_messages=True,
-                can_add_web_page_previews=True,
-                can_change_info=True,
-                can_invite_users=True,
-                can_pin_messages=True
-            )
+            # 获取当前群组的权限状态（优先使用缓存）
+            current_permissions = await get_chat_permissions(bot, chat_id)
             
             # 检查是否需要更改权限
-            if (current_permissions.can_send_messages == target_permissions.can_send_messages and
-                current_permissions.can_send_polls == target_permissions.can_send_polls and
-                current_permissions.can_send_other_messages == target_permissions.can_send_other_messages and
-                current_permissions.can_add_web_page_previews == target_permissions.can_add_web_page_previews and
-                current_permissions.can_change_info == target_permissions.can_change_info and
-                current_permissions.can_invite_users == target_permissions.can_invite_users and
-                current_permissions.can_pin_messages == target_permissions.can_pin_messages):
-                
+            if current_permissions is not None and permissions_match(current_permissions, AUTO_UNMUTE_PERMISSIONS):
                 logger.info(f"[解除禁言] 群组 {chat_id} 已经处于解除禁言状态，无需修改")
                 return
             
             # 设置新的权限
-            await temp_bot.set_chat_permissions(
-                chat_id=chat_id,
-                permissions=target_permissions
-            )
+            if not await set_chat_permissions_cached(bot, chat_id, AUTO_UNMUTE_PERMISSIONS):
+                logger.info(f"[解除禁言] 群组 {chat_id} 权限未发生变化")
+                return
+            event_broker.publish('moderation', {'action': 'unmute_all', 'chat_id': chat_id})
 
             # 发送解除禁言通知
             notification_text = (
@@ -1951,7 +4285,7 @@ async def _unmute_group_core(bot, chat_id: int):
                 "✅ 现在可以正常发言了\n"
                 "📝 如有问题请联系管理员"
             )
-            await temp_bot.send_message(
+            await bot.send_message(
                 chat_id=chat_id,
                 text=notification_text,
                 parse_mode='HTML'
@@ -1969,6 +4303,14 @@ async def _unmute_group_core(bot, chat_id: int):
         logger.error(f"[解除禁言] 解除群组 {chat_id} 禁言时出错: {str(e)}", exc_info=True)
         raise
 
+# 可持久化的定时任务类型，payload 以关键字参数传给处理函数
+JOB_HANDLERS = {
+    'verification_timeout': handle_verification_timeout,
+    'delete_message': delete_message_job,
+    'unmute_user': _unmute_user_core,
+    'unmute_group': _unmute_group_core
+}
+
 # Flask 路由处理函数
 @app.route('/mute_user', methods=['POST'])
 @login_required
@@ -2013,8 +4355,7 @@ async def mute_user():
         try:
             async with bot_manager.get_bot() as bot:
                 # 检查机器人权限
-                bot_member = await bot.get_chat_member(chat_id, (await bot.get_me()).id)
-                if bot_member.status not in [ChatMemberStatus.ADMINISTRATOR]:
+                if await get_bot_status(bot, chat_id) not in [ChatMemberStatus.ADMINISTRATOR]:
                     logger.error("Bot needs admin rights")
                     return jsonify({
                         'status': 'error',
@@ -2022,19 +4363,27 @@ async def mute_user():
                     }), 403
 
                 # 执行禁言操作
-                await bot.restrict_chat_member(
+                await restrict_member(
+                    bot,
                     chat_id=chat_id,
                     user_id=user_id,
                     permissions=permissions
                 )
+                event_broker.publish('moderation', {
+                    'action': 'mute_user',
+                    'chat_id': chat_id,
+                    'user_id': user_id,
+                    'duration': duration
+                })
 
                 # 如果设置了时长，创建定时解除任务
                 if duration is not None and duration > 0:
                     logger.info(f"[禁言] 创建用户 {user_id} 的 {duration} 秒自动解除任务")
                     task_id = f"user_mute_{chat_id}_{user_id}"
-                    task_manager.schedule_task(
+                    task_manager.schedule_job(
                         task_id,
-                        lambda bot: _unmute_user_core(bot, chat_id, user_id),
+                        'unmute_user',
+                        {'chat_id': chat_id, 'user_id': user_id},
                         duration
                     )
                     message = f'用户已被禁言 {duration} 秒'
@@ -2098,8 +4447,7 @@ async def mute_all():
 
         async with bot_manager.get_bot() as bot:
             # 检查机器人权限
-            bot_member = await bot.get_chat_member(chat_id, (await bot.get_me()).id)
-            if bot_member.status not in [ChatMemberStatus.ADMINISTRATOR]:
+            if await get_bot_status(bot, chat_id) not in [ChatMemberStatus.ADMINISTRATOR]:
                 logger.error("Bot needs admin rights")
                 return jsonify({
                     'status': 'error',
@@ -2113,9 +4461,10 @@ async def mute_all():
             if duration is not None and duration > 0:
                 logger.info(f"[禁言] 创建群组 {chat_id} 的 {duration} 秒自动解除任务")
                 task_id = f"group_mute_{chat_id}"
-                task_manager.schedule_task(
+                task_manager.schedule_job(
                     task_id,
-                    lambda bot: _unmute_group_core(bot, chat_id),
+                    'unmute_group',
+                    {'chat_id': chat_id},
                     duration
                 )
                 message = f'已开启{"严格" if mute_level == "strict" else "轻度"}全群禁言 {duration} 秒'
@@ -2233,16 +4582,18 @@ async def spam_filter_settings():
                     'message': '缺少群组ID'
                 }), 400
 
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            c.execute('''
-                SELECT enabled, rules
-                FROM spam_filter_settings 
-                WHERE chat_id = ?
-            ''', (chat_id,))
-            
-            row = c.fetchone()
+            def load_settings(conn):
+                c = conn.cursor()
+                
+                c.execute('''
+                    SELECT enabled, rules
+                    FROM spam_filter_settings 
+                    WHERE chat_id = ?
+                ''', (chat_id,))
+                
+                return c.fetchone()
+
+            row = await db.run(load_settings)
             if row:
                 settings = {
                     'enabled': bool(row[0]),
@@ -2254,7 +4605,6 @@ async def spam_filter_settings():
                     'rules': []
                 }
             
-            conn.close()
             return jsonify({
                 'status': 'success',
                 'settings': settings
@@ -2278,11 +4628,10 @@ async def spam_filter_settings():
                     'message': '缺少群组ID'
                 }), 400
 
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
             now = datetime.now(CHINA_TZ).strftime('%Y-%m-%d %H:%M:%S')
             
-            try:
+            def save_settings(conn):
+                c = conn.cursor()
                 c.execute('''
                     INSERT INTO spam_filter_settings 
                     (chat_id, enabled, rules, updated_at)
@@ -2294,13 +4643,19 @@ async def spam_filter_settings():
                 ''', (chat_id, enabled, json.dumps(rules), now))
                 
                 conn.commit()
+
+            await db.run(save_settings)
+
+            # 规则已变化，下一条消息时重新编译
+            try:
+                spam_filter_cache.invalidate(int(chat_id))
+            except (TypeError, ValueError):
+                spam_filter_cache.invalidate()
                 
-                return jsonify({
-                    'status': 'success',
-                    'message': '设置已更新'
-                })
-            finally:
-                conn.close()
+            return jsonify({
+                'status': 'success',
+                'message': '设置已更新'
+            })
             
     except Exception as e:
         logger.error(f"Error in spam_filter_settings: {str(e)}", exc_info=True)
@@ -2321,17 +4676,17 @@ def get_join_settings():
                 'message': '缺少群组ID'
             }), 400
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+        with db.connection() as conn:
+            c = conn.cursor()
         
-        c.execute('''
-            SELECT enabled, verify_type, question, answer, 
-                   welcome_message, timeout, updated_at
-            FROM join_settings 
-            WHERE chat_id = ?
-        ''', (chat_id,))
+            c.execute('''
+                SELECT enabled, verify_type, question, answer, 
+                       welcome_message, timeout, updated_at
+                FROM join_settings 
+                WHERE chat_id = ?
+            ''', (chat_id,))
         
-        row = c.fetchone()
+            row = c.fetchone()
         if row:
             settings = {
                 'enabled': bool(row[0]),
@@ -2363,9 +4718,6 @@ def get_join_settings():
             'status': 'error',
             'message': str(e)
         }), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 # 新增路由：更新入群设置
 @app.route('/join_settings', methods=['POST'])
@@ -2388,28 +4740,30 @@ async def update_join_settings():
         welcome_message = data.get('welcome_message', '')
         timeout = data.get('timeout', 300)
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+        def save_settings(conn):
+            c = conn.cursor()
         
-        now = datetime.now(CHINA_TZ).strftime('%Y-%m-%d %H:%M:%S')
+            now = datetime.now(CHINA_TZ).strftime('%Y-%m-%d %H:%M:%S')
         
-        c.execute('''
-            INSERT INTO join_settings 
-            (chat_id, enabled, verify_type, question, answer, 
-             welcome_message, timeout, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(chat_id) DO UPDATE SET
-            enabled=excluded.enabled,
-            verify_type=excluded.verify_type,
-            question=excluded.question,
-            answer=excluded.answer,
-            welcome_message=excluded.welcome_message,
-            timeout=excluded.timeout,
-            updated_at=excluded.updated_at
-        ''', (chat_id, enabled, verify_type, question, answer, 
-              welcome_message, timeout, now))
+            c.execute('''
+                INSERT INTO join_settings 
+                (chat_id, enabled, verify_type, question, answer, 
+                 welcome_message, timeout, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET
+                enabled=excluded.enabled,
+                verify_type=excluded.verify_type,
+                question=excluded.question,
+                answer=excluded.answer,
+                welcome_message=excluded.welcome_message,
+                timeout=excluded.timeout,
+                updated_at=excluded.updated_at
+            ''', (chat_id, enabled, verify_type, question, answer, 
+                  welcome_message, timeout, now))
         
-        conn.commit()
+            conn.commit()
+
+        await db.run(save_settings)
 
         # 如果启用了验证，发送通知到群组
         if enabled:
@@ -2437,9 +4791,6 @@ async def update_join_settings():
             'status': 'error',
             'message': str(e)
         }), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 # 新增路由：获取待验证用户列表
 @app.route('/pending_members', methods=['GET'])
@@ -2453,27 +4804,27 @@ def get_pending_members():
                 'message': '缺少群组ID'
             }), 400
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+        with db.connection() as conn:
+            c = conn.cursor()
         
-        c.execute('''
-            SELECT user_id, username, full_name, join_time, 
-                   verify_deadline, status
-            FROM pending_members 
-            WHERE chat_id = ? AND status = 'pending'
-            ORDER BY join_time DESC
-        ''', (chat_id,))
-        
-        members = []
-        for row in c.fetchall():
-            members.append({
-                'user_id': row[0],
-                'username': row[1],
-                'full_name': row[2],
-                'join_time': row[3],
-                'verify_deadline': row[4],
-                'status': row[5]
-            })
+            c.execute('''
+                SELECT user_id, username, full_name, join_time, 
+                       verify_deadline, status
+                FROM pending_members 
+                WHERE chat_id = ? AND status = 'pending'
+                ORDER BY join_time DESC
+            ''', (chat_id,))
+        
+            members = []
+            for row in c.fetchall():
+                members.append({
+                    'user_id': row[0],
+                    'username': row[1],
+                    'full_name': row[2],
+                    'join_time': row[3],
+                    'verify_deadline': row[4],
+                    'status': row[5]
+                })
         
         return jsonify({
             'status': 'success',
@@ -2486,9 +4837,6 @@ def get_pending_members():
             'status': 'error',
             'message': str(e)
         }), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 # 新增路由：处理验证结果
 @app.route('/verify_member', methods=['POST'])
@@ -2507,17 +4855,32 @@ async def verify_member():
                 'message': '缺少必要参数'
             }), 400
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # 更新用户状态
-        c.execute('''
-            UPDATE pending_members
-            SET status = ?
-            WHERE chat_id = ? AND user_id = ?
-        ''', ('approved' if approved else 'rejected', chat_id, user_id))
-        
-        conn.commit()
+        def update_status(conn):
+            c = conn.cursor()
+            
+            # 更新用户状态
+            c.execute('''
+                UPDATE pending_members
+                SET status = ?
+                WHERE chat_id = ? AND user_id = ?
+            ''', ('approved' if approved else 'rejected', chat_id, user_id))
+            
+            conn.commit()
+
+            # 查询欢迎消息
+            c.execute('''
+                SELECT welcome_message
+                FROM join_settings 
+                WHERE chat_id = ?
+            ''', (chat_id,))
+            return c.fetchone()
+
+        result = await db.run(update_status)
+        event_broker.publish('verification', {
+            'chat_id': chat_id,
+            'user_id': user_id,
+            'status': 'approved' if approved else 'rejected'
+        })
 
         # 处理验证结果
         async with bot_manager.get_bot() as bot:
@@ -2529,7 +4892,8 @@ async def verify_member():
                     can_send_other_messages=True,
                     can_add_web_page_previews=True
                 )
-                await bot.restrict_chat_member(
+                await restrict_member(
+                    bot,
                     chat_id=chat_id,
                     user_id=user_id,
                     permissions=permissions
@@ -2544,13 +4908,6 @@ async def verify_member():
                     parse_mode='HTML'
                 )
                 
-                # 查询欢迎消息
-                c.execute('''
-                    SELECT welcome_message
-                    FROM join_settings 
-                    WHERE chat_id = ?
-                ''', (chat_id,))
-                result = c.fetchone()
                 if result and result[0]:
                     welcome_msg = result[0]
                     await send_auto_delete_message(
@@ -2583,9 +4940,6 @@ async def verify_member():
             'status': 'error',
             'message': str(e)
         }), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 # 新增白名单相关路由
 @app.route('/spam_filter/whitelist', methods=['GET'])
@@ -2600,24 +4954,24 @@ def get_whitelist():
                 'message': '缺少群组ID'
             }), 400
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+        with db.connection() as conn:
+            c = conn.cursor()
         
-        c.execute('''
-            SELECT user_id, username, full_name, added_by, added_at, note
-            FROM spam_filter_whitelist 
-            WHERE chat_id = ?
-            ORDER BY added_at DESC
-        ''', (chat_id,))
-        
-        whitelist = [{
-            'user_id': row[0],
-            'username': row[1],
-            'full_name': row[2],
-            'added_by': row[3],
-            'added_at': row[4],
-            'note': row[5]
-        } for row in c.fetchall()]
+            c.execute('''
+                SELECT user_id, username, full_name, added_by, added_at, note
+                FROM spam_filter_whitelist 
+                WHERE chat_id = ?
+                ORDER BY added_at DESC
+            ''', (chat_id,))
+        
+            whitelist = [{
+                'user_id': row[0],
+                'username': row[1],
+                'full_name': row[2],
+                'added_by': row[3],
+                'added_at': row[4],
+                'note': row[5]
+            } for row in c.fetchall()]
         
         return jsonify({
             'status': 'success',
@@ -2630,9 +4984,6 @@ def get_whitelist():
             'status': 'error',
             'message': str(e)
         }), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 # 修改添加到白名单的路由
 @app.route('/spam_filter/whitelist', methods=['POST'])
@@ -2665,17 +5016,19 @@ async def add_to_whitelist():
                 username = None
                 full_name = None
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
         try:
-            c.execute('''
-                INSERT INTO spam_filter_whitelist 
-                (chat_id, user_id, username, full_name, added_by, note)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (chat_id, user_id, username, full_name, added_by, note))
-            
-            conn.commit()
+            def add_member(conn):
+                c = conn.cursor()
+                c.execute('''
+                    INSERT INTO spam_filter_whitelist 
+                    (chat_id, user_id, username, full_name, added_by, note)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (chat_id, user_id, username, full_name, added_by, note))
+                
+                conn.commit()
+
+            await db.run(add_member)
+            whitelist_index.add(chat_id, user_id)
             
             return jsonify({
                 'status': 'success',
@@ -2694,9 +5047,6 @@ async def add_to_whitelist():
             'status': 'error',
             'message': str(e)
         }), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/spam_filter/whitelist', methods=['DELETE'])
 @login_required
@@ -2713,17 +5063,19 @@ def remove_from_whitelist():
                 'message': '缺少必要参数'
             }), 400
 
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        c.execute('''
-            DELETE FROM spam_filter_whitelist 
-            WHERE chat_id = ? AND user_id = ?
-        ''', (chat_id, user_id))
-        
-        conn.commit()
+        with db.connection() as conn:
+            c = conn.cursor()
+            
+            c.execute('''
+                DELETE FROM spam_filter_whitelist 
+                WHERE chat_id = ? AND user_id = ?
+            ''', (chat_id, user_id))
+            
+            conn.commit()
+            removed = c.rowcount
+        whitelist_index.remove(chat_id, user_id)
         
-        if c.rowcount == 0:
+        if removed == 0:
             return jsonify({
                 'status': 'error',
                 'message': '用户不在白名单中'
@@ -2740,9 +5092,6 @@ def remove_from_whitelist():
             'status': 'error',
             'message': str(e)
         }), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 async def init_app():
     """初始化应用"""
@@ -2762,7 +5111,7 @@ async def init_app():
             # 使用配置文件中的 WEBHOOK_URL
             success = await bot.set_webhook(
                 url=TELEGRAM['WEBHOOK_URL'],  # 修改这里
-                allowed_updates=['message', 'edited_message', 'channel_post', 'edited_channel_post']
+                allowed_updates=['message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member']
             )
             
             if success:
@@ -2777,7 +5126,7 @@ async def init_app():
         logger.error(f"Failed to initialize app: {str(e)}", exc_info=True)
         raise
 async def _apply_mute_settings(bot, chat_id: int, mute_level: str, is_auto_mute: bool = False, duration: int = None):
-    """应用禁言设置的核心函数"""
+    """应用禁言设置的核心函数，返回群组权限是否发生了变化（未变化时不发送通知）"""
     permissions = ChatPermissions(
         can_send_messages=mute_level != 'strict',
         can_send_polls=False,
@@ -2788,11 +5137,15 @@ async def _apply_mute_settings(bot, chat_id: int, mute_level: str, is_auto_mute:
         can_pin_messages=False
     )
     
-    # 设置权限
-    await bot.set_chat_permissions(
-        chat_id=chat_id,
-        permissions=permissions
-    )
+    # 设置权限，已经是相同级别的禁言时不重复调用
+    if not await set_chat_permissions_cached(bot, chat_id, permissions):
+        return False
+    event_broker.publish('moderation', {
+        'action': 'mute_all',
+        'chat_id': chat_id,
+        'mute_level': mute_level,
+        'duration': duration
+    })
     
     # 只有在不是自动禁言的情况下才发送常规禁言通知
     if not is_auto_mute:
@@ -2807,148 +5160,443 @@ async def _apply_mute_settings(bot, chat_id: int, mute_level: str, is_auto_mute:
             text=notification_text,
             parse_mode='HTML'
         )
+    return True
 
-async def check_auto_mute():
-    """检查并执行自动禁言"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # 获取所有启用了自动禁言的设置
-        c.execute('SELECT * FROM auto_mute_settings WHERE enabled = 1')
-        settings = c.fetchall()
-        
-        # 使用北京时间
+def auto_mute_permissions(mute_level):
+    """自动禁言时段内的群组权限，轻度禁言仍允许发送文字"""
+    return ChatPermissions(
+        can_send_messages=mute_level != 'strict',
+        can_send_polls=False,
+        can_send_other_messages=False,
+        can_add_web_page_previews=False,
+        can_change_info=False,
+        can_invite_users=False,
+        can_pin_messages=False
+    )
+
+# 自动禁言结束后恢复的群组权限
+AUTO_UNMUTE_PERMISSIONS = ChatPermissions(
+    can_send_messages=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+    can_change_info=True,
+    can_invite_users=True,
+    can_pin_messages=True
+)
+
+class _AutoMutePlan:
+    """一个群组解析后的自动禁言设置"""
+    __slots__ = ('chat_id', 'start_text', 'end_text', 'start', 'end', 'days', 'mute_level')
+
+    def __init__(self, chat_id, start_text, end_text, days, mute_level):
+        self.chat_id = chat_id
+        self.start_text = start_text
+        self.end_text = end_text
+        self.start = datetime.strptime(start_text, '%H:%M').time()
+        self.end = datetime.strptime(end_text, '%H:%M').time()
+        self.days = [int(d) for d in days.split(',')]
+        self.mute_level = mute_level
+
+    def next_instant(self, action, after):
+        """返回 after（CHINA_TZ 时间）之后下一次开始或结束禁言的时刻，没有生效日期时返回 None"""
+        target = self.start if action == 'start' else self.end
+        for offset in range(8):
+            day = after.date() + timedelta(days=offset)
+            # 与原来的逐分钟检查一致：切换发生当天的 weekday() 必须在 days 中
+            if day.weekday() not in self.days:
+                continue
+            candidate = CHINA_TZ.localize(datetime.combine(day, target))
+            if candidate > after:
+                return candidate
+        return None
+
+    def previous_instant(self, action, before):
+        """返回 before 及之前最近一次开始或结束禁言的时刻"""
+        target = self.start if action == 'start' else self.end
+        for offset in range(8):
+            day = before.date() - timedelta(days=offset)
+            if day.weekday() not in self.days:
+                continue
+            candidate = CHINA_TZ.localize(datetime.combine(day, target))
+            if candidate <= before:
+                return candidate
+        return None
+
+    def expected_state(self, now):
+        """按最近一次应当发生的切换推算当前状态，返回 ('muted' 或 'unmuted', 切换时刻)，无法推算时返回 None"""
+        last_start = self.previous_instant('start', now)
+        last_end = self.previous_instant('end', now) if self.end != self.start else None
+        if last_start is None and last_end is None:
+            return None
+        if last_end is None or (last_start is not None and last_start > last_end):
+            return 'muted', last_start
+        return 'unmuted', last_end
+
+# 切换成功后记录群组当前的禁言状态；失败时只记录错误，保留上一次成功的状态
+RECORD_AUTO_MUTE_SUCCESS_SQL = """
+    INSERT INTO auto_mute_state (chat_id, state, mute_level, due_at, applied_at, duration_ms, error)
+    VALUES (?, ?, ?, ?, ?, ?, NULL)
+    ON CONFLICT(chat_id) DO UPDATE SET
+        state = excluded.state,
+        mute_level = excluded.mute_level,
+        due_at = excluded.due_at,
+        applied_at = excluded.applied_at,
+        duration_ms = excluded.duration_ms,
+        error = NULL
+"""
+
+RECORD_AUTO_MUTE_FAILURE_SQL = """
+    INSERT INTO auto_mute_state (chat_id, due_at, applied_at, duration_ms, error)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id) DO UPDATE SET
+        due_at = excluded.due_at,
+        applied_at = excluded.applied_at,
+        duration_ms = excluded.duration_ms,
+        error = excluded.error
+"""
+
+async def set_auto_mute_permissions(bot, plan, action):
+    """设置自动禁言开始或结束后的群组权限，返回权限是否发生了变化"""
+    if action == 'start':
+        logger.info(f"[自动禁言] 群组 {plan.chat_id} 开始禁言 - 禁言时间：{plan.start_text} - {plan.end_text}")
+        permissions = auto_mute_permissions(plan.mute_level)
+    else:
+        logger.info(f"[自动禁言] 群组 {plan.chat_id} 解除禁言")
+        permissions = AUTO_UNMUTE_PERMISSIONS
+    changed = await set_chat_permissions_cached(bot, plan.chat_id, permissions)
+    event_broker.publish('auto_mute', {
+        'chat_id': plan.chat_id,
+        'action': 'started' if action == 'start' else 'ended'
+    })
+    return changed
+
+async def send_auto_mute_notice(bot, plan, action, restored=False):
+    """发送自动禁言开始或结束的通知；restored 表示核对时补做的切换，不是按时执行的"""
+    if restored and action == 'start':
+        notification_text = (
+            "🌙 当前处于自动禁言时段，已恢复禁言\n\n"
+            f"⏰ 禁言时段：{plan.start_text} - {plan.end_text}\n"
+            f"🔒 禁言级别：{plan.mute_level == 'strict' and '严格（禁止所有消息）' or '轻度（仅允许文字消息）'}"
+        )
+    elif restored:
+        notification_text = (
+            "🌅 自动禁言时段已过，已恢复正常发言\n\n"
+            "📝 如有问题请联系管理员"
+        )
+    elif action == 'start':
+        notification_text = (
+            "🌙 自动禁言模式已开始\n\n"
+            f"⏰ 禁言时段：{plan.start_text} - {plan.end_text}\n"
+            f"📅 生效日期：{formatDays(plan.days)}\n"
+            f"🔒 禁言级别：{plan.mute_level == 'strict' and '严格（禁止所有消息）' or '轻度（仅允许文字消息）'}\n\n"
+            "⚠️ 请各位成员注意休息"
+        )
+    else:
+        notification_text = (
+            "🌅 自动禁言模式已结束\n\n"
+            "✅ 现在可以正常发言了\n"
+            "📝 如有问题请联系管理员"
+        )
+    await bot.send_message(
+        chat_id=plan.chat_id,
+        text=notification_text,
+        parse_mode='HTML'
+    )
+
+class AutoMutePlanner:
+    """
+    自动禁言计划
+
+    启动时读取一次所有启用的设置，为每个群组算出下一次开始和结束禁言的时刻放进最小堆，
+    调度协程只睡眠到最早的时刻，到期后并发执行同一时刻的所有切换，并算出这些群组的下一次时刻。
+    设置被修改或删除时只重新读取该群组的一行，旧的堆条目在到达堆顶时丢弃。
+    空闲时不访问数据库；唤醒晚了也会执行已经到期的切换，不会错过。
+
+    启动时以及调度协程被推迟超过 AUTO_MUTE['STALL_THRESHOLD'] 秒后执行一次核对：
+    按设置推算每个群组此刻应处的状态，与 auto_mute_state 中记录的最近一次成功切换比较，
+    只对不一致的群组补做切换，不需要逐个调用 get_chat。
+    没有记录且此刻不在禁言时段的群组视为未禁言，不做处理。
+    只在常驻事件循环上修改堆。
+    """
+
+    def __init__(self):
+        self._plans = {}  # chat_id -> _AutoMutePlan
+        self._applied = {}  # chat_id -> (最近一次成功切换后的状态, 禁言级别)
+        self._heap = []  # (到期时间戳, 序号, 动作, plan)
+        self._seq = 0
+        self._wakeup = None
+        self._notice_tasks = set()  # 后台发送通知的任务，保留引用以免被回收
+        self._stats = {
+            'transitions': 0,
+            'failed': 0,
+            'reloads': 0,
+            'max_lateness': 0.0,
+            'last_lateness': 0.0,
+            'last_batch': None,
+            'reconciliations': 0,
+            'last_reconciled': 0
+        }
+
+    @staticmethod
+    def _parse(row):
+        chat_id, start_time, end_time, days_of_week, mute_level = row
+        try:
+            return _AutoMutePlan(chat_id, start_time, end_time, days_of_week, mute_level)
+        except (TypeError, ValueError) as e:
+            logger.error(f"[自动禁言] 群组 {chat_id} 的设置无效: {str(e)}")
+            return None
+
+    @staticmethod
+    def _read_all(conn):
+        rows = conn.execute('''
+            SELECT chat_id, start_time, end_time, days_of_week, mute_level
+            FROM auto_mute_settings WHERE enabled = 1
+        ''').fetchall()
+        applied = conn.execute(
+            'SELECT chat_id, state, mute_level FROM auto_mute_state WHERE state IS NOT NULL'
+        ).fetchall()
+        return rows, applied
+
+    async def load(self):
+        """读取所有启用的设置并重建计划"""
+        rows, applied = await db.run(self._read_all)
+        self._plans = {}
+        self._heap = []
+        self._applied = {chat_id: (state, mute_level) for chat_id, state, mute_level in applied}
         now = datetime.now(CHINA_TZ)
-        
-        for row in settings:
-            chat_id = row[1]
-            start_time = datetime.strptime(row[3], '%H:%M').time()
-            end_time = datetime.strptime(row[4], '%H:%M').time()
-            days_of_week = [int(d) for d in row[5].split(',')]
-            mute_level = row[6]
-            
-            current_time = now.time()
-            current_day = now.weekday()
-            
-            # 检查是否在设定的日期内
-            if current_day not in days_of_week:
+        for row in rows:
+            plan = self._parse(row)
+            if plan is not None:
+                self._add(plan, now)
+        logger.info(f"[自动禁言] 已加载 {len(self._plans)} 个群组的计划")
+
+    def record_applied(self, chat_id, state, mute_level):
+        """记录在计划之外（例如保存设置时立即禁言）成功完成的切换"""
+        self._applied[chat_id] = (state, mute_level)
+        ingest_writer.submit(RECORD_AUTO_MUTE_SUCCESS_SQL, (
+            chat_id, state, mute_level, time.time(), time.time(), None
+        ))
+
+    def reload_chat(self, chat_id):
+        """设置修改或删除后重新读取该群组（可在任意线程调用）"""
+        with db.connection() as conn:
+            row = conn.execute('''
+                SELECT chat_id, start_time, end_time, days_of_week, mute_level
+                FROM auto_mute_settings WHERE chat_id = ? AND enabled = 1
+            ''', (chat_id,)).fetchone()
+        plan = self._parse(row) if row else None
+        runtime.loop.call_soon_threadsafe(self._replace, chat_id, plan)
+
+    def _replace(self, chat_id, plan):
+        self._stats['reloads'] += 1
+        self._plans.pop(chat_id, None)
+        if plan is not None:
+            self._add(plan, datetime.now(CHINA_TZ))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _add(self, plan, now):
+        self._plans[plan.chat_id] = plan
+        self._push(plan, 'start', now)
+        # 开始和结束时间相同时只执行开始，与原来的判断顺序一致
+        if plan.end != plan.start:
+            self._push(plan, 'end', now)
+
+    def _push(self, plan, action, after):
+        instant = plan.next_instant(action, after)
+        if instant is None:
+            return
+        self._seq += 1
+        heapq.heappush(self._heap, (instant.timestamp(), self._seq, action, plan))
+
+    def _pop_due(self, now):
+        """取出所有已到期且仍然有效的切换，并为它们排好下一次"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due_at, _, action, plan = heapq.heappop(self._heap)
+            if self._plans.get(plan.chat_id) is not plan:
                 continue
-            
-            def is_exact_time(current, target):
-                """检查是否恰好是目标时间（精确到分钟）"""
-                return (current.hour == target.hour and 
-                       current.minute == target.minute and
-                       current.second < 30)
-            
+            self._push(plan, action, datetime.fromtimestamp(due_at, CHINA_TZ))
+            due.append((due_at, action, plan))
+        return due
+
+    async def run(self):
+        """调度协程：睡眠到最早的切换时刻"""
+        self._wakeup = asyncio.Event()
+        await self.load()
+        logger.info("[自动禁言] 调度器已启动")
+        await self.reconcile('启动')
+        while True:
             try:
-                async with bot_manager.get_bot() as bot:
-                    start_match = is_exact_time(current_time, start_time)
-                    end_match = is_exact_time(current_time, end_time)
-                    
-                    if start_match:
-                        logger.info(f"[自动禁言] 群组 {chat_id} 开始禁言 - 禁言时间：{row[3]} - {row[4]}")
-                        
-                        # 设置禁言
-                        permissions = ChatPermissions(
-                            can_send_messages=mute_level != 'strict',
-                            can_send_polls=False,
-                            can_send_other_messages=False,
-                            can_add_web_page_previews=False,
-                            can_change_info=False,
-                            can_invite_users=False,
-                            can_pin_messages=False
-                        )
-                        
-                        await bot.set_chat_permissions(
-                            chat_id=chat_id,
-                            permissions=permissions
-                        )
-                        
-                        # 发送开启通知
-                        notification_text = (
-                            "🌙 自动禁言模式已开始\n\n"
-                            f"⏰ 禁言时段：{row[3]} - {row[4]}\n"
-                            f"📅 生效日期：{formatDays(days_of_week)}\n"
-                            f"🔒 禁言级别：{mute_level == 'strict' and '严格（禁止所有消息）' or '轻度（仅允许文字消息）'}\n\n"
-                            "⚠️ 请各位成员注意休息"
-                        )
-                        await bot.send_message(
-                            chat_id=chat_id,
-                            text=notification_text,
-                            parse_mode='HTML'
-                        )
-                            
-                    elif end_match:
-                        logger.info(f"[自动禁言] 群组 {chat_id} 解除禁言")
-                        
-                        # 解除禁言
-                        permissions = ChatPermissions(
-                            can_send_messages=True,
-                            can_send_polls=True,
-                            can_send_other_messages=True,
-                            can_add_web_page_previews=True,
-                            can_change_info=True,
-                            can_invite_users=True,
-                            can_pin_messages=True
-                        )
-                        
-                        await bot.set_chat_permissions(
-                            chat_id=chat_id,
-                            permissions=permissions
-                        )
-                        
-                        # 发送解除通知
-                        notification_text = (
-                            "🌅 自动禁言模式已结束\n\n"
-                            "✅ 现在可以正常发言了\n"
-                            "📝 如有问题请联系管理员"
-                        )
-                        await bot.send_message(
-                            chat_id=chat_id,
-                            text=notification_text,
-                            parse_mode='HTML'
-                        )
-                    
+                now = time.time()
+                due = self._pop_due(now)
+                if due:
+                    await self._dispatch(due)
+                    continue
+
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+                # 本应在 timeout 后醒来却晚了很多：期间可能错过了多次切换，
+                # 直接按当前应处的状态核对，而不是依次补做每一次切换
+                stall = time.time() - (now + timeout) if timeout is not None else 0
+                if stall > AUTO_MUTE['STALL_THRESHOLD']:
+                    logger.warning(f"[自动禁言] 调度协程被推迟了 {stall:.0f} 秒")
+                    self._pop_due(time.time())
+                    await self.reconcile('调度延迟')
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logger.error(f"[自动禁言] 群组 {chat_id} 操作失败: {str(e)}")
-                
-    except Exception as e:
-        logger.error(f"[自动禁言] 检查过程出错: {str(e)}")
-    finally:
-        if 'conn' in locals():
-            conn.close()
+                logger.error(f"[自动禁言] 调度器错误: {str(e)}", exc_info=True)
+                await asyncio.sleep(1)
+
+    async def reconcile(self, reason):
+        """补做与记录状态不一致的群组的切换"""
+        now = datetime.now(CHINA_TZ)
+        pending = []
+        for plan in self._plans.values():
+            expected = plan.expected_state(now)
+            if expected is None:
+                continue
+            state, instant = expected
+            applied = self._applied.get(plan.chat_id)
+            if applied is None:
+                if state == 'unmuted':
+                    continue
+            elif applied[0] == state and (state == 'unmuted' or applied[1] == plan.mute_level):
+                continue
+            pending.append((instant.timestamp(), 'start' if state == 'muted' else 'end', plan))
+
+        self._stats['reconciliations'] += 1
+        self._stats['last_reconciled'] = len(pending)
+        if not pending:
+            logger.info(f"[自动禁言] {reason}核对完成，所有群组状态一致")
+            return
+        logger.info(f"[自动禁言] {reason}核对发现 {len(pending)} 个群组需要补做切换")
+        await self._dispatch(pending, restored=True)
+
+    async def _dispatch(self, due, restored=False):
+        """
+        并发执行同一时刻到期的切换（最多 AUTO_MUTE['CONCURRENCY'] 个群组同时进行），
+        共用连接池中的同一个 bot。先设置所有群组的权限，通知在后台发送，
+        权限切换不会因为排队发送通知而推迟；权限本来就是目标状态的群组不发送通知。
+        每个群组的结果和耗时写入 auto_mute_state。
+        restored 为核对补做的切换：距原定时刻的间隔不计入延迟统计，通知说明是恢复状态。
+        """
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(AUTO_MUTE['CONCURRENCY'])
+
+        async def flip(bot, due_at, action, plan):
+            async with semaphore:
+                if not restored:
+                    lateness = max(time.time() - due_at, 0.0)
+                    self._stats['last_lateness'] = lateness
+                    self._stats['max_lateness'] = max(self._stats['max_lateness'], lateness)
+                    if lateness > 60:
+                        logger.warning(f"[自动禁言] 群组 {plan.chat_id} 的切换延迟了 {lateness:.0f} 秒")
+
+                call_started = time.monotonic()
+                try:
+                    changed = await set_auto_mute_permissions(bot, plan, action)
+                except Exception as e:
+                    duration_ms = (time.monotonic() - call_started) * 1000
+                    self._stats['failed'] += 1
+                    logger.error(f"[自动禁言] 群组 {plan.chat_id} 操作失败: {str(e)}")
+                    ingest_writer.submit(RECORD_AUTO_MUTE_FAILURE_SQL, (
+                        plan.chat_id, due_at, time.time(), duration_ms, str(e)
+                    ))
+                    return None
+                duration_ms = (time.monotonic() - call_started) * 1000
+                state = 'muted' if action == 'start' else 'unmuted'
+                self._stats['transitions'] += 1
+                self._applied[plan.chat_id] = (state, plan.mute_level)
+                ingest_writer.submit(RECORD_AUTO_MUTE_SUCCESS_SQL, (
+                    plan.chat_id, state, plan.mute_level, due_at, time.time(), duration_ms
+                ))
+                return changed
+
+        async with bot_manager.get_bot() as bot:
+            results = await asyncio.gather(*(flip(bot, *entry) for entry in due))
+
+        elapsed = time.monotonic() - started
+        # flip 失败时返回 None，成功时返回权限是否发生了变化
+        succeeded = [(action, plan, changed) for (_, action, plan), changed in zip(due, results) if changed is not None]
+        changed = [(action, plan) for action, plan, was_changed in succeeded if was_changed]
+        self._stats['last_batch'] = {
+            'groups': len(due),
+            'succeeded': len(succeeded),
+            'seconds': round(elapsed, 3)
+        }
+        if len(due) > 1:
+            logger.info(f"[自动禁言] {len(due)} 个群组切换完成，成功 {len(succeeded)} 个，耗时 {elapsed:.1f} 秒")
+
+        if changed:
+            task = asyncio.get_running_loop().create_task(self._send_notices(changed, restored))
+            self._notice_tasks.add(task)
+            task.add_done_callback(self._notice_tasks.discard)
+
+    async def _send_notices(self, transitions, restored=False):
+        semaphore = asyncio.Semaphore(AUTO_MUTE['CONCURRENCY'])
+
+        async def notify(bot, action, plan):
+            async with semaphore:
+                try:
+                    await send_auto_mute_notice(bot, plan, action, restored)
+                except Exception as e:
+                    logger.error(f"[自动禁言] 群组 {plan.chat_id} 通知发送失败: {str(e)}")
+
+        try:
+            async with bot_manager.get_bot() as bot:
+                await asyncio.gather(*(notify(bot, action, plan) for action, plan in transitions))
+        except Exception as e:
+            logger.error(f"[自动禁言] 发送通知出错: {str(e)}")
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats['chats'] = len(self._plans)
+        stats['pending'] = len(self._heap)
+        stats['next_transition'] = (
+            datetime.fromtimestamp(self._heap[0][0], CHINA_TZ).strftime('%Y-%m-%d %H:%M:%S')
+            if self._heap else None
+        )
+        return stats
 
 def formatDays(days):
     """格式化星期显示"""
     day_names = ['周日', '周一', '周二', '周三', '周四', '周五', '周六']
     return '、'.join(day_names[day] for day in days)
 
-async def auto_mute_scheduler():
-    """自动禁言调度器"""
-    logger.info("[自动禁言] 调度器已启动")
-    while True:
-        try:
-            await check_auto_mute()
-        except Exception as e:
-            logger.error(f"[自动禁言] 调度器错误: {str(e)}")
-        finally:
-            # 等待到下一分钟的整点
-            now = datetime.now(CHINA_TZ)
-            next_minute = (now + timedelta(minutes=1)).replace(second=0, microsecond=0)
-            sleep_seconds = (next_minute - now).total_seconds()
-            await asyncio.sleep(sleep_seconds)
+# 创建全局自动禁言计划
+auto_mute_planner = AutoMutePlanner()
 
 if __name__ == '__main__':
     # 初始化目录
     init_directories()
     
+    # 只检查查询计划：python telegram-bot.py --check-query-plans，
+    # 有查询全表扫描或热点查询需要临时排序时以非零状态退出，可用于部署前检查
+    if '--check-query-plans' in sys.argv[1:]:
+        init_db(check_plans=False)
+        sys.exit(1 if check_query_plans() else 0)
+    
     # 初始化数据库
     init_db()
     
-    # 创建新的事件循环
+    # 加载白名单索引
+    whitelist_index.load()
+    
+    # 启动批量消息写入线程
+    ingest_writer.start()
+    
+    # 创建新的事件循环，并作为 Flask 路由共享的常驻运行时
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    runtime.attach(loop)
     
     async def main():
         try:
@@ -2962,20 +5610,29 @@ if __name__ == '__main__':
             tasks.append(app_task)
             
             # 启动自动禁言调度器
-            scheduler_task = asyncio.create_task(auto_mute_scheduler())
+            scheduler_task = asyncio.create_task(auto_mute_planner.run())
             tasks.append(scheduler_task)
             
             # 启动过期验证清理任务
             cleaner_task = asyncio.create_task(clean_expired_verifications())
             tasks.append(cleaner_task)
             
+            # 启动过期附件清理任务
+            retention_task = asyncio.create_task(media_retention.run())
+            tasks.append(retention_task)
+            
+            # 启动定时任务调度器，并恢复重启前未执行的任务
+            task_manager.start()
+            task_manager.restore_jobs()
+            
             # 启动 Flask 应用
             from threading import Thread
             def run_flask():
                 app.run(
                     host=SERVER['HOST'], 
                     port=SERVER['PORT'], 
-                    use_reloader=False
+                    use_reloader=False,
+                    threaded=True
                 )
             
             flask_thread = Thread(target=run_flask)
@@ -2985,6 +5642,7 @@ if __name__ == '__main__':
             logger.info("Flask 应用已启动")
             logger.info("自动禁言调度器已启动")
             logger.info("验证记录清理任务已启动")
+            logger.info("附件清理任务已启动")
             
             # 等待所有任务完成
             await asyncio.gather(*tasks)
@@ -2993,15 +5651,10 @@ if __name__ == '__main__':
             logger.error(f"启动错误: {str(e)}", exc_info=True)
             raise
     
-    # 优雅关闭处理
+    # 优雅关闭处理：信号只负责让事件循环退出，清理统一在下面的 finally 中按顺序进行
     def signal_handler(sig, frame):
         logger.info("接收到关闭信号，正在关闭服务器...")
-        for task in asyncio.all_tasks(loop):
-            task.cancel()
-        loop.stop()
-        loop.close()
-        logger.info("服务器已关闭")
-        sys.exit(0)
+        raise KeyboardInterrupt
     
     import signal
     signal.signal(signal.SIGINT, signal_handler)
@@ -3017,12 +5670,21 @@ if __name__ == '__main__':
         raise
     finally:
         logger.info("正在清理资源...")
+        # 先删完已经排队的消息（删除任务完成后还要写库，所以在停止写入线程之前）
+        try:
+            loop.run_until_complete(deletion_batcher.close())
+        except Exception as e:
+            logger.error(f"删除排队中的消息时出错: {str(e)}")
+        # 所有写入方都已处理完，再把队列中尚未落盘的数据写完
+        ingest_writer.stop()
         pending = asyncio.all_tasks(loop)
         for task in pending:
             task.cancel()
         
         try:
             loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.run_until_complete(media_downloader.close())
+            loop.run_until_complete(bot_manager.shutdown())
             loop.close()
         except Exception as e:
             logger.error(f"清理过程中出错: {str(e)}", exc_info=True)